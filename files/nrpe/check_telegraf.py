@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Nagios check of the telegraf internal metrics.
+
+Reads the local prometheus_client output the charm configures for the
+internal input (see health_port) with a single request per run.
+
+    check_telegraf.py errors --port 9274
+    check_telegraf.py buffer --port 9274 -w 80 -c 95 [--limit 10000]
+    check_telegraf.py gather --port 9274 -w 8 -c 10
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import urllib.request
+
+OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
+
+STATUS = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+# write errors are counted since telegraf started, the previous run's count
+# is kept in the nagios home dir
+STATE_DIR = '/var/lib/nagios'
+
+
+def get_metrics(port, timeout=5):
+    url = 'http://127.0.0.1:{}/metrics'.format(port)
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        content = response.read().decode('utf-8', 'replace')
+    metrics = []
+    for match in re.finditer(r'^(internal_\w+)(?:\{(.*)\})? (\S+)',
+                             content, flags=re.MULTILINE):
+        name, labels, value = match.groups()
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', labels or ''))
+        try:
+            metrics.append((name, labels, float(value)))
+        except ValueError:
+            continue
+    return metrics
+
+
+def check_errors(metrics, args):
+    errors = {}
+    for name, labels, value in metrics:
+        if name == 'internal_write_errors':
+            output = labels.get('output', '?')
+            errors[output] = errors.get(output, 0) + value
+    state_path = os.path.join(args.state_dir,
+                              'telegraf-write-errors-{}.json'.format(args.port))
+    try:
+        with open(state_path) as fd:
+            previous = json.load(fd)
+    except (IOError, ValueError):
+        previous = {}
+    with open(state_path, 'w') as fd:
+        json.dump(errors, fd)
+    rising = sorted('{} (+{:g})'.format(output, value - previous[output])
+                    for output, value in errors.items()
+                    if value > previous.get(output, value))
+    if rising:
+        return CRITICAL, 'write errors: {}'.format(', '.join(rising))
+    return OK, 'no new write errors in {} outputs'.format(len(errors))
+
+
+def check_buffer(metrics, args):
+    sizes = {}
+    limits = {}
+    for name, labels, value in metrics:
+        if name == 'internal_write_buffer_size':
+            sizes[labels.get('output', '?')] = value
+        elif name == 'internal_write_buffer_limit':
+            limits[labels.get('output', '?')] = value
+    status = OK
+    usage = []
+    for output, size in sorted(sizes.items()):
+        limit = limits.get(output) or args.limit
+        if not limit:
+            continue
+        percent = 100.0 * size / limit
+        if percent > args.critical:
+            status = CRITICAL
+        elif percent > args.warning:
+            status = max(status, WARNING)
+        usage.append('{} {:.0f}%'.format(output, percent))
+    return status, 'buffer usage: {}'.format(', '.join(usage) or 'no outputs')
+
+
+def check_gather(metrics, args):
+    status = OK
+    slow = []
+    for name, labels, value in metrics:
+        if name != 'internal_gather_gather_time_ns':
+            continue
+        seconds = value / 1e9
+        if seconds > args.critical:
+            status = CRITICAL
+        elif seconds > args.warning:
+            status = max(status, WARNING)
+        else:
+            continue
+        slow.append('{} {:.1f}s'.format(labels.get('input', '?'), seconds))
+    if slow:
+        return status, 'slow inputs: {}'.format(', '.join(sorted(slow)))
+    return OK, 'all inputs gathered under {:g}s'.format(args.warning)
+
+
+CHECKS = {'errors': check_errors, 'buffer': check_buffer,
+          'gather': check_gather}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('check', choices=sorted(CHECKS))
+    parser.add_argument('--port', type=int, default=9274)
+    parser.add_argument('-w', '--warning', type=float, default=80)
+    parser.add_argument('-c', '--critical', type=float, default=95)
+    parser.add_argument('--limit', type=float, default=0,
+                        help='metric_buffer_limit, if telegraf does not '
+                             'report it')
+    parser.add_argument('--state-dir', default=STATE_DIR)
+    args = parser.parse_args(argv)
+    try:
+        metrics = get_metrics(args.port)
+        status, message = CHECKS[args.check](metrics, args)
+    except Exception as e:
+        status, message = UNKNOWN, 'telegraf internal metrics: {}'.format(e)
+    print('{}: {}'.format(STATUS[status], message))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
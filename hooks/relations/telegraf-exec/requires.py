@@ -39,6 +39,10 @@ class ExecRequires(RelationBase):
                 # by default run_on_this_unit is True, we risk to run the command
                 # everywhere than not running it at all
                 cmd['run_on_this_unit'] = cmd_info.pop('run_on_this_unit', True)
+                # optional hints for the exec budget: a fixed interval, or the
+                # expected run time in seconds to derive the interval from
+                cmd['interval'] = cmd_info.pop('interval', None)
+                cmd['cost'] = cmd_info.pop('cost', None)
                 cmd.update(cmd_info)
                 cmds.append(cmd)
         return cmds
@@ -0,0 +1,47 @@
+from charms.reactive import hook
+from charms.reactive import RelationBase
+from charms.reactive import scopes
+
+
+class ListenerProvides(RelationBase):
+    scope = scopes.UNIT
+
+    @hook('{provides:telegraf-listener}-relation-{joined,changed}')
+    def changed(self):
+        conv = self.conversation()
+        conv.set_state('{relation_name}.available')
+
+    @hook('{provides:telegraf-listener}-relation-{departed,broken}')
+    def broken(self):
+        conv = self.conversation()
+        conv.remove_state('{relation_name}.available')
+
+    def listeners(self):
+        """Return the (transport, data_format) requested by each related unit"""
+        listeners = []
+        for conv in self.conversations():
+            # unix sockets by default, no ports to manage and no network
+            # stack overhead
+            transport = conv.get_remote('transport') or 'unix'
+            data_format = conv.get_remote('data_format') or 'influx'
+            listeners.append((transport, data_format))
+        return listeners
+
+    def users(self):
+        """Return the users the related units connect to unix sockets as"""
+        return [conv.get_remote('user') for conv in self.conversations()
+                if conv.get_remote('user')]
+
+    def configure(self, addresses):
+        """Send the address of the requested listener to each related unit.
+
+        addresses is a dict of (transport, data_format) -> address
+        """
+        for conv in self.conversations():
+            transport = conv.get_remote('transport') or 'unix'
+            data_format = conv.get_remote('data_format') or 'influx'
+            address = addresses.get((transport, data_format))
+            if address is None:
+                continue
+            conv.set_remote(transport=transport, data_format=data_format,
+                            address=address)
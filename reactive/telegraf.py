@@ -1,13 +1,29 @@
 import base64
 import binascii
+import contextlib
+import fcntl
+import fnmatch
+import glob
+import grp
+import hashlib
 import os
 import json
+import math
+import pwd
+import re
+import shutil
+import subprocess
+import time
+import urllib.request
 import yaml
 
+from collections import OrderedDict
+
 import apt_pkg
 
 from charms.reactive import (
     helpers,
+    hook,
     when,
     when_not,
     set_state,
@@ -15,31 +31,183 @@ from charms.reactive import (
 )
 from charms.reactive.bus import get_states
 
+from charmhelpers.contrib.charmsupport import nrpe
 from charmhelpers.core import hookenv, host, unitdata
 from charmhelpers.core.templating import render
 from charmhelpers.fetch import apt_install, apt_update, add_source
 
-from jinja2 import Template
-
 BASE_DIR = '/etc/telegraf'
 
 CONFIG_FILE = 'telegraf.conf'
 
 CONFIG_DIR = 'telegraf.d'
 
+LAST_GOOD_DIR = 'telegraf.last-good'
+
+LISTENER_SOCKET_DIR = '/var/lib/telegraf'
+
+# data formats of the telegraf input parsers, the listener relation can
+# request any of them
+LISTENER_DATA_FORMATS = ('avro', 'binary', 'collectd', 'csv', 'dropwizard',
+                         'form_urlencoded', 'graphite', 'grok', 'influx',
+                         'json', 'json_v2', 'logfmt', 'nagios', 'opentsdb',
+                         'prometheus', 'prometheusremotewrite', 'value',
+                         'wavefront', 'xml', 'xpath_json', 'xpath_msgpack',
+                         'xpath_protobuf')
+
+# tcp, udp and http listener ports of each co-located unit, from listener_port
+LISTENER_PORTS_PER_UNIT = 10
+
+# prometheus_client output of the prometheus-client relation, plus the slot
+# of co-located units
+PROMETHEUS_CLIENT_PORT = 9126
+
+SYSTEMD_DROPIN_DIR = '/etc/systemd/system/telegraf.service.d'
+
+SYSTEMD_DROPIN_FILE = 'juju.conf'
+
+SYSTEMD_OPTIONS = ('memory_max', 'cpu_quota', 'nice', 'io_scheduling_class',
+                   'gomaxprocs')
+
+# changing any of them (re)starts the debug_duration window
+DEBUG_OPTIONS = ('debug', 'debug_plugins', 'debug_duration')
+
+# rough upper bound of the memory used by each buffered metric, used to fit
+# metric_buffer_limit in the memory_max budget
+BUFFERED_METRIC_SIZE = 1024
+
+PROC_MOUNTS = '/proc/mounts'
+
+SYS_BLOCK = '/sys/block'
+
+PROC_MEMINFO = '/proc/meminfo'
+
+PROC_SOCKSTAT = ('/proc/net/sockstat', '/proc/net/sockstat6')
+
+NETSTAT_MODES = ('auto', 'netstat', 'slow', 'nstat', 'off')
+
+PROCSTAT_SELECTORS = ('systemd_unit', 'cgroup', 'pid_file')
+
+SYSTEMD_UNIT_DIRS = ('/etc/systemd/system', '/run/systemd/system',
+                     '/lib/systemd/system', '/usr/lib/systemd/system')
+
+PEER_RELATION = 'peers'
+
+# registry of the telegraf units sharing this machine, in BASE_DIR
+MACHINE_UNITS_DIR = 'juju-units'
+
+LOCK_FILE = '.juju.lock'
+
+NRPE_CHECKS = ('telegraf_proc', 'telegraf_write_errors', 'telegraf_buffer',
+               'telegraf_gather_time')
+
+# seconds to wait for the health endpoint, update-status runs it every time
+HEALTH_TIMEOUT = 2
+
+EXTRA_PLUGINS_FILE = 'extra_plugins.conf'
+
+EXTRA_PLUGINS_KINDS = ('inputs', 'outputs', 'processors', 'aggregators')
+
 
 # Utilities #
-def exec_timeout_supported():
+def get_installed_version(package):
+    """Return the installed version of package, or None if not installed"""
     apt_pkg.init()
     apt_pkg.config.set("Dir::Cache::pkgcache", "")
     cache = apt_pkg.Cache()
-    pkg = cache['telegraf']
+    try:
+        pkg = cache[package]
+    except KeyError:
+        return None
+    if pkg.current_ver is None:
+        return None
+    return pkg.current_ver.ver_str
+
+
+def exec_timeout_supported():
     timeout_support = True
-    if '0.12' in pkg.current_ver.ver_str:
+    if '0.12' in (get_installed_version('telegraf') or ''):
         timeout_support = False
     return timeout_support
 
 
+def version_compare(a, b):
+    apt_pkg.init_system()
+    return apt_pkg.version_compare(a, b)
+
+
+def content_encoding_supported():
+    """content_encoding is supported by the influxdb output since 1.8"""
+    version = get_installed_version('telegraf')
+    return version is not None and version_compare(version, '1.8') >= 0
+
+
+def diskio_globs_supported():
+    """Glob patterns in the diskio devices are supported since telegraf 1.10,
+    older versions only match device names"""
+    version = get_installed_version('telegraf')
+    return version is not None and version_compare(version, '1.10') >= 0
+
+
+def internal_input_supported():
+    """The internal input was added in telegraf 1.2"""
+    version = get_installed_version('telegraf')
+    return version is not None and version_compare(version, '1.2') >= 0
+
+
+def statsd_protocol_supported():
+    """The statsd input protocol option was added in telegraf 1.5"""
+    version = get_installed_version('telegraf')
+    return version is not None and version_compare(version, '1.5') >= 0
+
+
+def get_influxdb_content_encoding(versions):
+    """Return the content_encoding of the influxdb output, or None.
+
+    versions are the ones advertised by the related InfluxDB units, if any.
+    With influxdb_content_encoding set to auto writes are gzipped unless a
+    unit advertises a version older than 1.0.
+    """
+    encoding = hookenv.config().get('influxdb_content_encoding')
+    if encoding == 'auto':
+        old = [v for v in versions if v and version_compare(str(v), '1.0') < 0]
+        encoding = 'identity' if old else 'gzip'
+    if encoding in (None, '', 'identity'):
+        return None
+    if not content_encoding_supported():
+        hookenv.log("content_encoding requires telegraf >= 1.8, sending "
+                    "uncompressed writes")
+        return None
+    return encoding
+
+
+def get_package_file():
+    """Return the path of a telegraf deb shipped with the charm, or None.
+
+    A non-empty telegraf resource takes precedence over a file in the charm
+    files directory matching package_name.
+    """
+    try:
+        resource_path = hookenv.resource_get('telegraf')
+    except (NotImplementedError, OSError):
+        # resources are not supported by this juju version
+        resource_path = None
+    if resource_path:
+        resource_path = resource_path.strip()
+        if os.path.isfile(resource_path) and os.path.getsize(resource_path):
+            return resource_path
+    package_path = os.path.join(hookenv.charm_dir(), 'files',
+                                hookenv.config()['package_name'])
+    if os.path.isfile(package_path):
+        return package_path
+    return None
+
+
+def get_deb_version(package_path):
+    cmd = ['dpkg-deb', '--field', package_path, 'Version']
+    return subprocess.check_output(cmd).decode('utf-8').strip()
+
+
 def get_templates_dir():
     return os.path.join(hookenv.charm_dir(), 'templates')
 
@@ -52,6 +220,116 @@ def get_configs_dir():
     return os.path.join(BASE_DIR, CONFIG_DIR)
 
 
+def get_last_good_dir():
+    return os.path.join(BASE_DIR, LAST_GOOD_DIR)
+
+
+def get_systemd_dropin_path():
+    return os.path.join(SYSTEMD_DROPIN_DIR, SYSTEMD_DROPIN_FILE)
+
+
+def get_machine_units_dir():
+    return os.path.join(BASE_DIR, MACHINE_UNITS_DIR)
+
+
+def get_plugin_config_path(plugin):
+    return os.path.join(get_configs_dir(),
+                        '{}{}.conf'.format(get_config_prefix(), plugin))
+
+
+def read_machine_registry():
+    """Return the registry entries of the telegraf units in this machine,
+    as {unit: {'unit': unit, 'registered': time, 'slot': slot}}"""
+    registry = {}
+    for path in glob.glob(os.path.join(get_machine_units_dir(), '*')):
+        try:
+            with open(path, 'r') as fd:
+                info = json.load(fd)
+        except (IOError, ValueError):
+            continue
+        if info.get('unit'):
+            registry[info['unit']] = info
+    return registry
+
+
+def list_machine_units():
+    """Return the telegraf units registered in this machine, oldest first"""
+    units = [(info.get('registered', 0), unit)
+             for unit, info in read_machine_registry().items()]
+    return [unit for _, unit in sorted(units)]
+
+
+def get_config_prefix():
+    """Return the prefix of the telegraf.d files of this unit.
+
+    Units of different principals can share a machine, and its telegraf.
+    The first unit registered in the machine uses plain file names, the
+    ones deployed next to it prefix them with their unit name.
+    """
+    kv = unitdata.kv()
+    prefix = kv.get('config_prefix')
+    slot = kv.get('machine_slot')
+    unit = hookenv.local_unit()
+    if prefix is not None and slot is not None and kv.get('unit.stopped'):
+        # don't register back once the unit is being removed
+        return prefix
+    registry = read_machine_registry()
+    others = dict((u, info) for u, info in registry.items() if u != unit)
+    if prefix is None:
+        prefix = '{}-'.format(unit.replace('/', '-')) if others else ''
+        kv.set('config_prefix', prefix)
+    if slot is None:
+        # units registered before the slots were only the first one
+        used = set(info.get('slot', 0) for info in others.values())
+        slot = 0
+        while prefix and (slot == 0 or slot in used):
+            slot += 1
+        kv.set('machine_slot', slot)
+    info = registry.get(unit)
+    if not kv.get('unit.stopped') and (info is None or info.get('slot') != slot):
+        os.makedirs(get_machine_units_dir(), exist_ok=True)
+        registry_path = os.path.join(get_machine_units_dir(),
+                                     unit.replace('/', '-'))
+        with open(registry_path, 'w') as fd:
+            json.dump({'unit': unit, 'slot': slot,
+                       'registered': (info or {}).get('registered',
+                                                      time.time())}, fd)
+    return prefix
+
+
+def get_machine_slot():
+    """Return the slot of this unit in the machine, 0 for the first one.
+
+    The listeners of the co-located units are all served by the same
+    telegraf, each unit offsets its ports by its slot so they don't clash.
+    """
+    get_config_prefix()
+    return unitdata.kv().get('machine_slot')
+
+
+def is_machine_owner():
+    """Check if this unit manages the main config and the host inputs.
+
+    The oldest telegraf unit of the machine does, the others only add the
+    telegraf.d files of their relations.
+    """
+    get_config_prefix()
+    units = list_machine_units()
+    return not units or units[0] == hookenv.local_unit()
+
+
+@contextlib.contextmanager
+def machine_lock():
+    """Serialize the changes to the telegraf config shared by the units of
+    this machine"""
+    with open(os.path.join(BASE_DIR, LOCK_FILE), 'a') as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
 def list_supported_plugins():
     return [k for k in hookenv.metadata()['requires'].keys()
             if k != 'juju-info'] + \
@@ -65,96 +343,900 @@ def list_config_files():
     current_states = get_states()
     for plugin in list_supported_plugins():
         if 'plugins.{}.configured'.format(plugin) in current_states.keys():
-            config_path = '{}/{}.conf'.format(get_configs_dir(), plugin)
+            config_path = get_plugin_config_path(plugin)
             config_files.append(config_path)
-    if 'extra_plugins.configured' in current_states.keys():
-        config_files.append('{}/extra_plugins.conf'.format(get_configs_dir()))
+    if 'plugins.statsd.configured' in current_states.keys():
+        config_files.append(os.path.join(get_configs_dir(), 'statsd.conf'))
+    if 'plugins.procstat.configured' in current_states.keys():
+        config_files.append(get_plugin_config_path('procstat'))
+    config_files.extend(list_extra_plugins_files())
+    if os.path.exists(get_systemd_dropin_path()):
+        config_files.append(get_systemd_dropin_path())
+    return config_files
+
+
+def list_extra_plugins_files(configs_dir=None):
+    """Return the extra_plugins config files currently in telegraf.d, or in
+    configs_dir"""
+    configs_dir = configs_dir or get_configs_dir()
+    prefix = get_config_prefix()
+    files = glob.glob(os.path.join(configs_dir,
+                                   '{}extra_plugins-*.conf'.format(prefix)))
+    legacy_path = os.path.join(configs_dir, prefix + EXTRA_PLUGINS_FILE)
+    if os.path.exists(legacy_path):
+        files.append(legacy_path)
+    return sorted(files)
+
+
+def list_active_config_files():
+    """Return the config files telegraf would load right now"""
+    config_files = []
+    if os.path.exists(get_main_config_path()):
+        config_files.append(get_main_config_path())
+    config_files.extend(
+        sorted(glob.glob(os.path.join(get_configs_dir(), '*.conf'))))
     return config_files
 
 
 def get_remote_unit_name():
-    for rel_type in hookenv.metadata()['requires'].keys():
-        rels = hookenv.relations_of_type(rel_type)
-        if rels and len(rels) >= 1:
-            rel = rels[0]
-            if rel['private-address'] == hookenv.unit_private_ip():
-                return rel['__unit__']
+    """Return the name of the principal unit, or None if not known yet.
+
+    The name is cached in unitdata once found, as the principal of a
+    subordinate unit never changes.
+    """
+    kv = unitdata.kv()
+    unit_name = kv.get('principal_unit')
+    if unit_name is not None:
+        return unit_name
+    # juju >= 2.2 sets the principal unit in the hook environment
+    unit_name = os.environ.get('JUJU_PRINCIPAL_UNIT') or None
+    if unit_name is None:
+        # the remote unit of a container scoped relation is the principal,
+        # check juju-info first as it's the one expected to be always there
+        requires = hookenv.metadata()['requires']
+        rel_types = sorted([k for k, v in requires.items()
+                            if v.get('scope') == 'container'],
+                           key=lambda k: k != 'juju-info')
+        for rel_type in rel_types:
+            rels = hookenv.relations_of_type(rel_type)
+            if rels:
+                unit_name = rels[0]['__unit__']
+                break
+    if unit_name is not None:
+        kv.set('principal_unit', unit_name)
+    return unit_name
+
+
+def get_base_inputs():
+    """Return the config tables of the host inputs"""
+    inputs = get_extra_options()['inputs']
+    tables = []
+    if inputs.get('cpu'):
+        # cpu options in extra_options replace the cpu policy
+        tables.append(ConfigTable('inputs.cpu').update(inputs['cpu']))
+    else:
+        cpu_options = get_cpu_options()
+        tables.append(ConfigTable('inputs.cpu', [
+            ('percpu', cpu_options['percpu']),
+            ('totalcpu', True),
+            ('drop', ['time_*'])],
+            comments={'percpu': "Whether to report per-cpu stats or not, "
+                                "only up to percpu_max_cores",
+                      'totalcpu': "Whether to report total system cpu stats "
+                                  "or not",
+                      'drop': "Comment this line if you want the raw CPU "
+                              "time metrics"}))
+        if cpu_options['cpu_basicstats']:
+            tables.append(ConfigTable('inputs.cpu', [
+                ('name_override', 'cpu_cores'),
+                ('percpu', True),
+                ('totalcpu', False),
+                ('drop', ['time_*']),
+                ('tagexclude', ['cpu'])],
+                comment="Spread of the cpu usage across cores (min, max, "
+                        "mean...) instead of\nper-cpu stats, without the cpu "
+                        "tag all cores are aggregated together"))
+            tables.append(ConfigTable('aggregators.basicstats', [
+                ('namepass', ['cpu_cores']),
+                ('period', hookenv.config()['interval']),
+                ('drop_original', True)]))
+    tables[0].comment = "Read metrics about cpu usage"
+    # extra_options take precedence over the charm defaults
+    disk_options, diskio_options = get_disk_options()
+    tables.append(ConfigTable(
+        'inputs.disk', comment="Read metrics about disk usage by mount point, "
+        "filesystems in disk_ignore_fs\nare skipped, and with "
+        "disk_autodiscover only the mount points found when\nrendering this "
+        "file are gathered.").update(disk_options).update(inputs.get('disk')))
+    tables.append(ConfigTable(
+        'inputs.diskio', comment="Read metrics about disk IO by device, for "
+        "the devices matching diskio_devices,\nor for all devices including "
+        "disk partitions if it's empty.").update(
+            diskio_options).update(inputs.get('diskio')))
+    tables.append(ConfigTable('inputs.mem',
+                              comment="Read metrics about memory usage"))
+    tables.append(ConfigTable(
+        'inputs.net', comment="Read metrics about network interface usage, by "
+        "default from any up interface\n(excluding loopback), unless "
+        "interfaces are set in extra_options.").update(inputs.get('net')))
+    tables.extend(get_netstat_tables(inputs))
+    tables.append(ConfigTable('inputs.swap',
+                              comment="Read metrics about swap memory usage"))
+    tables.append(ConfigTable('inputs.system',
+                              comment="Read metrics about system load & uptime"))
+    return tables
 
 
 def render_base_inputs():
-    extra_options = get_extra_options()
-    # use base inputs from charm templates
-    with open(os.path.join(get_templates_dir(), 'base_inputs.conf'), 'r') as fd:
-        return render_template(
-            fd.read(),
-            {'extra_options': extra_options['inputs']})
+    return render_tables(get_base_inputs())
+
+
+def get_netstat_tables(inputs):
+    """Return the netstat input for the netstat_mode policy.
+
+    netstat enumerates every socket on each gather, on hosts with more than
+    netstat_max_sockets the auto mode uses the nstat kernel counters instead.
+    The mode in use is kept for the unit status.
+    """
+    config = hookenv.config()
+    mode = config.get('netstat_mode') or 'auto'
+    if mode not in NETSTAT_MODES:
+        hookenv.log("Invalid netstat_mode {}, expected one of: {}".format(
+            mode, ', '.join(NETSTAT_MODES)), level=hookenv.WARNING)
+        mode = 'auto'
+    description = mode
+    if mode == 'auto':
+        sockets = count_sockets()
+        max_sockets = config.get('netstat_max_sockets')
+        mode = 'netstat'
+        if max_sockets and sockets is not None and sockets > max_sockets:
+            hookenv.log("{} sockets, over netstat_max_sockets ({}), using "
+                        "nstat".format(sockets, max_sockets))
+            mode = 'nstat'
+        description = '{} ({} sockets)'.format(mode, sockets)
+    unitdata.kv().set('netstat_mode', description)
+    if mode == 'nstat':
+        return [ConfigTable('inputs.nstat', comment="Read the TCP/IP kernel "
+                            "counters, instead of netstat").update(
+                                inputs.get('nstat'))]
+    if mode == 'off':
+        return []
+    table = ConfigTable('inputs.netstat', comment="Read metrics about TCP "
+                        "status such as established, time wait etc and UDP "
+                        "sockets counts.")
+    if mode == 'slow':
+        table.options['interval'] = config['netstat_slow_interval']
+    return [table.update(inputs.get('netstat'))]
+
+
+def count_sockets():
+    """Count the TCP and UDP sockets netstat would go through, from the
+    kernel's socket stats"""
+    sockets = 0
+    for path in PROC_SOCKSTAT:
+        try:
+            with open(path, 'r') as fd:
+                lines = fd.readlines()
+        except IOError as e:
+            hookenv.log("Can't read {}: {}".format(path, e),
+                        level=hookenv.WARNING)
+            return None
+        for line in lines:
+            proto, _, stats = line.partition(':')
+            if proto not in ('TCP', 'UDP', 'TCP6', 'UDP6'):
+                continue
+            stats = stats.split()
+            values = dict(zip(stats[::2], stats[1::2]))
+            sockets += int(values.get('inuse', 0)) + int(values.get('tw', 0))
+    return sockets
+
+
+def get_config_error():
+    """Return why the charm config can't be applied as set, or None"""
+    memory_max = hookenv.config().get('memory_max')
+    if memory_max:
+        try:
+            parse_size(memory_max)
+        except (IOError, ValueError):
+            return 'Invalid memory_max: {}'.format(memory_max)
+    debug_duration = hookenv.config().get('debug_duration')
+    if debug_duration:
+        try:
+            parse_duration(debug_duration)
+        except ValueError:
+            return 'Invalid debug_duration: {}'.format(debug_duration)
+    statsd_percentiles = hookenv.config().get('statsd_percentiles')
+    if statsd_percentiles and hookenv.config().get('statsd_port'):
+        for percentile in statsd_percentiles.split(','):
+            try:
+                if percentile.strip():
+                    parse_percentile(percentile)
+            except ValueError:
+                return 'Invalid statsd_percentiles: {}'.format(statsd_percentiles)
+    return None
+
+
+def get_status_message(message=''):
+    """Add the policies the unit is running with to a status message"""
+    notes = [message] if message else []
+    netstat_mode = unitdata.kv().get('netstat_mode')
+    if netstat_mode and not netstat_mode.startswith('netstat'):
+        notes.append('netstat: {}'.format(netstat_mode))
+    config = hookenv.config()
+    if config.get('debug') or config.get('debug_plugins'):
+        if not is_debug_active():
+            notes.append('debug: expired')
+        elif config.get('debug'):
+            notes.append('debug: on')
+        else:
+            notes.append('debug: {}'.format(config['debug_plugins']))
+    return '; '.join(notes)
+
+
+def start_debug_window():
+    """Record when debug logging was turned on, for debug_duration"""
+    kv = unitdata.kv()
+    kv.unset('debug.expired')
+    config = hookenv.config()
+    if config.get('debug') or config.get('debug_plugins'):
+        kv.set('debug.since', time.time())
+    else:
+        kv.unset('debug.since')
+
+
+def get_debug_duration():
+    """Return debug_duration in seconds, or None if debug logging isn't
+    limited in time"""
+    duration = hookenv.config().get('debug_duration')
+    if not duration:
+        return None
+    try:
+        return parse_duration(duration)
+    except ValueError:
+        hookenv.log("Invalid debug_duration {}, not limiting debug "
+                    "logging".format(duration), level=hookenv.WARNING)
+        return None
+
+
+def is_debug_active():
+    """Whether debug logging is on and debug_duration hasn't expired yet"""
+    config = hookenv.config()
+    kv = unitdata.kv()
+    if not (config.get('debug') or config.get('debug_plugins')) or \
+            kv.get('debug.expired'):
+        return False
+    if kv.get('debug.since') is None:
+        # turned on before the charm tracked it, e.g: on upgrade
+        start_debug_window()
+    duration = get_debug_duration()
+    return duration is None or time.time() < kv.get('debug.since') + duration
+
+
+def log_level_supported():
+    """The per plugin log_level option was added in telegraf 1.32, older
+    versions fail to load configs using it"""
+    version = get_installed_version('telegraf')
+    return version is not None and version_compare(version, '1.32') >= 0
+
+
+def get_debug_plugins():
+    """Return the plugins in debug_plugins to log at debug level, as
+    [(kind, name)], while debug logging is active"""
+    if not hookenv.config().get('debug_plugins') or not is_debug_active():
+        return []
+    if not log_level_supported():
+        hookenv.log("debug_plugins requires telegraf >= 1.32, ignoring it",
+                    level=hookenv.WARNING)
+        return []
+    plugins = []
+    for plugin in hookenv.config().get('debug_plugins', '').split(','):
+        kind, _, name = plugin.strip().partition('.')
+        if kind not in ('inputs', 'outputs') or not name:
+            if plugin.strip():
+                hookenv.log("Invalid debug_plugins entry {}, expected "
+                            "inputs.<name> or outputs.<name>".format(plugin),
+                            level=hookenv.WARNING)
+            continue
+        plugins.append((kind, name))
+    return plugins
+
+
+def get_cpu_options():
+    """Return the cpu input policy for the number of cores of this machine.
+
+    Per-cpu stats are gathered up to percpu_max_cores, above it only the
+    totals, plus their spread across cores if cpu_basicstats is set.
+    """
+    config = hookenv.config()
+    max_cores = config.get('percpu_max_cores')
+    cores = os.cpu_count()
+    percpu = not max_cores or cores is None or cores <= max_cores
+    if not percpu:
+        hookenv.log("{} cores, over percpu_max_cores ({}), gathering only "
+                    "total cpu stats".format(cores, max_cores))
+    return {'percpu': percpu,
+            'cpu_basicstats': not percpu and bool(config.get('cpu_basicstats'))}
+
+
+def get_disk_options():
+    """Return the default options of the disk and diskio inputs.
+
+    With disk_autodiscover, the mount points and block devices present when
+    the config is rendered are listed explicitly. So are the devices matching
+    diskio_devices on telegraf versions that don't support glob patterns.
+    """
+    config = hookenv.config()
+    ignore_fs = [fs.strip() for fs in config.get('disk_ignore_fs', '').split(',')
+                 if fs.strip()]
+    devices = [dev.strip() for dev in config.get('diskio_devices', '').split(',')
+               if dev.strip()]
+    disk_options = {}
+    diskio_options = {}
+    if config.get('disk_autodiscover'):
+        mount_points = list_mount_points(ignore_fs)
+        if mount_points:
+            disk_options['mount_points'] = mount_points
+        devices = list_block_devices(devices) or devices
+    if any(c in dev for dev in devices for c in '*?[') and \
+            not diskio_globs_supported():
+        devices = list_block_devices(devices)
+        if not devices:
+            hookenv.log("No block devices matching diskio_devices, gathering "
+                        "diskio stats for all devices", level=hookenv.WARNING)
+    if ignore_fs:
+        disk_options['ignore_fs'] = ignore_fs
+    if devices:
+        diskio_options['devices'] = devices
+    if config.get('diskio_skip_serial_number'):
+        diskio_options['skip_serial_number'] = True
+    return disk_options, diskio_options
+
+
+def list_mount_points(ignore_fs=()):
+    """List the mount points of block devices, skipping ignore_fs"""
+    mount_points = []
+    try:
+        with open(PROC_MOUNTS, 'r') as fd:
+            mounts = [line.split() for line in fd]
+    except IOError as e:
+        hookenv.log("Can't read {}: {}".format(PROC_MOUNTS, e),
+                    level=hookenv.WARNING)
+        return mount_points
+    for mount in mounts:
+        if len(mount) < 3 or not mount[0].startswith('/dev/') or \
+                mount[2] in ignore_fs:
+            continue
+        # spaces and such are escaped as octal, e.g: \040
+        path = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)),
+                      mount[1])
+        if path not in mount_points:
+            mount_points.append(path)
+    return sorted(mount_points)
+
+
+def list_block_devices(patterns=()):
+    """List the block devices matching any of the glob patterns"""
+    if not os.path.isdir(SYS_BLOCK):
+        return []
+    devices = sorted(os.listdir(SYS_BLOCK))
+    if patterns:
+        devices = [dev for dev in devices
+                   if any(fnmatch.fnmatch(dev, pattern) for pattern in patterns)]
+    return devices
 
 
 def get_extra_options():
+    """Return the extra_options config, plus the routing options of the
+    outputs, as {kind: {plugin: {option: value}}}"""
     extra_options = {'inputs': {}, 'outputs': {}}
     extra_options_raw = hookenv.config()['extra_options']
     extra_opts = yaml.load(extra_options_raw) or {}
     extra_options.update(extra_opts)
-    # jsonify value, required as the telegraf config values format is similar
-    # to raw json
-    json_vals = {}
-    # kind level
-    for k, v in extra_options.items():
-        json_vals[k] = {}
-        # plugins level
-        for plugin, values in v.items():
-            json_vals[k][plugin] = {}
-            # inner plugin (aka key:value)
-            for key, val in values.items():
-                if key in ('tagpass', 'tagdrop'):
-                    # this is a tagpass/drop, we need to go deeper
-                    json_vals[k][plugin][key] = {}
-                    for tag, tagvalue in val.items():
-                        json_vals[k][plugin][key][tag] = json.dumps(tagvalue)
-                else:
-                    json_vals[k][plugin][key] = json.dumps(val)
-    return json_vals
-
-
-def render_extra_options(kind, name, extra_options=None):
-    template = """
-  {% if extra_options %}
-  {% for key, value in extra_options.items() %}
-  {% if key != 'tagpass' and key != 'tagdrop' %}
-  {{ key }} = {{ value }}
-  {% endif %}
-  {% endfor %}
-  {% for key, value in extra_options.items() %}
-  {% if key == 'tagpass' or key == 'tagdrop' %}
-  [{{ kind }}.{{ name }}.{{ key }}]
-    {% for tag, tagvalue in value.items() %}
-    {{ tag }} = {{ tagvalue }}
-    {% endfor %}
-  {% endif %}
-  {% endfor %}
-  {% endif %}
-  """
+    # extra_options can still set a different log_level
+    for kind, name in get_debug_plugins():
+        options = {'log_level': 'debug'}
+        options.update(extra_options[kind].get(name) or {})
+        extra_options[kind][name] = options
+    # outputs options in extra_options take precedence over the routing
+    for output, options in get_routing().items():
+        options.update(extra_options['outputs'].get(output) or {})
+        extra_options['outputs'][output] = options
+    return extra_options
+
+
+def get_routing():
+    """Return the namepass/namedrop options of each output from the routing
+    config, e.g: {'influxdb': {'namepass': ['postgresql*']}}
+    """
+    try:
+        routing = yaml.safe_load(hookenv.config().get('routing') or '') or {}
+    except yaml.YAMLError as e:
+        routing = e
+    if not isinstance(routing, dict):
+        hookenv.log("Invalid routing config, ignoring it: {}".format(routing),
+                    level=hookenv.ERROR)
+        return {}
+    outputs = {}
+    for output, rules in routing.items():
+        # a plain list of globs is a namepass
+        if not isinstance(rules, dict):
+            rules = {'namepass': rules}
+        options = {}
+        for key in ('namepass', 'namedrop'):
+            globs = rules.get(key)
+            if isinstance(globs, str):
+                globs = [globs]
+            if globs:
+                options[key] = [str(g) for g in globs]
+        if options:
+            outputs[output] = options
+    return outputs
+
+
+def route_outputs(content):
+    """Add the routing options to the outputs of a raw config, like
+    outputs_config. The namepass/namedrop an output already sets take
+    precedence over the routing ones."""
+    routing = get_routing()
+
+    def add_options(match):
+        # the output's own options, up to the next table
+        body = re.split(r'^[ \t]*\[\[?[\w.-]+\]\]?[ \t]*(?:#.*)?$',
+                        content[match.end():], maxsplit=1, flags=re.MULTILINE)[0]
+        keys = set(re.findall(r'^[ \t]*"?([\w-]+)"?[ \t]*=', body,
+                              flags=re.MULTILINE))
+        options = routing.get(match.group(2), {})
+        return match.group(0) + ''.join(
+            '\n{}  {} = {}'.format(match.group(1), key, toml_value(value))
+            for key, value in sorted(options.items()) if key not in keys)
+    return re.sub(r'^([ \t]*)\[\[outputs\.([\w-]+)\]\][^\n]*$', add_options,
+                  content, flags=re.MULTILINE)
+
+
+def get_extra_plugins():
+    """Return a dict of config file path -> content for extra_plugins.
+
+    extra_plugins can be a raw string, saved "as is" in extra_plugins.conf, or
+    a YAML mapping keyed by plugin instance name, each instance rendered to its
+    own extra_plugins-<name>.conf file.
+    """
+    configs_dir = get_configs_dir()
+    prefix = get_config_prefix()
+    plugins_raw = hookenv.config()['extra_plugins']
+    if not plugins_raw:
+        return {}
+    try:
+        plugins = yaml.safe_load(plugins_raw)
+    except yaml.YAMLError:
+        plugins = None
+    if not isinstance(plugins, dict):
+        # not structured, probably a plain telegraf config string
+        return {os.path.join(configs_dir, prefix + EXTRA_PLUGINS_FILE): plugins_raw}
+    extra_plugins = {}
+    for name, plugin in plugins.items():
+        name = re.sub(r'[^\w-]', '_', str(name))
+        config_path = os.path.join(configs_dir, '{}extra_plugins-{}.conf'.format(
+            prefix, name))
+        if isinstance(plugin, str):
+            extra_plugins[config_path] = plugin
+            continue
+        options = dict(plugin) if isinstance(plugin, dict) else {}
+        kind, _, plugin_name = str(options.pop('plugin', '')).partition('.')
+        if kind not in EXTRA_PLUGINS_KINDS or not plugin_name:
+            hookenv.log("Invalid plugin for extra plugin {}, expected one of: "
+                        "{}".format(name, ', '.join(
+                            '{}.<name>'.format(k) for k in EXTRA_PLUGINS_KINDS)),
+                        level=hookenv.WARNING)
+            continue
+        table = ConfigTable('{}.{}'.format(kind, plugin_name)).update(options)
+        extra_plugins[config_path] = render_tables([table])
+    return extra_plugins
+
+
+def set_plugin_configured(plugin, config_written=True):
+    """Set the plugin as configured, config_written=False for relations
+    that don't need a config file (e.g: nothing to gather in this unit)"""
+    unitdata.kv().set('plugins.{}.no_config'.format(plugin), not config_written)
+    set_state('plugins.{}.configured'.format(plugin))
+
+
+def is_plugin_configured(plugin):
+    """Check if the plugin is configured, and its config file (if it
+    needs one) is in place"""
+    if 'plugins.{}.configured'.format(plugin) not in get_states():
+        return False
+    return os.path.exists(get_plugin_config_path(plugin)) or \
+        bool(unitdata.kv().get('plugins.{}.no_config'.format(plugin)))
+
+
+def relation_hook_pending(plugin, relation_name=None, peers=False):
+    """Check if the plugin config could be out of date with its relation.
+
+    Relation data only changes in the relation's own hooks, so unless the
+    plugin config needs to be rendered again, the relation data doesn't need
+    to be read in any other hook. With peers, the peer relation hooks count
+    too, for plugins electing a unit among the peers.
+    """
+    relation_name = relation_name or plugin
+    if not is_plugin_configured(plugin):
+        return True
+    hook_name = hookenv.hook_name()
+    if peers and hook_name.startswith('{}-relation-'.format(PEER_RELATION)):
+        return True
+    return hook_name.startswith('{}-relation-'.format(relation_name)) or \
+        hook_name == 'upgrade-charm'
+
+
+def relation_data_changed(plugin, data):
+    """Check if the relation fields the plugin is configured from changed
+    since it was last configured, so relation hooks that don't change them
+    don't render the config or send settings to the related units again"""
+    changed = helpers.data_changed('plugins.{}.relation'.format(plugin), data)
+    return changed or not is_plugin_configured(plugin)
+
+
+def set_peer_cluster(plugin, cluster):
+    """Tell the peers which cluster is monitored by the plugin in this unit"""
+    for relation_id in hookenv.relation_ids(PEER_RELATION):
+        hookenv.relation_set(relation_id, relation_settings={
+            '{}-cluster'.format(plugin): cluster or ''})
+
+
+def is_cluster_collector(plugin, cluster):
+    """Check if this unit is the one collecting the cluster level stats.
+
+    One unit is elected among the peers monitoring the same cluster, by
+    rendezvous hashing of their names: the elected unit only changes when it
+    departs, or when a unit with a higher score joins.
+    """
+    units = [hookenv.local_unit()]
+    for relation_id in hookenv.relation_ids(PEER_RELATION):
+        for unit in hookenv.related_units(relation_id):
+            if hookenv.relation_get('{}-cluster'.format(plugin), unit,
+                                    relation_id) == cluster:
+                units.append(unit)
+
+    def score(unit):
+        return hashlib.md5('{}:{}'.format(cluster, unit).encode('utf-8')).hexdigest()
+    return max(units, key=score) == hookenv.local_unit()
+
+
+def get_cluster_options(plugin, cluster, options, cluster_keys):
+    """Return the plugin options without the cluster level ones, unless this
+    unit is the one elected to collect them"""
+    cluster_keys = [k for k in cluster_keys if k in options]
+    if cluster_keys and not is_cluster_collector(plugin, cluster):
+        hookenv.log("{} stats of {} collected by another unit: {}".format(
+            plugin, cluster, ', '.join(cluster_keys)))
+        options = dict((k, v) for k, v in options.items()
+                       if k not in cluster_keys)
+    return options
+
+
+def plugin_data_changed(plugin, tables):
+    """Check if the plugin config tables changed since they were rendered.
+
+    The tables are compared as data, extra_options included, so reordering or
+    reformatting doesn't count as a change.
+    """
+    config_path = get_plugin_config_path(plugin)
+    changed = helpers.data_changed('plugins.{}.data'.format(plugin),
+                                   [table.to_dict() for table in tables])
+    return changed or not os.path.exists(config_path)
+
+
+def write_plugin_config(plugin, tables):
+    """Render the plugin config tables to its config file, if they changed"""
+    if plugin_data_changed(plugin, tables):
+        hookenv.log("Updating {} plugin config file".format(plugin))
+        host.write_file(get_plugin_config_path(plugin),
+                        render_tables(tables).encode('utf-8'))
+
+
+# Config model #
+class ConfigTable(object):
+    """A table of the telegraf config, e.g: [agent] or [[inputs.cpu]].
+
+    Options are plain python values, serialized by toml_value when rendered.
+    Dict options are rendered as sub-tables after the other options, e.g:
+    [inputs.cpu.tagpass], and None options are left out.
+    """
+
+    def __init__(self, name, options=(), array=True, comment=None,
+                 comments=None):
+        self.name = name
+        self.array = array
+        # rendered above the table and above each option
+        self.comment = comment
+        self.comments = comments or {}
+        self.options = OrderedDict(options)
+
+    def update(self, options):
+        """Set options, e.g: from extra_options, in key order"""
+        for key, value in sorted((options or {}).items()):
+            self.options[key] = value
+        return self
+
+    def to_dict(self):
+        return {'name': self.name, 'array': self.array,
+                'options': dict(self.options)}
+
+    def __eq__(self, other):
+        return isinstance(other, ConfigTable) and \
+            self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<ConfigTable {}>'.format(self.name)
+
+    def render(self):
+        header = '[[{}]]' if self.array else '[{}]'
+        return render_comment(self.comment) + header.format(self.name) + \
+            '\n' + self.render_options()
+
+    def render_options(self, indent='  '):
+        lines = []
+        tables = []
+        for key, value in self.options.items():
+            if isinstance(value, dict):
+                tables.append((key, value))
+            elif value is not None:
+                lines.append(render_comment(self.comments.get(key), indent))
+                lines.append('{}{} = {}\n'.format(indent, toml_key(key),
+                                                  toml_value(value)))
+        for key, options in tables:
+            lines.append('{}[{}.{}]\n'.format(indent, self.name, toml_key(key)))
+            lines.extend('{}  {} = {}\n'.format(indent, toml_key(k),
+                                                toml_value(v))
+                         for k, v in sorted(options.items()) if v is not None)
+        return ''.join(lines)
+
+
+def render_comment(comment, indent=''):
+    if not comment:
+        return ''
+    return ''.join('{}# {}'.format(indent, line).rstrip() + '\n'
+                   for line in comment.splitlines())
+
+
+def toml_key(key):
+    key = str(key)
+    if re.match(r'^[A-Za-z0-9_-]+$', key):
+        return key
+    return json.dumps(key)
+
+
+def toml_value(value):
+    """Serialize a python value (e.g: from extra_options) as a TOML value"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return '[{}]'.format(', '.join(toml_value(v) for v in value))
+    if isinstance(value, dict):
+        return '{{{}}}'.format(', '.join(
+            '{} = {}'.format(toml_key(k), toml_value(v))
+            for k, v in sorted(value.items()) if v is not None))
+    # TOML basic strings use the same escapes as JSON
+    return json.dumps(str(value))
+
+
+def render_tables(tables):
+    """Render the config tables, each one preceded by an empty line"""
+    return ''.join('\n' + table.render() for table in tables)
+
+
+def plugin_table(kind, name, options=(), extra_options=None, **kwargs):
+    """Return the [[kind.name]] table with the charm options, updated with
+    the plugin's extra_options"""
     if extra_options is None:
         extra_options = get_extra_options()
-    context = {"extra_options": extra_options[kind].get(name, {}),
-               "kind": kind,
-               "name": name}
-    return render_template(template, context)
+    table = ConfigTable('{}.{}'.format(kind, name), options, **kwargs)
+    return table.update(extra_options[kind].get(name))
+
+
+def get_memory_total():
+    """Return the MemTotal of /proc/meminfo in bytes"""
+    with open(PROC_MEMINFO, 'r') as fd:
+        for line in fd:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    raise ValueError("No MemTotal in {}".format(PROC_MEMINFO))
+
+
+def parse_size(size):
+    """Convert a systemd style size (e.g: 512M, 1G, 50%) to bytes, or None
+    for infinity. Percentages are of the memory of the machine"""
+    size = str(size).strip().upper()
+    if size == 'INFINITY':
+        return None
+    if size.endswith('%'):
+        return int(float(size[:-1]) / 100 * get_memory_total())
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def parse_duration(duration):
+    """Convert a telegraf duration (e.g: 10s, 1m30s, 500ms) to seconds"""
+    units = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', str(duration))
+    if not parts:
+        return float(duration)
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+def parse_percentile(percentile):
+    """Convert a statsd percentile (e.g: 90, 99.9) to a number"""
+    percentile = percentile.strip()
+    value = float(percentile) if '.' in percentile else int(percentile)
+    if not 0 <= value <= 100:
+        raise ValueError("percentile out of range: {}".format(percentile))
+    return value
+
+
+def get_agent_table(hostname):
+    """Return the [agent] table of the main config"""
+    config = hookenv.config()
+    logfile = config.get('logfile') or None
+    options = [
+        ('interval', config['interval']),
+        ('round_interval', config['round_interval']),
+        ('metric_buffer_limit', get_metric_buffer_limit()),
+        ('collection_jitter', config['collection_jitter']),
+        ('flush_interval', config['flush_interval']),
+        ('flush_jitter', config['flush_jitter']),
+        ('debug', bool(config['debug']) and is_debug_active()),
+        ('quiet', config['quiet']),
+        ('logfile', logfile),
+        ('logfile_rotation_max_size',
+         logfile and config['logfile_rotation_max_size']),
+        ('logfile_rotation_max_archives',
+         logfile and config['logfile_rotation_max_archives']),
+        ('hostname', hostname)]
+    comments = {
+        'interval': "Default data collection interval for all plugins",
+        'round_interval': "Rounds collection interval to 'interval'\nie, if "
+                          "interval=\"10s\" then always collect on :00, :10, "
+                          ":20, etc.",
+        'metric_buffer_limit': "Telegraf will cache metric_buffer_limit "
+                               "metrics for each output, and will\nflush this "
+                               "buffer on a successful write.",
+        'collection_jitter': "Collection jitter is used to jitter the "
+                             "collection by a random amount.\nEach plugin will "
+                             "sleep for a random time within jitter before "
+                             "collecting.\nThis can be used to avoid many "
+                             "plugins querying things like sysfs at the\nsame "
+                             "time, which can have a measurable effect on the "
+                             "system.",
+        'flush_interval': "Default data flushing interval for all outputs. "
+                          "You should not set this below\ninterval. Maximum "
+                          "flush_interval will be flush_interval + "
+                          "flush_jitter",
+        'flush_jitter': "Jitter the flush interval by a random amount. This "
+                        "is primarily to avoid\nlarge write spikes for users "
+                        "running a large number of telegraf instances.\nie, a "
+                        "jitter of 5s and interval 10s means flushes will "
+                        "happen every 10-15s",
+        'debug': "Run telegraf in debug mode",
+        'quiet': "Run telegraf in quiet mode",
+        'logfile': "Log to this file instead of stderr, rotated when it "
+                   "reaches\nlogfile_rotation_max_size, keeping "
+                   "logfile_rotation_max_archives files",
+        'hostname': "Override default hostname, if empty use os.Hostname()"}
+    return ConfigTable('agent', options, array=False,
+                       comment="Configuration for telegraf agent",
+                       comments=comments)
+
+
+def get_metric_buffer_limit():
+    """Return metric_buffer_limit, capped to fit half of memory_max"""
+    config = hookenv.config()
+    buffer_limit = config['metric_buffer_limit']
+    try:
+        memory_max = parse_size(config.get('memory_max') or 'infinity')
+    except (IOError, ValueError) as e:
+        hookenv.log("Invalid memory_max {}, not capping metric_buffer_limit: "
+                    "{}".format(config['memory_max'], e), level=hookenv.ERROR)
+        memory_max = None
+    if memory_max is not None:
+        max_buffered = memory_max // 2 // BUFFERED_METRIC_SIZE
+        if buffer_limit > max_buffered:
+            hookenv.log("Capping metric_buffer_limit to {} to fit memory_max "
+                        "{}".format(max_buffered, config['memory_max']))
+            buffer_limit = max_buffered
+    return buffer_limit
+
+
+def set_port(key, port, protocol='TCP'):
+    """Set the port exposed for key, a false port stops exposing it.
+
+    Ports are only recorded here, update_ports opens and closes them all at
+    once at the end of the hook.
+    """
+    kv = unitdata.kv()
+    ports = kv.get('ports', {})
+    if port:
+        port = '{}/{}'.format(port, protocol.lower())
+        if ports.get(key) == port:
+            return
+        ports[key] = port
+    elif key in ports:
+        del ports[key]
+    else:
+        return
+    kv.set('ports', ports)
 
 
-def render_template(template, context):
-    tmpl = Template(template, lstrip_blocks=True, trim_blocks=True)
-    return tmpl.render(**context)
+def update_ports():
+    """Open/close ports to match the ones set via set_port"""
+    ports = sorted(set(unitdata.kv().get('ports', {}).values()))
+    if not helpers.data_changed('ports', ports):
+        return
+    opened_ports = set(p.lower() for p in hookenv.opened_ports())
+    for port in sorted(opened_ports - set(ports)):
+        number, protocol = port.split('/')
+        hookenv.close_port(number, protocol.upper())
+    for port in sorted(set(ports) - opened_ports):
+        number, protocol = port.split('/')
+        hookenv.open_port(number, protocol.upper())
 
 
-def check_port(key, new_port):
-    unitdata_key = '{}.port'.format(key)
-    kv = unitdata.kv()
-    if kv.get(unitdata_key) != new_port:
-        hookenv.open_port(new_port)
-        if kv.get(unitdata_key):  # Dont try to close non existing ports
-            hookenv.close_port(kv.get(unitdata_key))
-        kv.set(unitdata_key, new_port)
+hookenv.atexit(update_ports)
+
+
+def get_statsd_port():
+    config = hookenv.config()
+    if not config.get('statsd_port', False):
+        return False
+    if config.get('statsd_port') == 'default':
+        return 8125
+    else:
+        return int(config.get('statsd_port'))
+
+
+def get_statsd_percentiles():
+    """Return the statsd_percentiles config as a list, without the invalid
+    ones"""
+    percentiles = []
+    for percentile in hookenv.config()['statsd_percentiles'].split(','):
+        if not percentile.strip():
+            continue
+        try:
+            percentiles.append(parse_percentile(percentile))
+        except ValueError:
+            hookenv.log("Invalid statsd percentile {}, skipping it".format(
+                percentile.strip()), level=hookenv.WARNING)
+    return percentiles
+
+
+def get_prometheus_client_options(extra_options):
+    """Merge the prometheus_client charm config into extra_options.
+
+    Options set for prometheus_client via extra_options take precedence.
+    """
+    config = hookenv.config()
+    options = {}
+    if config.get('prometheus_expiration_interval'):
+        options['expiration_interval'] = config['prometheus_expiration_interval']
+    collectors_exclude = [c.strip() for c in
+                          config.get('prometheus_collectors_exclude', '').split(',')
+                          if c.strip()]
+    if collectors_exclude:
+        options['collectors_exclude'] = collectors_exclude
+    # string_as_label is enabled by default in telegraf, only render it when
+    # disabled so older telegraf versions don't choke on it
+    if not config.get('prometheus_string_as_label', True):
+        options['string_as_label'] = False
+    if config.get('prometheus_path'):
+        options['path'] = config['prometheus_path']
+    options.update(extra_options['outputs'].get('prometheus_client') or {})
+    extra_options['outputs']['prometheus_client'] = options
+    return extra_options
 
 
 def get_prometheus_port():
@@ -167,6 +1249,225 @@ def get_prometheus_port():
         return int(config.get('prometheus_output_port'))
 
 
+def get_health_port():
+    """Return health_port, or 0 if it's not set or the installed telegraf
+    doesn't have the internal input"""
+    port = hookenv.config().get('health_port')
+    if port and not internal_input_supported():
+        hookenv.log("health_port requires telegraf >= 1.2, not gathering the "
+                    "internal metrics", level=hookenv.WARNING)
+        return 0
+    return port or 0
+
+
+def get_health_tables():
+    """Return the internal input and the local prometheus output the unit
+    health is read from, see check_health"""
+    port = get_health_port()
+    # the port in the rendered config, read by update-status
+    unitdata.kv().set('health.port', port)
+    if not port:
+        return []
+    return [ConfigTable('inputs.internal', [('collect_memstats', False)],
+                        comment="Telegraf's own metrics, used for the juju "
+                                "unit status"),
+            ConfigTable('outputs.prometheus_client', [
+                ('listen', '127.0.0.1:{}'.format(port)),
+                ('namepass', ['internal_*'])],
+                comment="Local endpoint of the internal metrics, only read by "
+                        "the charm")]
+
+
+def get_internal_metrics():
+    """Fetch the telegraf internal metrics from the health endpoint, as a
+    list of (name, labels, value)"""
+    url = 'http://127.0.0.1:{}/metrics'.format(unitdata.kv().get('health.port'))
+    with urllib.request.urlopen(url, timeout=HEALTH_TIMEOUT) as response:
+        content = response.read().decode('utf-8', 'replace')
+    metrics = []
+    for match in re.finditer(r'^(internal_\w+)(?:\{(.*)\})? (\S+)',
+                             content, flags=re.MULTILINE):
+        name, labels, value = match.groups()
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', labels or ''))
+        try:
+            metrics.append((name, labels, float(value)))
+        except ValueError:
+            continue
+    return metrics
+
+
+def check_health(metrics):
+    """Return the (status, message) of the unit from the internal metrics.
+
+    Inputs gathering slower than health_gather_threshold of the interval and
+    outputs with a buffer fuller than health_buffer_threshold are reported,
+    and the unit is blocked if write errors or dropped metrics went up since
+    the previous check.
+    """
+    config = hookenv.config()
+    kv = unitdata.kv()
+    max_gather_time = parse_duration(config['interval']) * \
+        config['health_gather_threshold']
+    slow = set()
+    buffers = {}
+    limits = {}
+    counters = {}
+    for name, labels, value in metrics:
+        if name == 'internal_gather_gather_time_ns':
+            if value / 1e9 > max_gather_time:
+                slow.add(labels.get('input', '?'))
+        elif name == 'internal_write_buffer_size':
+            buffers[labels.get('output', '?')] = value
+        elif name == 'internal_write_buffer_limit':
+            limits[labels.get('output', '?')] = value
+        elif name in ('internal_write_errors', 'internal_write_metrics_dropped'):
+            key = '{}:{}'.format(name, labels.get('output', '?'))
+            counters[key] = counters.get(key, 0) + value
+    full = set()
+    for output, size in buffers.items():
+        limit = limits.get(output) or get_metric_buffer_limit()
+        if size > limit * config['health_buffer_threshold']:
+            full.add(output)
+    # errors and dropped metrics are counted since telegraf started
+    previous = kv.get('health.counters') or {}
+    kv.set('health.counters', counters)
+    errors = set()
+    dropped = set()
+    for key, value in counters.items():
+        name, output = key.split(':', 1)
+        if value > previous.get(key, value):
+            (dropped if name.endswith('dropped') else errors).add(output)
+    issues = []
+    for label, names in (('dropping metrics', dropped),
+                         ('write errors', errors),
+                         ('buffer full', full),
+                         ('slow inputs', slow)):
+        if names:
+            issues.append('{}: {}'.format(label, ', '.join(sorted(names))))
+    status = 'blocked' if dropped or errors else 'active'
+    return status, '; '.join(issues)
+
+
+def validate_config():
+    """Check the config files with a telegraf --test run.
+
+    Returns None if the config is valid, or can't be checked because telegraf
+    isn't installed or the check is disabled, otherwise the telegraf output.
+    """
+    timeout = hookenv.config().get('config_check_timeout')
+    telegraf_bin = shutil.which('telegraf')
+    if not timeout or telegraf_bin is None:
+        return None
+    cmd = [telegraf_bin, '--config', get_main_config_path(),
+           '--config-directory', get_configs_dir(), '--test']
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # the config was loaded, but some inputs are slow to gather
+        hookenv.log("telegraf config check timed out after {}s, assuming the "
+                    "config is valid".format(timeout), level=hookenv.WARNING)
+    except subprocess.CalledProcessError as e:
+        return e.output.decode('utf-8', 'replace')
+    return None
+
+
+def save_last_good_config():
+    last_good_dir = get_last_good_dir()
+    if os.path.exists(last_good_dir):
+        shutil.rmtree(last_good_dir)
+    os.makedirs(os.path.join(last_good_dir, CONFIG_DIR))
+    for config_path in list_active_config_files():
+        shutil.copy2(config_path, os.path.join(
+            last_good_dir, os.path.relpath(config_path, BASE_DIR)))
+
+
+def get_config_file_states():
+    """Return the config files this unit renders, with the state of the
+    handler rendering each one"""
+    configs_dir = get_configs_dir()
+    config_states = {}
+    if is_machine_owner():
+        config_states[get_main_config_path()] = 'telegraf.configured'
+        config_states[os.path.join(configs_dir, 'statsd.conf')] = \
+            'plugins.statsd.configured'
+    for plugin in list_supported_plugins() + ['procstat']:
+        config_states[get_plugin_config_path(plugin)] = \
+            'plugins.{}.configured'.format(plugin)
+    last_good_files = list_extra_plugins_files(
+        os.path.join(get_last_good_dir(), CONFIG_DIR))
+    for config_path in list_extra_plugins_files() + [
+            os.path.join(configs_dir, os.path.basename(path))
+            for path in last_good_files]:
+        config_states[config_path] = 'extra_plugins.configured'
+    return config_states
+
+
+def read_config_file(config_path):
+    """Return the content of a config file, or None if it doesn't exist"""
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path, 'rb') as fd:
+        return fd.read()
+
+
+def restore_last_good_config():
+    """Replace the config files of this unit with the last ones telegraf
+    started with.
+
+    Files of other units in the machine are left alone, they aren't this
+    unit's to revert. Returns the files rolled back, with the state of the
+    handler rendering each one, or None if there's no config to restore.
+    """
+    last_good_dir = get_last_good_dir()
+    if not os.path.exists(last_good_dir):
+        hookenv.log("No previous telegraf config to restore")
+        return None
+    restored = {}
+    for config_path, state in sorted(get_config_file_states().items()):
+        last_good_path = os.path.join(
+            last_good_dir, os.path.relpath(config_path, BASE_DIR))
+        if read_config_file(config_path) == read_config_file(last_good_path):
+            continue
+        hookenv.log("Restoring {} from the last good config".format(config_path))
+        if os.path.exists(config_path):
+            os.unlink(config_path)
+        if os.path.exists(last_good_path):
+            shutil.copy2(last_good_path, config_path)
+        restored[config_path] = state
+    return restored
+
+
+def reset_restored_config(restored):
+    """Forget what was rendered to the restored config files, so their
+    handlers render them again in the next hook.
+
+    The states are only removed at the end of the hook: removing them now
+    would render the rejected config again in this one.
+    """
+    kv = unitdata.kv()
+    for config_path, state in restored.items():
+        if state == 'extra_plugins.configured':
+            digests = ['extra_plugins.{}'.format(os.path.basename(config_path))]
+        elif state.startswith('plugins.'):
+            plugin = state.split('.')[1]
+            digests = ['plugins.{}.data'.format(plugin),
+                       'plugins.{}.relation'.format(plugin)]
+        else:
+            digests = []
+        for digest in digests:
+            kv.unset('reactive.data_changed.{}'.format(digest))
+    states = sorted(set(restored.values()))
+
+    def remove_restored_states():
+        hookenv.log("Rendering the restored config files again in the next "
+                    "hook: {}".format(', '.join(states)))
+        for state in states:
+            remove_state(state)
+        # check the config again once rendered
+        remove_state('telegraf.configured')
+    hookenv.atexit(remove_restored_states)
+
+
 # States
 
 
@@ -184,17 +1485,65 @@ def install_telegraf():
     #  * https://github.com/juju-solutions/layer-basic#overview
     #
     config = hookenv.config()
-    if config['apt_repository'] and config['apt_repository_key']:
-        add_source(config['apt_repository'],
-                   config['apt_repository_key'])
-        apt_update()
-    apt_install(config['package_name'], fatal=True)
+    start = time.time()
+    installed_version = get_installed_version('telegraf')
+    package_file = get_package_file()
+    if installed_version is not None and not is_machine_owner():
+        hookenv.log("telegraf is managed by {} in this machine, skipping "
+                    "install".format(list_machine_units()[0]))
+        source = 'installed'
+    elif package_file is not None:
+        if installed_version != get_deb_version(package_file):
+            hookenv.log("Installing telegraf from {}".format(package_file))
+            subprocess.check_call(['dpkg', '-i', package_file])
+            source = 'file'
+        else:
+            source = 'installed'
+    else:
+        # package_name can pin a version, e.g: telegraf=1.4.0-1
+        package, _, version = config['package_name'].partition('=')
+        # a new repository may have a newer telegraf, unless pinned
+        if installed_version is not None and \
+                (version == installed_version or
+                 (not version and not config.changed('apt_repository'))):
+            hookenv.log("{} already installed, skipping apt".format(
+                config['package_name']))
+            source = 'installed'
+        else:
+            if config['apt_repository'] and config['apt_repository_key']:
+                add_source(config['apt_repository'],
+                           config['apt_repository_key'])
+                apt_update()
+            apt_install(config['package_name'], fatal=True)
+            source = 'apt'
+    unitdata.kv().set('install', {'source': source,
+                                  'seconds': round(time.time() - start, 2)})
     set_state('telegraf.installed')
 
 
+@when('telegraf.installed')
+def check_machine_owner():
+    """Take over the main config when the unit managing it is removed"""
+    kv = unitdata.kv()
+    owner = is_machine_owner()
+    previous = kv.get('machine_owner')
+    kv.set('machine_owner', owner)
+    if previous is not None and owner != previous:
+        hookenv.log("Machine owner changed, this unit {} the main "
+                    "config".format('manages' if owner else 'no longer manages'))
+        remove_state('telegraf.configured')
+        remove_state('telegraf.systemd.configured')
+        remove_state('plugins.statsd.configured')
+
+
 @when('telegraf.installed')
 @when_not('telegraf.configured')
 def configure_telegraf():
+    if not is_machine_owner():
+        hookenv.log("Main config managed by {}".format(list_machine_units()[0]))
+        set_state('telegraf.hostname.resolved')
+        set_state('telegraf.configured')
+        return
     config = hookenv.config()
     context = config.copy()
     inputs = config.get('inputs_config', '')
@@ -216,73 +1565,276 @@ def configure_telegraf():
     if config['tags']:
         for tag in config['tags'].split(','):
             key, value = tag.split("=")
-            tags.append('{} = "{}"'.format(key, value))
-    context["tags"] = tags
+            tags.append((key, value))
+    context["tags"] = ConfigTable('tags', tags, array=False).render_options()
+    if config.get('logfile'):
+        log_dir = os.path.dirname(config['logfile'])
+        if not os.path.exists(log_dir):
+            host.mkdir(log_dir, owner='telegraf', group='telegraf', perms=0o755)
     if inputs:
         context["inputs"] = inputs
+        unitdata.kv().unset('netstat_mode')
     else:
         # use base inputs from charm templates
         context["inputs"] = render_base_inputs()
     if outputs:
-        context["outputs"] = outputs
+        context["outputs"] = route_outputs(outputs)
     else:
         context["outputs"] = ""
         hookenv.log("No output plugins in main config.")
     config_path = get_main_config_path()
-    if config["hostname"] == "UNIT_NAME":
+    hostname = config["hostname"]
+    if hostname == "UNIT_NAME":
         remote_unit_name = get_remote_unit_name()
         if remote_unit_name is not None:
-            context["hostname"] = remote_unit_name.replace('/', '-')
+            hostname = remote_unit_name.replace('/', '-')
+            set_state('telegraf.hostname.resolved')
         else:
-            hookenv.log("Waiting for relation to render config file.")
-            # if UNIT_NAME in hostname config and relation not yet available,
-            # make telegraf unable to start to not get weird metrics names
-            if os.path.exists(config_path):
-                os.unlink(config_path)
-            return
+            hookenv.log("Principal unit not known yet, using the machine "
+                        "hostname until it is.")
+            # telegraf uses os.Hostname() if hostname is empty
+            hostname = ""
+            remove_state('telegraf.hostname.resolved')
+    else:
+        set_state('telegraf.hostname.resolved')
+    context["agent"] = get_agent_table(hostname).render()
     if get_prometheus_port():
-        context["prometheus_output_port"] = get_prometheus_port()
-        check_port("prometheus_output", get_prometheus_port())
-    context['extra_options'] = get_extra_options()
+        extra_options = get_prometheus_client_options(get_extra_options())
+        context["prometheus_output"] = render_tables([plugin_table(
+            'outputs', 'prometheus_client',
+            [('listen', ':{}'.format(get_prometheus_port()))],
+            extra_options=extra_options)])
+    set_port('prometheus_output', get_prometheus_port())
+    health_input, health_output = get_health_tables() or ('', '')
+    context['health_input'] = health_input and render_tables([health_input])
+    context['health_output'] = health_output and render_tables([health_output])
 
     hookenv.log("Updating main config file")
-    render(source='telegraf.conf.tmpl', templates_dir=get_templates_dir(),
-           target=config_path, context=context)
+    with machine_lock():
+        render(source='telegraf.conf.tmpl', templates_dir=get_templates_dir(),
+               target=config_path, context=context)
     set_state('telegraf.configured')
 
 
+@when('telegraf.configured')
+@when_not('telegraf.hostname.resolved')
+def update_hostname():
+    if get_remote_unit_name() is not None:
+        hookenv.log("Principal unit found, updating hostname in main config")
+        remove_state('telegraf.configured')
+
+
+@when('telegraf.installed')
+@when_not('telegraf.systemd.configured')
+def configure_systemd():
+    config = hookenv.config()
+    if not is_machine_owner():
+        set_state('telegraf.systemd.configured')
+        return
+    if not host.init_is_systemd():
+        hookenv.log("Not running under systemd, ignoring resource controls")
+        set_state('telegraf.systemd.configured')
+        return
+    dropin_path = get_systemd_dropin_path()
+    context = dict((k, config.get(k)) for k in SYSTEMD_OPTIONS)
+    if get_config_error():
+        # systemd would ignore it too
+        context['memory_max'] = None
+    changed = False
+    if any(context.values()):
+        content = render(source='telegraf-systemd.conf.tmpl', target=None,
+                         templates_dir=get_templates_dir(), context=context)
+        if not os.path.exists(dropin_path) or \
+                open(dropin_path).read() != content:
+            hookenv.log("Updating telegraf systemd drop-in")
+            host.mkdir(SYSTEMD_DROPIN_DIR)
+            host.write_file(dropin_path, content.encode('utf-8'))
+            changed = True
+    elif os.path.exists(dropin_path):
+        hookenv.log("Deleting telegraf systemd drop-in")
+        os.unlink(dropin_path)
+        changed = True
+    if changed:
+        # start_or_restart takes care of the restart, as the drop-in is
+        # tracked with the config files
+        subprocess.check_call(['systemctl', 'daemon-reload'])
+    set_state('telegraf.systemd.configured')
+
+
 @when('config.changed')
 def handle_config_changes():
     config = hookenv.config()
-    if config.changed('extra_options'):
+    debug_changed = any(config.changed(k) for k in DEBUG_OPTIONS)
+    if debug_changed:
+        start_debug_window()
+    # debug_plugins are rendered as extra_options
+    options_changed = config.changed('extra_options') or debug_changed
+    if options_changed or config.changed('routing'):
         for plugin in list_supported_plugins():
             remove_state('plugins.{}.configured'.format(plugin))
-    if config.changed('apt_repository') or config.changed('package_name'):
+    # everything changed in the install hook, which already installed it
+    if hookenv.hook_name() != 'install' and \
+            (config.changed('apt_repository') or config.changed('package_name')):
         remove_state('telegraf.installed')
     # if something else changed, let's reconfigure telegraf itself just in case
     if config.changed('extra_plugins'):
         remove_state('extra_plugins.configured')
+    if options_changed or \
+            any(config.changed(k) for k in config.keys() if k.startswith('statsd_')):
+        remove_state('plugins.statsd.configured')
+    if options_changed or config.changed('procstat_targets'):
+        remove_state('plugins.procstat.configured')
+    # relation plugins rendered from charm configs too
+    if config.changed('interval') or \
+            any(config.changed(k) for k in config.keys() if k.startswith('exec_')):
+        remove_state('plugins.exec.configured')
+    if config.changed('listener_port') or config.changed('statsd_port'):
+        remove_state('plugins.listener.configured')
+    if any(config.changed(k) for k in config.keys() if k.startswith('prometheus_')):
+        remove_state('plugins.prometheus-client.configured')
+    if config.changed('elasticsearch_cluster_stats'):
+        remove_state('plugins.elasticsearch.configured')
+    if config.changed('mongodb_perdb_stats') or config.changed('mongodb_col_stats'):
+        remove_state('plugins.mongodb.configured')
+    if any(config.changed(k) for k in config.keys() if k.startswith('influxdb_')):
+        remove_state('plugins.influxdb-api.configured')
+    if any(config.changed(k) for k in SYSTEMD_OPTIONS):
+        remove_state('telegraf.systemd.configured')
+    nrpe_keys = [k for k in config.keys()
+                 if k.startswith(('nagios_', 'nrpe_', 'health_'))]
+    if any(config.changed(k) for k in
+           ['interval', 'metric_buffer_limit', 'memory_max'] + nrpe_keys):
+        remove_state('telegraf.nrpe.configured')
     remove_state('telegraf.configured')
 
 
 @when('telegraf.configured')
 @when_not('extra_plugins.configured')
 def configure_extra_plugins():
+    plugins = get_extra_plugins()
+    stale_files = set(list_extra_plugins_files())
+    for config_path, content in sorted(plugins.items()):
+        stale_files.discard(config_path)
+        digest_key = 'extra_plugins.{}'.format(os.path.basename(config_path))
+        # only rewrite the fragments that actually changed
+        if helpers.data_changed(digest_key, content) or \
+                not os.path.exists(config_path):
+            hookenv.log("Updating {} config file".format(config_path))
+            host.write_file(config_path, content.encode('utf-8'))
+    for config_path in sorted(stale_files):
+        hookenv.log("Deleting {} config file".format(config_path))
+        os.unlink(config_path)
+    set_state('extra_plugins.configured')
+
+
+@when('telegraf.installed')
+@when_not('plugins.statsd.configured')
+def configure_statsd():
+    if not is_machine_owner():
+        # a host level input, one per machine
+        return
     config = hookenv.config()
-    plugins = config['extra_plugins']
-    if plugins:
-        config_path = '{}/extra_plugins.conf'.format(get_configs_dir())
-        host.write_file(config_path, plugins.encode('utf-8'))
-        set_state('extra_plugins.configured')
+    config_path = os.path.join(get_configs_dir(), 'statsd.conf')
+    port = get_statsd_port()
+    set_port('statsd', port, protocol='UDP')
+    if not port:
+        if os.path.exists(config_path):
+            hookenv.log("Deleting {} plugin config file".format('statsd'))
+            os.unlink(config_path)
+        return
+    percentiles = get_statsd_percentiles()
+    options = [('protocol', 'udp' if statsd_protocol_supported() else None),
+               ('service_address', ':{}'.format(port))]
+    for kind in ('gauges', 'counters', 'sets', 'timings'):
+        key = 'delete_{}'.format(kind)
+        options.append((key, config['statsd_{}'.format(key)]))
+    options += [
+        ('percentiles', percentiles),
+        ('allowed_pending_messages', config['statsd_allowed_pending_messages']),
+        ('percentile_limit', config['statsd_percentile_limit']),
+        ('metric_separator', config['statsd_metric_separator'])]
+    comments = {
+        'protocol': "Protocol, the listener relation only hands out UDP",
+        'service_address': "Address and port to host UDP listener on",
+        'delete_gauges': "Delete gauges, counters, sets and timings every "
+                         "interval, instead of\nreporting their last value "
+                         "forever",
+        'percentiles': "Percentiles to calculate for timing & histogram stats",
+        'allowed_pending_messages': "Number of UDP messages allowed to queue "
+                                    "up, once filled the statsd server\nwill "
+                                    "start dropping packets",
+        'percentile_limit': "Number of timing/histogram values to track "
+                            "per-measurement in the\ncalculation of "
+                            "percentiles. Raising this limit increases the "
+                            "accuracy\nof percentiles but also increases "
+                            "the memory usage and cpu time.",
+        'metric_separator': "Separator used for the measurement name"}
+    table = plugin_table('inputs', 'statsd', options, comment="Statsd server",
+                         comments=comments)
+    hookenv.log("Updating {} plugin config file".format('statsd'))
+    host.write_file(config_path, render_tables([table]).encode('utf-8'))
+    set_state('plugins.statsd.configured')
+
+
+def get_principal_systemd_unit():
+    """Return the systemd unit named after the principal application, or
+    None if there isn't one"""
+    principal = get_remote_unit_name()
+    if principal is None:
+        return None
+    unit = '{}.service'.format(principal.split('/')[0])
+    for units_dir in SYSTEMD_UNIT_DIRS:
+        if os.path.exists(os.path.join(units_dir, unit)):
+            return unit
+    hookenv.log("No {} systemd unit for the principal {}".format(unit, principal),
+                level=hookenv.WARNING)
+    return None
+
+
+@when('telegraf.installed')
+@when_not('plugins.procstat.configured')
+def configure_procstat():
+    """Gather the process metrics of the processes in procstat_targets,
+    selected by systemd unit, cgroup or pid file instead of scanning every
+    process for a pattern"""
+    config_path = get_plugin_config_path('procstat')
+    targets = [t.strip() for t in
+               hookenv.config().get('procstat_targets', '').split(',')
+               if t.strip()]
+    extra_options = get_extra_options()
+    tables = []
+    for target in targets:
+        selector, _, value = target.partition(':')
+        if selector == 'principal':
+            if get_remote_unit_name() is None:
+                hookenv.log("Principal unit not known yet, procstat not "
+                            "configured")
+                return
+            selector, value = 'systemd_unit', get_principal_systemd_unit()
+            if value is None:
+                continue
+        elif selector not in PROCSTAT_SELECTORS or not value:
+            hookenv.log("Invalid procstat target {}, expected principal or "
+                        "one of: {}".format(target, ', '.join(
+                            '{}:<value>'.format(s) for s in PROCSTAT_SELECTORS)),
+                        level=hookenv.WARNING)
+            continue
+        tables.append(plugin_table('inputs', 'procstat', [(selector, value)],
+                                   extra_options=extra_options))
+    if tables:
+        write_plugin_config('procstat', tables)
+        set_state('plugins.procstat.configured')
+    elif os.path.exists(config_path):
+        hookenv.log("Deleting {} plugin config file".format('procstat'))
+        os.unlink(config_path)
 
 
 @when('elasticsearch.available')
 def elasticsearch_input(es):
-    template = """
-[[inputs.elasticsearch]]
-  servers = {{ servers }}
-"""
+    if not relation_hook_pending('elasticsearch', peers=True):
+        return
     hosts = []
+    cluster = None
     rels = hookenv.relations_of_type('elasticsearch')
     for rel in rels:
         es_host = rel.get('host')
@@ -291,25 +1843,47 @@ def elasticsearch_input(es):
             hookenv.log('No host received for relation: {}.'.format(rel))
             continue
         hosts.append("http://{}:{}".format(es_host, port))
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'elasticsearch')
+        if cluster is None:
+            cluster = rel.get('cluster-name') or \
+                rel.get('__unit__', 'elasticsearch/0').split('/')[0]
+    set_peer_cluster('elasticsearch', cluster)
+    config_path = get_plugin_config_path('elasticsearch')
     if hosts:
-        context = {"servers": json.dumps(hosts)}
-        input_config = render_template(template, context) + \
-            render_extra_options("inputs", "elasticsearch")
-        hookenv.log("Updating {} plugin config file".format('elasticsearch'))
-        host.write_file(config_path, input_config.encode('utf-8'))
+        # node stats are collected everywhere, cluster level stats only by
+        # one unit per cluster
+        extra_options = get_extra_options()
+        options = extra_options['inputs'].get('elasticsearch', {})
+        if hookenv.config().get('elasticsearch_cluster_stats'):
+            options = dict({'cluster_health': True, 'cluster_stats': True},
+                           **options)
+        options = get_cluster_options(
+            'elasticsearch', cluster, options,
+            [k for k in options if k.startswith('cluster_')])
+        extra_options['inputs']['elasticsearch'] = options
+        write_plugin_config('elasticsearch', [plugin_table(
+            'inputs', 'elasticsearch', [('servers', hosts)],
+            extra_options=extra_options)])
         set_state('plugins.elasticsearch.configured')
     elif os.path.exists(config_path):
         os.unlink(config_path)
         remove_state('plugins.elasticsearch.configured')
 
 
+@when_not('elasticsearch.available')
+@when('plugins.elasticsearch.configured')
+def elasticsearch_input_departed():
+    config_path = get_plugin_config_path('elasticsearch')
+    if os.path.exists(config_path):
+        os.unlink(config_path)
+    remove_state('plugins.elasticsearch.configured')
+    # let another unit collect the cluster stats
+    set_peer_cluster('elasticsearch', None)
+
+
 @when('memcached.available')
 def memcached_input(memcache):
-    template = """
-[[inputs.memcached]]
-  servers = {{ servers }}
-"""
+    if not relation_hook_pending('memcached'):
+        return
     required_keys = ['host', 'port']
     rels = hookenv.relations_of_type('memcached')
     addresses = []
@@ -319,13 +1893,10 @@ def memcached_input(memcache):
             port = rel['port']
             address = '{}:{}'.format(addr, port)
             addresses.append(address)
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'memcached')
+    config_path = get_plugin_config_path('memcached')
     if addresses:
-        context = {"servers": json.dumps(addresses)}
-        input_config = render_template(template, context) + \
-            render_extra_options("inputs", "memcached")
-        hookenv.log("Updating {} plugin config file".format('memcached'))
-        host.write_file(config_path, input_config.encode('utf-8'))
+        write_plugin_config('memcached', [plugin_table(
+            'inputs', 'memcached', [('servers', addresses)])])
         set_state('plugins.memcached.configured')
     elif os.path.exists(config_path):
         os.unlink(config_path)
@@ -333,13 +1904,19 @@ def memcached_input(memcache):
 
 @when('mongodb.database.available')
 def mongodb_input(mongodb):
-    template = """
-[[inputs.mongodb]]
-  servers = {{ servers }}
-"""
+    if not relation_hook_pending('mongodb', peers=True):
+        return
+    config = hookenv.config()
     rels = hookenv.relations_of_type('mongodb')
+    # only the local replica set member, each one has its own telegraf
+    local_rels = [rel for rel in rels
+                  if rel['private-address'] == hookenv.unit_private_ip()]
+    if rels and not local_rels:
+        hookenv.log("No local mongodb unit found, collecting all of them")
+        local_rels = rels
     mongo_addresses = []
-    for rel in rels:
+    replset = None
+    for rel in local_rels:
         addr = rel['private-address']
         port = rel.get('port', None)
         if port:
@@ -347,38 +1924,66 @@ def mongodb_input(mongodb):
         else:
             mongo_address = addr
         mongo_addresses.append(mongo_address)
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'mongodb')
+        if replset is None:
+            replset = rel.get('replset') or \
+                rel.get('__unit__', 'mongodb/0').split('/')[0]
+    set_peer_cluster('mongodb', replset)
+    config_path = get_plugin_config_path('mongodb')
     if mongo_addresses:
-        context = {"servers": json.dumps(mongo_addresses)}
-        input_config = render_template(template, context) + \
-            render_extra_options("inputs", "mongodb")
-        hookenv.log("Updating {} plugin config file".format('mongodb'))
-        host.write_file(config_path, input_config.encode('utf-8'))
+        # per-db and collection stats are the same in every member, they are
+        # collected by one unit per replica set
+        extra_options = get_extra_options()
+        options = extra_options['inputs'].get('mongodb', {})
+        defaults = {}
+        if config.get('mongodb_perdb_stats'):
+            defaults['gather_perdb_stats'] = True
+        if config.get('mongodb_col_stats'):
+            defaults['gather_col_stats'] = True
+        options = get_cluster_options(
+            'mongodb', replset, dict(defaults, **options),
+            ['gather_perdb_stats', 'gather_col_stats', 'col_stats_dbs'])
+        extra_options['inputs']['mongodb'] = options
+        write_plugin_config('mongodb', [plugin_table(
+            'inputs', 'mongodb', [('servers', mongo_addresses)],
+            extra_options=extra_options)])
         set_state('plugins.mongodb.configured')
     elif os.path.exists(config_path):
         os.unlink(config_path)
 
 
+@when_not('mongodb.database.available')
+@when('plugins.mongodb.configured')
+def mongodb_input_departed():
+    config_path = get_plugin_config_path('mongodb')
+    if os.path.exists(config_path):
+        os.unlink(config_path)
+    remove_state('plugins.mongodb.configured')
+    # let another unit collect the replica set stats
+    set_peer_cluster('mongodb', None)
+
+
 @when('postgresql.database.available')
 def postgresql_input(db):
-    template = """
-[[inputs.postgresql]]
-  address = "host={{host}} user={{user}} password={{password}} dbname={{database}}"
-"""
+    if not relation_hook_pending('postgresql'):
+        return
     required_keys = ['host', 'user', 'password', 'database']
     rels = hookenv.relations_of_type('postgresql')
-    inputs = []
+    addresses = []
     for rel in rels:
         if all([rel.get(key) for key in required_keys]) \
                 and hookenv.local_unit() in rel.get('allowed-units') \
                 and rel['private-address'] == hookenv.unit_private_ip():
-            context = rel.copy()
-            inputs.append(render_template(template, context) +
-                          render_extra_options("inputs", "postgresql"))
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'postgresql')
+            addresses.append("host={host} user={user} password={password} "
+                             "dbname={database}".format(**rel))
+    if not relation_data_changed('postgresql', addresses):
+        return
+    extra_options = get_extra_options()
+    inputs = [plugin_table('inputs', 'postgresql', [('address', address)],
+                           extra_options=extra_options)
+              for address in addresses]
+    config_path = get_plugin_config_path('postgresql')
     if inputs:
-        hookenv.log("Updating {} plugin config file".format('postgresql'))
-        host.write_file(config_path, '\n'.join(inputs).encode('utf-8'))
+        write_plugin_config('postgresql', inputs)
         set_state('plugins.postgresql.configured')
     elif os.path.exists(config_path):
         os.unlink(config_path)
@@ -386,10 +1991,8 @@ def postgresql_input(db):
 
 @when('haproxy.available')
 def haproxy_input(haproxy):
-    template = """
-[[inputs.haproxy]]
-  servers = {{ servers }}
-"""
+    if not relation_hook_pending('haproxy'):
+        return
     rels = hookenv.relations_of_type('haproxy')
     haproxy_addresses = []
     for rel in rels:
@@ -413,12 +2016,10 @@ def haproxy_input(haproxy):
             userpass += ":{}".format(password)
         haproxy_address = 'http://{}@{}:{}'.format(userpass, addr, port)
         haproxy_addresses.append(haproxy_address)
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'haproxy')
+    config_path = get_plugin_config_path('haproxy')
     if haproxy_addresses:
-        input_config = render_template(template, {"servers": json.dumps(haproxy_addresses)}) + \
-            render_extra_options("inputs", "haproxy")
-        hookenv.log("Updating {} plugin config file".format('haproxy'))
-        host.write_file(config_path, input_config.encode('utf-8'))
+        write_plugin_config('haproxy', [plugin_table(
+            'inputs', 'haproxy', [('servers', haproxy_addresses)])])
         set_state('plugins.haproxy.configured')
     elif os.path.exists(config_path):
         os.unlink(config_path)
@@ -426,11 +2027,9 @@ def haproxy_input(haproxy):
 
 @when('apache.available')
 def apache_input(apache):
-    template = """
-[[inputs.apache]]
-  urls = {{ urls }}
-"""
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'apache')
+    if not relation_hook_pending('apache'):
+        return
+    config_path = get_plugin_config_path('apache')
     port = '8080'
     vhost = render(source='apache-server-status.tmpl',
                    templates_dir=get_templates_dir(),
@@ -441,48 +2040,99 @@ def apache_input(apache):
                      "enabled": True,
                      "site_config": vhost,
                      "site_modules": "status"}
-    urls = []
     rels = hookenv.relations_of_type('apache')
-    for rel in rels:
-        hookenv.relation_set(rel['__relid__'], relation_settings=relation_info)
-        addr = rel['private-address']
-        url = 'http://{}:{}/server-status?auto'.format(addr, port)
-        urls.append(url)
+    urls = ['http://{}:{}/server-status?auto'.format(rel['private-address'], port)
+            for rel in rels]
+    relation_ids = sorted(set(rel['__relid__'] for rel in rels))
+    if not relation_data_changed('apache', [urls, relation_ids]):
+        return
+    for relation_id in relation_ids:
+        hookenv.relation_set(relation_id, relation_settings=relation_info)
     if urls:
-        context = {"urls": json.dumps(urls)}
-        input_config = render_template(template, context) + \
-            render_extra_options("inputs", "apache")
-        hookenv.log("Updating {} plugin config file".format('apache'))
-        host.write_file(config_path, input_config.encode('utf-8'))
+        write_plugin_config('apache', [plugin_table(
+            'inputs', 'apache', [('urls', urls)])])
         set_state('plugins.apache.configured')
     elif os.path.exists(config_path):
         os.unlink(config_path)
 
 
+def apply_exec_budget(commands):
+    """Apply the exec budget to the exec relation commands.
+
+    Commands get an interval from their interval or cost hints, the ones over
+    exec_max_commands (most expensive first) are skipped, and the rest are
+    grouped in as few exec inputs as possible.
+    """
+    config = hookenv.config()
+    base_interval = parse_duration(config['interval'])
+    duty_cycle = config.get('exec_max_duty_cycle')
+    max_commands = config.get('exec_max_commands')
+    costs = []
+    for command in commands:
+        interval = command.pop('interval', None)
+        cost = command.pop('cost', None)
+        # hints sent by the related units, bad ones are ignored
+        try:
+            cost = float(cost or 0)
+            if not math.isfinite(cost) or cost < 0:
+                raise ValueError(cost)
+        except (TypeError, ValueError):
+            hookenv.log("Invalid exec cost {!r} for {}, ignoring it".format(
+                cost, command['commands']), level=hookenv.WARNING)
+            cost = 0
+        try:
+            interval = parse_duration(interval) if interval else None
+            if interval is not None and (not math.isfinite(interval) or
+                                         interval < 0):
+                raise ValueError(interval)
+        except (TypeError, ValueError):
+            hookenv.log("Invalid exec interval {!r} for {}, using the "
+                        "default".format(interval, command['commands']),
+                        level=hookenv.WARNING)
+            interval = None
+        if not interval and cost and duty_cycle:
+            # stretch the interval so the command runs at most duty_cycle of
+            # the time, in multiples of the agent interval to keep it aligned
+            interval = base_interval * math.ceil(cost / duty_cycle / base_interval)
+        if interval and interval != base_interval:
+            command['interval'] = '{:g}s'.format(interval)
+        costs.append(cost / (interval or base_interval))
+    # cheaper commands take precedence when over budget
+    budget = set()
+    total = 0
+    for cost, idx in sorted(zip(costs, range(len(commands)))):
+        command = commands[idx]
+        if max_commands and total + len(command['commands']) > max_commands:
+            hookenv.log("exec budget of {} commands exceeded, skipping: "
+                        "{}".format(max_commands, command['commands']),
+                        level=hookenv.WARNING)
+            continue
+        total += len(command['commands'])
+        budget.add(idx)
+    # group commands with the same settings, keeping the relation order
+    inputs = OrderedDict()
+    for idx, command in enumerate(commands):
+        if idx not in budget:
+            continue
+        key = json.dumps(dict((k, v) for k, v in command.items()
+                              if k != 'commands'), sort_keys=True)
+        if key not in inputs:
+            inputs[key] = dict(command, commands=[])
+        inputs[key]['commands'].extend(c for c in command['commands']
+                                       if c not in inputs[key]['commands'])
+    return list(inputs.values())
+
+
 @when('exec.available')
 def exec_input(exec_rel):
-    template = """
-{% for cmd in commands %}
-[[inputs.exec]]
-  commands = {{ cmd.commands }}
-  {% for key, value in cmd|dictsort %}
-      {% if key not in ["commands", "tags"] %}
-  {{ key }} = "{{ value }}"
-      {% endif %}
-  {% endfor %}
-  {% if cmd.tags %}
-  [inputs.exec.tags]
-    {% for tag, tag_value in cmd.tags|dictsort %}
-    {{ tag }} = "{{ tag_value }}"
-    {% endfor %}
-  {% endif %}
-
-{% endfor %}
-"""
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'exec')
+    if not relation_hook_pending('exec'):
+        return
     commands = exec_rel.commands()
+    if not relation_data_changed('exec', commands):
+        return
     if not commands:
         hookenv.log("No Commands defined in the exec relation, doing nothing.")
+        set_plugin_configured('exec', config_written=False)
         return
     timeout_support = exec_timeout_supported()
     pre_proc_cmds = []
@@ -493,16 +2143,19 @@ def exec_input(exec_rel):
         if run_on_this_unit:
             pre_proc_cmds.append(command)
     if pre_proc_cmds:
-        input_config = render_template(template, {'commands': pre_proc_cmds})
-        hookenv.log("Updating {} plugin config file".format('exec'))
-        host.write_file(config_path, input_config.encode('utf-8'))
-        set_state('plugins.exec.configured')
+        inputs = [ConfigTable('inputs.exec',
+                              [('commands', cmd.pop('commands'))]).update(cmd)
+                  for cmd in apply_exec_budget(pre_proc_cmds)]
+        write_plugin_config('exec', inputs)
+        set_plugin_configured('exec')
+    else:
+        set_plugin_configured('exec', config_written=False)
 
 
 @when_not('exec.available')
 @when('plugins.exec.configured')
 def exec_input_departed():
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'exec')
+    config_path = get_plugin_config_path('exec')
     rels = hookenv.relations_of_type('exec')
     if not rels:
         remove_state('plugins.exec.configured')
@@ -510,30 +2163,167 @@ def exec_input_departed():
             os.unlink(config_path)
 
 
+@when('listener.available')
+def listener_input(listener):
+    if not relation_hook_pending('listener'):
+        return
+    listeners = sorted(listener.listeners())
+    users = sorted(set(listener.users()))
+    if not relation_data_changed('listener', [listeners, users]):
+        return
+    config_path = get_plugin_config_path('listener')
+    first_port = hookenv.config()['listener_port'] + \
+        get_machine_slot() * LISTENER_PORTS_PER_UNIT
+    port = first_port
+    extra_options = get_extra_options()
+    inputs = []
+    addresses = {}
+    for transport, data_format in sorted(set(listeners)):
+        if transport != 'statsd' and data_format not in LISTENER_DATA_FORMATS:
+            hookenv.log("Unsupported listener data_format: {}".format(data_format),
+                        level=hookenv.WARNING)
+            continue
+        if transport in ('unix', 'unixgram'):
+            if not os.path.isdir(LISTENER_SOCKET_DIR):
+                host.mkdir(LISTENER_SOCKET_DIR, owner='telegraf',
+                           group='telegraf', perms=0o750)
+            address = os.path.join(LISTENER_SOCKET_DIR, '{}listener-{}.sock'.format(
+                get_config_prefix(), data_format))
+            plugin = 'socket_listener'
+            # the principal doesn't run as the telegraf user, it connects as
+            # a member of the telegraf group, see add_listener_user
+            options = [('service_address', '{}://{}'.format(transport, address)),
+                       ('socket_mode', '0660')]
+        elif transport in ('tcp', 'udp', 'http') and \
+                port >= first_port + LISTENER_PORTS_PER_UNIT:
+            hookenv.log("No listener ports left for {} {}, only {} per "
+                        "unit".format(transport, data_format,
+                                      LISTENER_PORTS_PER_UNIT),
+                        level=hookenv.WARNING)
+            continue
+        elif transport in ('tcp', 'udp'):
+            address = '127.0.0.1:{}'.format(port)
+            plugin = 'socket_listener'
+            options = [('service_address', '{}://{}'.format(transport, address))]
+            port += 1
+        elif transport == 'statsd':
+            if not get_statsd_port():
+                hookenv.log("statsd listener requested, but statsd_port is "
+                            "not set", level=hookenv.WARNING)
+                continue
+            # served by the statsd input, see configure_statsd
+            addresses[(transport, data_format)] = \
+                '127.0.0.1:{}'.format(get_statsd_port())
+            continue
+        elif transport == 'http':
+            address = 'http://127.0.0.1:{}/telegraf'.format(port)
+            plugin = 'http_listener_v2'
+            options = [('service_address', '127.0.0.1:{}'.format(port)),
+                       ('path', '/telegraf')]
+            port += 1
+        else:
+            hookenv.log("Unsupported listener transport: {}".format(transport),
+                        level=hookenv.WARNING)
+            continue
+        options.append(('data_format', data_format))
+        inputs.append(plugin_table('inputs', plugin, options,
+                                   extra_options=extra_options))
+        addresses[(transport, data_format)] = address
+    if any(transport in ('unix', 'unixgram') for transport, _ in addresses):
+        for user in users:
+            add_listener_user(user)
+    if inputs:
+        write_plugin_config('listener', inputs)
+        set_plugin_configured('listener')
+    else:
+        if os.path.exists(config_path):
+            os.unlink(config_path)
+        set_plugin_configured('listener', config_written=False)
+    listener.configure(addresses)
+
+
+def add_listener_user(user):
+    """Add a user to the telegraf group, so it can connect to the unix
+    sockets of the listener relation"""
+    try:
+        pwd.getpwnam(user)
+    except KeyError:
+        hookenv.log("Listener user {} doesn't exist in this machine".format(user),
+                    level=hookenv.WARNING)
+        return
+    if user not in grp.getgrnam('telegraf').gr_mem:
+        host.add_user_to_group(user, 'telegraf')
+
+
+@when_not('listener.available')
+@when('plugins.listener.configured')
+def listener_input_departed():
+    config_path = get_plugin_config_path('listener')
+    rels = hookenv.relations_of_type('listener')
+    if not rels:
+        remove_state('plugins.listener.configured')
+        if os.path.exists(config_path):
+            os.unlink(config_path)
+
+
 @when('influxdb-api.available')
 def influxdb_api_output(influxdb):
+    if not relation_hook_pending('influxdb-api'):
+        return
+    config = hookenv.config()
     required_keys = ['hostname', 'port', 'user', 'password']
     rels = hookenv.relations_of_type('influxdb-api')
     endpoints = []
+    versions = []
     user = None
     password = None
     for rel in rels:
         if all([rel.get(key) for key in required_keys]):
-            endpoints.append("http://{}:{}".format(rel['hostname'], rel['port']))
+            if config.get('influxdb_udp') and rel.get('udp-port'):
+                endpoints.append("udp://{}:{}".format(rel['hostname'],
+                                                      rel['udp-port']))
+            else:
+                if config.get('influxdb_udp'):
+                    hookenv.log("{} doesn't advertise an UDP port, using "
+                                "HTTP".format(rel['hostname']),
+                                level=hookenv.WARNING)
+                endpoints.append("http://{}:{}".format(rel['hostname'], rel['port']))
+            versions.append(rel.get('version'))
             if user is None:
                 user = rel['user']
             if password is None:
                 password = rel['password']
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'influxdb-api')
+    config_path = get_plugin_config_path('influxdb-api')
     if endpoints:
-        hookenv.log("Updating {} plugin config file".format('influxdb-api'))
-        content = render(source='influxdb-api.conf.tmpl', target=None,
-                         templates_dir=get_templates_dir(),
-                         context={'urls': json.dumps(endpoints),
-                                  'username': '{}'.format(user),
-                                  'password': '{}'.format(password)})
-        extra_opts = render_extra_options("outputs", "influxdb")
-        host.write_file(config_path, '\n'.join([content, extra_opts]).encode('utf-8'))
+        options = [('urls', endpoints),
+                   ('database', 'telegraf'),
+                   ('precision', config.get('influxdb_precision')),
+                   ('timeout', config.get('influxdb_timeout') or None),
+                   ('content_encoding', get_influxdb_content_encoding(versions)),
+                   ('username', '{}'.format(user)),
+                   ('password', '{}'.format(password)),
+                   ('user_agent', 'telegraf')]
+        write_plugin_config('influxdb-api', [plugin_table(
+            'outputs', 'influxdb', options,
+            comment="Configuration for influxdb server to send metrics to",
+            comments={
+                'urls': "The full HTTP or UDP endpoint URL for your InfluxDB "
+                        "instance.\nMultiple urls can be specified but it is "
+                        "assumed that they are part of the same\ncluster, "
+                        "this means that only ONE of the urls will be written "
+                        "to each interval.",
+                'database': "The target database for metrics (telegraf will "
+                            "create it if not exists)",
+                'precision': "Precision of writes, valid values are n, u, ms, "
+                             "s, m, and h\nnote: using second precision "
+                             "greatly helps InfluxDB compression",
+                'timeout': "Connection timeout (for the connection with "
+                           "InfluxDB), formatted as a string.\nIf not "
+                           "provided, will default to 0 (no timeout)",
+                'content_encoding': "HTTP Content-Encoding for write request "
+                                    "body",
+                'user_agent': "Set the user agent for HTTP POSTs (can be "
+                              "useful for log differentiation)"})])
         set_state('plugins.influxdb-api.configured')
     elif os.path.exists(config_path):
         os.unlink(config_path)
@@ -541,17 +2331,21 @@ def influxdb_api_output(influxdb):
 
 @when('prometheus-client.available')
 def prometheus_client(prometheus):
-    template = """
-[[outputs.prometheus_client]]
-  listen = "{{ listen }}"
-"""
+    if not relation_hook_pending('prometheus-client'):
+        return
     if get_prometheus_port():
         hookenv.log("Prometheus configured globally, skipping plugin setup")
+        set_port('prometheus-client', None)
+        config_path = get_plugin_config_path('prometheus-client')
+        if os.path.exists(config_path):
+            os.unlink(config_path)
         prometheus.configure(get_prometheus_port())
+        set_plugin_configured('prometheus-client', config_written=False)
         # bail out, nothing more need to be configured here
         return
-    port = 9126
-    extra_options = get_extra_options()
+    # one per co-located unit
+    port = PROMETHEUS_CLIENT_PORT + get_machine_slot()
+    extra_options = get_prometheus_client_options(get_extra_options())
     options = extra_options['outputs'].get('prometheus-client', {})
     listen = options.pop('listen', None)
     if listen is not None:
@@ -559,41 +2353,173 @@ def prometheus_client(prometheus):
         port = int(listen.split(":", 1)[1])
     else:
         listen = ":{}".format(port)
-    check_port("prometheus_output", get_prometheus_port())
+    set_port('prometheus-client', port)
     prometheus.configure(port)
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'prometheus-client')
-    hookenv.log("Updating {} plugin config file".format('prometheus-client'))
-    context = {"listen": listen}
-    content = render_template(template, context) + \
-        render_extra_options("outputs", "prometheus_client",
-                             extra_options=extra_options)
-    host.write_file(config_path, content.encode('utf-8'))
-    set_state('plugins.prometheus-client.configured')
+    write_plugin_config('prometheus-client', [plugin_table(
+        'outputs', 'prometheus_client', [('listen', listen)],
+        extra_options=extra_options)])
+    set_plugin_configured('prometheus-client')
 
 
 @when_not('prometheus-client.available')
 @when('plugins.prometheus-client.configured')
 def prometheus_client_departed():
     hookenv.log("prometheus-client relation not available")
-    config_path = '{}/{}.conf'.format(get_configs_dir(), 'prometheus-client')
+    config_path = get_plugin_config_path('prometheus-client')
     rels = hookenv.relations_of_type('prometheus-client')
-    if not rels and os.path.exists(config_path):
-        hookenv.log("Deleting {} plugin config file".format('prometheus-client'))
-        os.unlink(config_path)
+    if not rels:
+        if os.path.exists(config_path):
+            hookenv.log("Deleting {} plugin config file".format(
+                'prometheus-client'))
+            os.unlink(config_path)
         remove_state('plugins.prometheus-client.configured')
+        set_port('prometheus-client', None)
+
+
+@when('nrpe-external-master.available')
+@when_not('telegraf.nrpe.configured')
+def update_nrpe_config(nrpe_external_master):
+    config = hookenv.config()
+    nrpe.copy_nrpe_checks(nrpe_files_dir=os.path.join(
+        hookenv.charm_dir(), 'files', 'nrpe'))
+    unit_name = nrpe.get_nagios_unit_name()
+    nrpe_setup = nrpe.NRPE(hostname=nrpe.get_nagios_hostname())
+    nrpe_setup.add_check(
+        shortname='telegraf_proc',
+        description='telegraf process {}'.format(unit_name),
+        check_cmd='check_procs -c 1: -C telegraf')
+    port = get_health_port()
+    if port:
+        # one request to the health endpoint per check run
+        interval = parse_duration(config['interval'])
+        nrpe_setup.add_check(
+            shortname='telegraf_write_errors',
+            description='telegraf output write errors {}'.format(unit_name),
+            check_cmd='check_telegraf.py errors --port {}'.format(port))
+        nrpe_setup.add_check(
+            shortname='telegraf_buffer',
+            description='telegraf output buffer usage {}'.format(unit_name),
+            check_cmd='check_telegraf.py buffer --port {} -w {} -c {} '
+                      '--limit {}'.format(port, config['nrpe_buffer_warning'],
+                                          config['nrpe_buffer_critical'],
+                                          get_metric_buffer_limit()))
+        nrpe_setup.add_check(
+            shortname='telegraf_gather_time',
+            description='telegraf input gather time {}'.format(unit_name),
+            check_cmd='check_telegraf.py gather --port {} -w {:g} -c {:g}'.format(
+                port, interval * config['health_gather_threshold'], interval))
+    else:
+        hookenv.log("No health endpoint, only checking the telegraf process",
+                    level=hookenv.WARNING)
+        for check in NRPE_CHECKS[1:]:
+            nrpe_setup.remove_check(shortname=check)
+    nrpe_setup.write()
+    set_state('telegraf.nrpe.configured')
+
+
+@when_not('nrpe-external-master.available')
+@when('telegraf.nrpe.configured')
+def remove_nrpe_config():
+    nrpe_setup = nrpe.NRPE(hostname=nrpe.get_nagios_hostname())
+    for check in NRPE_CHECKS:
+        nrpe_setup.remove_check(shortname=check)
+    remove_state('telegraf.nrpe.configured')
 
 
 @when('telegraf.configured')
 def start_or_restart():
     states = sorted([k for k in get_states().keys()
                      if k.startswith('plugins') or k.startswith('extra_plugins')])
+    # extra plugins share a single state, track their fragments by name
+    states += [os.path.basename(path) for path in list_extra_plugins_files()]
 
     config_files_changed = helpers.any_file_changed(list_config_files())
     active_plugins_changed = helpers.data_changed('active_plugins', states or '')
     if config_files_changed or active_plugins_changed:
-        hookenv.log("Restarting telegraf")
-        host.service_restart('telegraf')
+        with machine_lock():
+            error = validate_config()
+            if error is not None:
+                hookenv.log("Invalid telegraf config, not restarting:\n{}".format(error),
+                            level=hookenv.ERROR)
+                restored = restore_last_good_config()
+                if restored is not None:
+                    # record the restored files, so they don't trigger a restart
+                    helpers.any_file_changed(list_config_files())
+                    reset_restored_config(restored)
+                hookenv.status_set('blocked',
+                                   'Invalid telegraf config, see juju debug-log')
+                set_state('telegraf.config.invalid')
+                return
+            hookenv.log("Restarting telegraf")
+            host.service_restart('telegraf')
+            save_last_good_config()
+        remove_state('telegraf.config.invalid')
+        error = get_config_error()
+        if error is not None:
+            hookenv.status_set('blocked', error)
+        else:
+            hookenv.status_set('active', get_status_message())
     else:
         hookenv.log("Not restarting: active_plugins_changed={} | "
                     "config_files_changed={}".format(active_plugins_changed,
                                                      config_files_changed))
+
+
+@hook('update-status')
+def update_health():
+    states = get_states()
+    if not unitdata.kv().get('health.port') or \
+            'telegraf.configured' not in states or \
+            'telegraf.config.invalid' in states or get_config_error():
+        return
+    try:
+        metrics = get_internal_metrics()
+    except (IOError, ValueError) as e:
+        hookenv.log("Can't read the telegraf internal metrics: {}".format(e),
+                    level=hookenv.WARNING)
+        hookenv.status_set('blocked', 'Telegraf internal metrics not available')
+        return
+    status, message = check_health(metrics)
+    hookenv.status_set(status, get_status_message(message))
+
+
+@hook('update-status')
+def expire_debug():
+    """Turn debug logging off once debug_duration is over, the debug config
+    stays set until it's changed, which starts a new window"""
+    config = hookenv.config()
+    if not (config.get('debug') or config.get('debug_plugins')) or \
+            unitdata.kv().get('debug.expired') or is_debug_active():
+        return
+    hookenv.log("debug_duration ({}) expired, turning debug logging "
+                "off".format(config['debug_duration']))
+    unitdata.kv().set('debug.expired', True)
+    for plugin in list_supported_plugins() + ['statsd', 'procstat']:
+        remove_state('plugins.{}.configured'.format(plugin))
+    remove_state('telegraf.configured')
+
+
+@hook('stop')
+def unregister_unit():
+    unitdata.kv().set('unit.stopped', True)
+    # after the handlers of the hook, so they don't write the files back
+    hookenv.atexit(remove_unit_config)
+
+
+def remove_unit_config():
+    """Remove the telegraf.d files and the registration of this unit, as
+    telegraf keeps running for the other units of the machine"""
+    units = [u for u in list_machine_units() if u != hookenv.local_unit()]
+    with machine_lock():
+        if units:
+            # the main config is left for the next owner to take over
+            for path in list_config_files():
+                if os.path.dirname(path) == get_configs_dir() and \
+                        os.path.exists(path):
+                    hookenv.log("Deleting {}".format(path))
+                    os.unlink(path)
+            host.service_restart('telegraf')
+        registry_path = os.path.join(get_machine_units_dir(),
+                                     hookenv.local_unit().replace('/', '-'))
+        if os.path.exists(registry_path):
+            os.unlink(registry_path)
@@ -0,0 +1,335 @@
+"""Hook simulation harness for the reactive handlers in reactive/telegraf.py
+
+Replays a scripted hook timeline (install, config changes, relation
+joins/departures, update-status...) against a fake hookenv/unitdata backend
+and a temporary /etc/telegraf, recording for each hook which handlers ran,
+which relations' data they read or set, which files were written and how
+many times telegraf was restarted or systemd reloaded. A restart is flagged
+as redundant when the config files are the same ones telegraf was already
+running with.
+
+Usage (from a test, with the pytest monkeypatch and tmpdir fixtures):
+
+    sim = HookSimulator(monkeypatch, tmpdir)
+    sim.run([('install',),
+             ('config-changed', {'tags': 'dc=us-east-1'}),
+             ('relation-joined', 'influxdb-api', 'influxdb/0',
+              {'hostname': '10.0.0.2', 'port': 8086,
+               'user': 'telegraf', 'password': 'secret'}),
+             ('update-status',)])
+    print(sim.report())
+"""
+import copy
+import getpass
+import hashlib
+import os
+import re
+
+from collections import Counter, OrderedDict
+
+import yaml
+
+from charms.reactive import bus, relations
+from charmhelpers.core import hookenv, unitdata
+
+import reactive
+
+from reactive import telegraf
+
+
+CHARM_DIR = os.path.join(os.path.dirname(reactive.__file__), '..')
+
+# flag set by each relation interface when the relation is ready
+RELATION_FLAGS = {
+    'apache': 'apache.available',
+    'elasticsearch': 'elasticsearch.available',
+    'exec': 'exec.available',
+    'haproxy': 'haproxy.available',
+    'influxdb-api': 'influxdb-api.available',
+    'listener': 'listener.available',
+    'memcached': 'memcached.available',
+    'mongodb': 'mongodb.database.available',
+    'postgresql': 'postgresql.database.available',
+    'prometheus-client': 'prometheus-client.available',
+}
+
+
+class FakeRelation(object):
+    """Relation data of the remote units, plus the interface methods the
+    handlers use (acts as its own relation factory too)"""
+
+    def __init__(self, name, simulator):
+        self.name = name
+        self.simulator = simulator
+        self.units = OrderedDict()
+        self.sent = []
+
+    def from_flag(self, flag):
+        return self
+
+    def relations(self):
+        return [dict(data, __unit__=unit, __relid__='{}:0'.format(self.name))
+                for unit, data in self.units.items()]
+
+    def commands(self):
+        self.simulator.hook.relation_reads[self.name] += 1
+        commands = []
+        for data in self.units.values():
+            for cmd in copy.deepcopy(data.get('commands', [])):
+                commands.append(dict({'timeout': '5s', 'run_on_this_unit': True,
+                                      'interval': None, 'cost': None}, **cmd))
+        return commands
+
+    def listeners(self):
+        self.simulator.hook.relation_reads[self.name] += 1
+        return [(data.get('transport') or 'unix',
+                 data.get('data_format') or 'influx')
+                for data in self.units.values()]
+
+    def users(self):
+        self.simulator.hook.relation_reads[self.name] += 1
+        return [data['user'] for data in self.units.values() if data.get('user')]
+
+    def configure(self, *args):
+        self.simulator.hook.relation_writes[self.name] += 1
+        self.sent.append(args)
+
+
+class HookStats(object):
+
+    def __init__(self, hook_name):
+        self.hook_name = hook_name
+        self.handlers = Counter()
+        self.relation_reads = Counter()
+        self.relation_writes = Counter()
+        self.writes = []
+        self.restarts = 0
+        self.redundant_restarts = 0
+        self.reloads = 0
+
+    def __repr__(self):
+        return '<HookStats {} handlers={} writes={} restarts={} ' \
+            'redundant={} reloads={}>'.format(
+                self.hook_name, sum(self.handlers.values()), len(self.writes),
+                self.restarts, self.redundant_restarts, self.reloads)
+
+
+class HookSimulator(object):
+
+    def __init__(self, monkeypatch, tmpdir, principal='ubuntu/0',
+                 config=None):
+        self.monkeypatch = monkeypatch
+        self.tmpdir = tmpdir
+        self.timeline = []
+        self.relations = dict((name, FakeRelation(name, self))
+                              for name in RELATION_FLAGS)
+        self.opened_ports = set()
+        self.installed_version = None
+        self.hook = None
+        self._running_config = None
+        self._setup(principal)
+        with open(os.path.join(CHARM_DIR, 'config.yaml')) as fd:
+            options = yaml.safe_load(fd)['options']
+        self.config = dict((k, v['default']) for k, v in options.items())
+        self.config.update(config or {})
+
+    def _setup(self, principal):
+        mp = self.monkeypatch
+        charm_dir = self.tmpdir.mkdir('sim_charm_dir')
+        mp.setitem(os.environ, 'CHARM_DIR', charm_dir.strpath)
+        mp.setitem(os.environ, 'JUJU_UNIT_NAME', 'telegraf/0')
+        mp.setitem(os.environ, 'JUJU_PRINCIPAL_UNIT', principal)
+        mp.setitem(os.environ, 'UNIT_STATE_DB',
+                   charm_dir.join('.unit-state.db').strpath)
+        mp.setattr(unitdata, '_KV', None)
+        base_dir = self.tmpdir.mkdir('sim_etc_telegraf')
+        base_dir.mkdir(telegraf.CONFIG_DIR)
+        mp.setattr(telegraf, 'BASE_DIR', base_dir.strpath)
+        mp.setattr(telegraf, 'SYSTEMD_DROPIN_DIR',
+                   self.tmpdir.join('sim_systemd').strpath)
+        mp.setattr(telegraf, 'get_templates_dir',
+                   lambda: os.path.join(CHARM_DIR, 'templates'))
+        with open(os.path.join(CHARM_DIR, 'metadata.yaml')) as md:
+            metadata = yaml.safe_load(md)
+        mp.setattr(hookenv, 'metadata', lambda: metadata)
+        # juju hook tools
+        mp.setattr(hookenv, 'log', self._log)
+        mp.setattr(hookenv, 'status_set', lambda *a, **kw: None)
+        mp.setattr(hookenv, 'unit_private_ip', lambda: '10.0.0.1')
+        mp.setattr(hookenv, 'relation_set', self._relation_set)
+        mp.setattr(hookenv, 'relation_ids', lambda *a: [])
+        mp.setattr(hookenv, 'resource_get', lambda name: False)
+        mp.setattr(hookenv, 'relations_of_type', self._relations_of_type)
+        mp.setattr(hookenv, 'opened_ports',
+                   lambda: sorted(self.opened_ports))
+        mp.setattr(hookenv, 'open_port', lambda port, protocol='TCP':
+                   self.opened_ports.add('{}/{}'.format(port, protocol.lower())))
+        mp.setattr(hookenv, 'close_port', lambda port, protocol='TCP':
+                   self.opened_ports.discard('{}/{}'.format(port, protocol.lower())))
+        # relation objects passed to the handlers
+        mp.setattr(relations, 'relation_factory',
+                   lambda name: self.relations.get(name))
+        # system
+        mp.setattr(telegraf, 'apt_install', self._apt_install)
+        mp.setattr(telegraf, 'apt_update', lambda *a, **kw: None)
+        mp.setattr(telegraf, 'add_source', lambda *a, **kw: None)
+        mp.setattr(telegraf, 'get_installed_version',
+                   lambda package: self.installed_version)
+        mp.setattr(telegraf, 'validate_config', lambda: None)
+        mp.setattr(telegraf, 'get_internal_metrics', lambda: [])
+        mp.setattr(telegraf.host, 'init_is_systemd', lambda: True)
+        mp.setattr(telegraf.host, 'service_restart', self._service_restart)
+        mp.setattr(telegraf.subprocess, 'check_call', self._check_call)
+        self._write_file = telegraf.host.write_file
+        mp.setattr(telegraf.host, 'write_file', self._intercept_write_file)
+        # swap the relation objects cached by handlers in a previous
+        # simulation, their args are only evaluated once per process
+        for handler in bus.Handler.get_handlers():
+            if hasattr(handler, '_args_evaled'):
+                mp.setattr(handler, '_args_evaled', [
+                    self.relations[arg.name] if isinstance(arg, FakeRelation)
+                    else arg for arg in handler._args_evaled])
+        # callbacks registered at import time, run at the end of every hook
+        self._atexit = list(hookenv._atexit)
+        mp.setattr(hookenv, '_atexit', [])
+
+    # fake backend
+    def _log(self, message, level=None):
+        match = re.match(r'Invoking reactive handler: .*:(\w+)$', str(message))
+        if match and self.hook is not None:
+            self.hook.handlers[match.group(1)] += 1
+
+    def _relations_of_type(self, name):
+        self.hook.relation_reads[name] += 1
+        return self.relations[name].relations()
+
+    def _relation_set(self, relation_id=None, relation_settings=None, **kwargs):
+        if relation_id is not None:
+            self.hook.relation_writes[relation_id.split(':')[0]] += 1
+
+    def _apt_install(self, packages, *a, **kw):
+        self.installed_version = '1.4.0-1'
+
+    def _intercept_write_file(self, path, content, owner='root', group='root',
+                              perms=0o444):
+        if self.hook is not None:
+            self.hook.writes.append(path)
+        # we don't run as root
+        user = getpass.getuser()
+        return self._write_file(path, content, user, user, 0o744)
+
+    def _check_call(self, cmd, *a, **kw):
+        if cmd[:2] == ['systemctl', 'daemon-reload']:
+            self.hook.reloads += 1
+
+    def _service_restart(self, service_name, **kwargs):
+        config = self._config_snapshot()
+        self.hook.restarts += 1
+        if config == self._running_config:
+            self.hook.redundant_restarts += 1
+        self._running_config = config
+
+    def _config_snapshot(self):
+        snapshot = {}
+        paths = telegraf.list_active_config_files()
+        if os.path.exists(telegraf.get_systemd_dropin_path()):
+            paths.append(telegraf.get_systemd_dropin_path())
+        for path in paths:
+            with open(path, 'rb') as fd:
+                snapshot[path] = hashlib.md5(fd.read()).hexdigest()
+        return snapshot
+
+    # hooks
+    def run_hook(self, hook_name):
+        """Run a hook the way layer:basic and charms.reactive do"""
+        self.hook = HookStats(hook_name)
+        self.monkeypatch.setitem(os.environ, 'JUJU_HOOK_NAME', hook_name)
+        hookenv._atexit[:] = self._atexit
+        config = hookenv.Config(self.config)
+        self.monkeypatch.setattr(hookenv, 'config', lambda: config)
+        changed = [k for k in config if config.changed(k)]
+        for key in changed:
+            bus.set_state('config.changed.{}'.format(key))
+        if changed:
+            bus.set_state('config.changed')
+        bus.dispatch()
+        hookenv._run_atexit()
+        for key in changed:
+            bus.remove_state('config.changed.{}'.format(key))
+        bus.remove_state('config.changed')
+        unitdata.kv().flush()
+        self.timeline.append(self.hook)
+        stats, self.hook = self.hook, None
+        return stats
+
+    def install(self):
+        """Deploy: install, config-changed and start hooks"""
+        return [self.run_hook(hook) for hook in
+                ('install', 'config-changed', 'start')]
+
+    def config_changed(self, **options):
+        self.config.update(options)
+        return self.run_hook('config-changed')
+
+    def update_status(self):
+        return self.run_hook('update-status')
+
+    def relation_joined(self, name, unit, data=None):
+        relation = self.relations[name]
+        relation.units[unit] = dict({'private-address': '10.0.1.{}'.format(
+            len(relation.units) + 2)}, **(data or {}))
+        bus.set_state(RELATION_FLAGS[name], {'relation': name})
+        return self.run_hook('{}-relation-joined'.format(name))
+
+    def relation_changed(self, name, unit, data):
+        self.relations[name].units[unit].update(data)
+        return self.run_hook('{}-relation-changed'.format(name))
+
+    def relation_departed(self, name, unit):
+        relation = self.relations[name]
+        del relation.units[unit]
+        if not relation.units:
+            bus.remove_state(RELATION_FLAGS[name])
+        return self.run_hook('{}-relation-departed'.format(name))
+
+    def run(self, events):
+        """Replay a timeline of (event, args...) tuples, e.g:
+
+            ('install',)
+            ('config-changed', {'interval': '20s'})
+            ('relation-joined', 'memcached', 'memcached/0', {'host': ...})
+            ('relation-changed', 'memcached', 'memcached/0', {'port': ...})
+            ('relation-departed', 'memcached', 'memcached/0')
+            ('update-status',)
+        """
+        for event in events:
+            name, args = event[0], event[1:]
+            if name == 'install':
+                self.install()
+            elif name == 'config-changed':
+                self.config_changed(**(args[0] if args else {}))
+            elif name.startswith('relation-'):
+                getattr(self, name.replace('-', '_'))(*args)
+            else:
+                self.run_hook(name)
+        return self.timeline
+
+    # results
+    @property
+    def restarts(self):
+        return sum(hook.restarts for hook in self.timeline)
+
+    @property
+    def redundant_restarts(self):
+        return sum(hook.redundant_restarts for hook in self.timeline)
+
+    def report(self):
+        row = '{:<36} {:>8} {:>5} {:>6} {:>8} {:>9} {:>7}'
+        lines = [row.format('hook', 'handlers', 'reads', 'writes', 'restarts',
+                            'redundant', 'reloads')]
+        for hook in self.timeline:
+            lines.append(row.format(
+                hook.hook_name, sum(hook.handlers.values()),
+                sum(hook.relation_reads.values()), len(hook.writes),
+                hook.restarts, hook.redundant_restarts, hook.reloads))
+        return '\n'.join(lines)
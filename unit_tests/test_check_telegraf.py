@@ -0,0 +1,71 @@
+"""files/nrpe/check_telegraf.py tests"""
+import importlib.util
+import os
+
+import pytest
+
+
+CHECK_PATH = os.path.join(os.path.dirname(__file__), '..', 'files', 'nrpe',
+                          'check_telegraf.py')
+
+spec = importlib.util.spec_from_file_location('check_telegraf', CHECK_PATH)
+check_telegraf = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(check_telegraf)
+
+
+@pytest.fixture()
+def metrics(monkeypatch):
+    metrics = []
+    monkeypatch.setattr(check_telegraf, 'get_metrics',
+                        lambda port, timeout=5: metrics)
+    return metrics
+
+
+def test_check_errors(metrics, tmpdir, capsys):
+    argv = ['errors', '--state-dir', tmpdir.strpath]
+    metrics.append(('internal_write_errors', {'output': 'influxdb'}, 2))
+    assert check_telegraf.main(argv) == check_telegraf.OK
+    assert capsys.readouterr().out == \
+        'OK: no new write errors in 1 outputs\n'
+    assert check_telegraf.main(argv) == check_telegraf.OK
+    metrics[0] = ('internal_write_errors', {'output': 'influxdb'}, 5)
+    assert check_telegraf.main(argv) == check_telegraf.CRITICAL
+    assert 'influxdb (+3)' in capsys.readouterr().out
+    # telegraf restarted, counting from 0 again
+    metrics[0] = ('internal_write_errors', {'output': 'influxdb'}, 0)
+    assert check_telegraf.main(argv) == check_telegraf.OK
+
+
+def test_check_buffer(metrics, capsys):
+    metrics.extend([
+        ('internal_write_buffer_limit', {'output': 'influxdb'}, 1000),
+        ('internal_write_buffer_size', {'output': 'influxdb'}, 100),
+        ('internal_write_buffer_size', {'output': 'file'}, 850)])
+    argv = ['buffer', '-w', '80', '-c', '95', '--limit', '1000']
+    assert check_telegraf.main(argv) == check_telegraf.WARNING
+    assert capsys.readouterr().out == \
+        'WARNING: buffer usage: file 85%, influxdb 10%\n'
+    metrics[1] = ('internal_write_buffer_size', {'output': 'influxdb'}, 1000)
+    assert check_telegraf.main(argv) == check_telegraf.CRITICAL
+
+
+def test_check_gather(metrics, capsys):
+    metrics.extend([
+        ('internal_gather_gather_time_ns', {'input': 'cpu'}, 1e6),
+        ('internal_gather_gather_time_ns', {'input': 'mongodb'}, 9e9)])
+    argv = ['gather', '-w', '8', '-c', '10']
+    assert check_telegraf.main(argv) == check_telegraf.WARNING
+    assert capsys.readouterr().out == 'WARNING: slow inputs: mongodb 9.0s\n'
+    metrics.append(('internal_gather_gather_time_ns', {'input': 'exec'}, 11e9))
+    assert check_telegraf.main(argv) == check_telegraf.CRITICAL
+    del metrics[1:]
+    assert check_telegraf.main(argv) == check_telegraf.OK
+
+
+def test_check_unknown(monkeypatch, capsys):
+    def get_metrics(port, timeout=5):
+        raise IOError('Connection refused')
+    monkeypatch.setattr(check_telegraf, 'get_metrics', get_metrics)
+    assert check_telegraf.main(['gather']) == check_telegraf.UNKNOWN
+    assert capsys.readouterr().out == \
+        'UNKNOWN: telegraf internal metrics: Connection refused\n'
@@ -0,0 +1,156 @@
+"""hook timeline simulations"""
+import pytest
+
+from charms.reactive import bus
+
+from reactive import telegraf
+
+from .hook_simulator import HookSimulator
+
+
+@pytest.fixture()
+def sim(monkeypatch, tmpdir):
+    simulator = HookSimulator(monkeypatch, tmpdir)
+    yield simulator
+    for state in bus.get_states():
+        bus.remove_state(state)
+
+
+def test_install(sim):
+    install, config_changed, start = sim.install()
+    assert install.handlers['install_telegraf'] == 1
+    assert install.handlers['configure_telegraf'] == 1
+    assert install.restarts == 1
+    # nothing changed after the install hook
+    for hook in (config_changed, start):
+        assert not hook.writes
+        assert hook.restarts == 0
+    assert sim.redundant_restarts == 0
+
+
+def test_fleet_timeline(sim):
+    """A unit related to a large fleet, restarts once per actual change"""
+    units = 20
+    sim.install()
+    for i in range(units):
+        sim.relation_joined('elasticsearch', 'elasticsearch/{}'.format(i),
+                            {'host': '10.0.2.{}'.format(i), 'port': 9200})
+    for i in range(units):
+        sim.relation_joined('influxdb-api', 'influxdb/{}'.format(i),
+                            {'hostname': '10.0.3.{}'.format(i), 'port': 8086,
+                             'user': 'telegraf', 'password': 'secret'})
+    # relation data that doesn't change the config
+    sim.relation_changed('elasticsearch', 'elasticsearch/0',
+                         {'cluster-name': 'es'})
+    sim.config_changed(tags='dc=us-east-1')
+    for _ in range(10):
+        sim.update_status()
+    for i in range(units):
+        sim.relation_departed('elasticsearch', 'elasticsearch/{}'.format(i))
+    assert sim.redundant_restarts == 0, sim.report()
+    # one restart per config change: install, joins, tags and departures
+    assert sim.restarts == 1 + 2 * units + 1 + units, sim.report()
+    assert not sim.tmpdir.join('sim_etc_telegraf', 'telegraf.d',
+                               'elasticsearch.conf').exists()
+    for hook in sim.timeline:
+        if hook.hook_name == 'update-status':
+            assert not hook.writes
+            assert hook.restarts == 0
+            assert not hook.relation_reads
+        if hook.hook_name.startswith('influxdb-api-'):
+            # other relations' data isn't read again
+            assert list(hook.relation_reads) == ['influxdb-api']
+
+
+def test_relation_handlers_gated(sim):
+    """Relation data is only read in the relation's own hooks, and settings
+    are only sent to the related units when the fields they use changed"""
+    sim.install()
+    sim.relation_joined('apache', 'apache/0')
+    sim.relation_joined('postgresql', 'postgresql/0',
+                        {'host': '10.0.0.1', 'user': 'telegraf',
+                         'password': 'secret', 'database': 'telegraf',
+                         'allowed-units': 'telegraf/0',
+                         'private-address': '10.0.0.1'})
+    sim.relation_joined('exec', 'ubuntu/0',
+                        {'commands': [{'commands': ['uptime'],
+                                       'data_format': 'json'}]})
+    sim.relation_joined('listener', 'ubuntu/0', {'transport': 'udp'})
+    sim.relation_joined('prometheus-client', 'prometheus/0')
+    for name in ('apache', 'postgresql', 'exec', 'listener', 'prometheus'):
+        assert sim.tmpdir.join('sim_etc_telegraf', 'telegraf.d').listdir(
+            lambda f: f.basename.startswith(name)), name
+    for _ in range(3):
+        hook = sim.update_status()
+        assert not hook.relation_reads
+        assert not hook.relation_writes
+    # fields the handlers don't use
+    for name, unit in (('apache', 'apache/0'), ('listener', 'ubuntu/0'),
+                       ('postgresql', 'postgresql/0')):
+        hook = sim.relation_changed(name, unit, {'egress-subnets': '10.0.0.0/24'})
+        assert list(hook.relation_reads) == [name]
+        assert not hook.relation_writes
+        assert not hook.writes
+    # a new unit gets the settings
+    hook = sim.relation_joined('apache', 'apache/1')
+    assert hook.relation_writes['apache'] == 1
+    assert sim.redundant_restarts == 0, sim.report()
+
+
+def test_redundant_restart_detected(sim, monkeypatch):
+    sim.install()
+    # a hook restarting telegraf on every run, no matter what changed
+    monkeypatch.setattr('reactive.telegraf.helpers.any_file_changed',
+                        lambda *a, **kw: True)
+    hook = sim.update_status()
+    assert hook.restarts == 1
+    assert hook.redundant_restarts == 1
+    assert 'update-status' in sim.report()
+
+
+def test_invalid_config_rendered_again(sim, monkeypatch):
+    """Files rolled back after a failed config check are rendered again, so
+    the valid changes of the same hook aren't lost"""
+    def validate_config():
+        for path in telegraf.list_active_config_files():
+            with open(path) as fd:
+                if 'inputs.broken' in fd.read():
+                    return 'Error parsing {}'.format(path)
+        return None
+    monkeypatch.setattr(telegraf, 'validate_config', validate_config)
+    configs_dir = sim.tmpdir.join('sim_etc_telegraf', 'telegraf.d')
+    sim.install()
+    sim.relation_joined('influxdb-api', 'influxdb/0',
+                        {'hostname': '10.0.3.1', 'port': 8086,
+                         'user': 'telegraf', 'password': 'secret'})
+    hook = sim.config_changed(routing='influxdb: ["cpu*"]',
+                              extra_plugins='[[inputs.broken]]')
+    assert hook.restarts == 0
+    assert 'namepass' not in configs_dir.join('influxdb-api.conf').read()
+    assert not configs_dir.join('extra_plugins.conf').exists()
+    # still rejected in the next hooks, and rolled back again
+    for _ in range(2):
+        hook = sim.update_status()
+        assert hook.restarts == 0
+        assert not configs_dir.join('extra_plugins.conf').exists()
+    hook = sim.config_changed(extra_plugins='')
+    assert hook.restarts == 1
+    assert 'namepass = ["cpu*"]' in configs_dir.join('influxdb-api.conf').read()
+    assert 'telegraf.config.invalid' not in bus.get_states()
+    assert sim.redundant_restarts == 0, sim.report()
+
+
+def test_run_timeline(sim):
+    timeline = sim.run([
+        ('install',),
+        ('config-changed', {'interval': '20s'}),
+        ('relation-joined', 'exec', 'ubuntu/0',
+         {'commands': [{'commands': ['uptime'], 'data_format': 'json'}]}),
+        ('update-status',),
+        ('relation-departed', 'exec', 'ubuntu/0'),
+    ])
+    assert [hook.hook_name for hook in timeline] == [
+        'install', 'config-changed', 'start', 'config-changed',
+        'exec-relation-joined', 'update-status', 'exec-relation-departed']
+    assert [hook.restarts for hook in timeline] == [1, 0, 0, 1, 1, 0, 1]
+    assert sim.redundant_restarts == 0
@@ -13,7 +13,6 @@ import py
 from charms.reactive import bus, helpers, RelationBase
 from charmhelpers.core import hookenv
 from charmhelpers.core.hookenv import Config
-from charmhelpers.core.templating import render
 
 
 import reactive
@@ -26,6 +25,8 @@ def setup(monkeypatch, tmpdir):
     monkeypatch.setitem(os.environ, 'JUJU_UNIT_NAME', 'telegraf-0')
     monkeypatch.setattr(telegraf, 'get_remote_unit_name', lambda: 'remote-unit-0')
     monkeypatch.setattr(telegraf, 'exec_timeout_supported', lambda: True)
+    # no peers
+    monkeypatch.setattr(telegraf.hookenv, 'relation_ids', lambda *a: [])
     # patch host.write for non-root
     user = getpass.getuser()
     orig_write_file = telegraf.host.write_file
@@ -80,6 +81,9 @@ def temp_config_dir(monkeypatch, tmpdir):
     base_dir = tmpdir.mkdir("etc_telegraf")
     configs_dir = base_dir.mkdir(telegraf.CONFIG_DIR)
     monkeypatch.setattr(telegraf, 'BASE_DIR', base_dir.strpath)
+    systemd_dir = tmpdir.mkdir("systemd").join("telegraf.service.d")
+    monkeypatch.setattr(telegraf, 'SYSTEMD_DROPIN_DIR', systemd_dir.strpath)
+    monkeypatch.setattr(telegraf.host, 'init_is_systemd', lambda: True)
 
 
 @pytest.fixture(autouse=True)
@@ -102,8 +106,10 @@ def configs_dir():
 
 def persist_state():
     """Fake persistent state by calling helpers that modify unitdata.kv"""
-    states = [k for k in bus.get_states().keys()
-              if k.startswith('plugins') or k.startswith('extra_plugins')]
+    states = sorted([k for k in bus.get_states().keys()
+                     if k.startswith('plugins') or k.startswith('extra_plugins')])
+    states += [os.path.basename(path)
+               for path in telegraf.list_extra_plugins_files()]
     helpers.any_file_changed(telegraf.list_config_files())
     if states:
         helpers.data_changed('active_plugins', states)
@@ -117,12 +123,59 @@ def test_get_remote_unit_name(monkeypatch):
     with open(os.path.join(real_charm_dir, 'metadata.yaml')) as md:
         metadata = yaml.safe_load(md)
     monkeypatch.setattr(telegraf.hookenv, 'metadata', lambda: metadata)
-    relations = []
-    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
-    monkeypatch.setattr(telegraf.hookenv, 'unit_private_ip', lambda: '1.2.3.4')
+    monkeypatch.delitem(os.environ, 'JUJU_PRINCIPAL_UNIT', raising=False)
+    relations = {}
+    rel_types = []
+
+    def relations_of_type(rel_type):
+        rel_types.append(rel_type)
+        return relations.get(rel_type, [])
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', relations_of_type)
     assert telegraf.get_remote_unit_name() is None
-    relations = [{'private-address': '1.2.3.4', '__unit__': 'remote-0'}]
+    # only container scoped relations are checked, juju-info first
+    assert rel_types[0] == 'juju-info'
+    assert 'postgresql' not in rel_types
+    assert 'influxdb-api' not in rel_types
+    relations['juju-info'] = [{'private-address': '1.2.3.4', '__unit__': 'remote-0'}]
     assert telegraf.get_remote_unit_name() == 'remote-0'
+    # the name is cached
+    del rel_types[:]
+    relations.clear()
+    assert telegraf.get_remote_unit_name() == 'remote-0'
+    assert rel_types == []
+
+
+def test_get_remote_unit_name_from_env(monkeypatch):
+    monkeypatch.undo()
+    monkeypatch.setitem(os.environ, 'JUJU_PRINCIPAL_UNIT', 'remote/1')
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: 1 / 0)
+    assert telegraf.get_remote_unit_name() == 'remote/1'
+    assert telegraf.unitdata.kv().get('principal_unit') == 'remote/1'
+
+
+def test_hostname_provisional(monkeypatch, config):
+    monkeypatch.setattr(telegraf, 'get_remote_unit_name', lambda: None)
+    telegraf.configure_telegraf()
+    assert 'hostname = ""' in base_dir().join('telegraf.conf').read()
+    assert 'telegraf.configured' in bus.get_states().keys()
+    assert 'telegraf.hostname.resolved' not in bus.get_states().keys()
+    # principal unit still unknown, nothing to do
+    telegraf.update_hostname()
+    assert 'telegraf.configured' in bus.get_states().keys()
+    monkeypatch.setattr(telegraf, 'get_remote_unit_name', lambda: 'remote/0')
+    telegraf.update_hostname()
+    assert 'telegraf.configured' not in bus.get_states().keys()
+    telegraf.configure_telegraf()
+    assert 'hostname = "remote-0"' in base_dir().join('telegraf.conf').read()
+    assert 'telegraf.hostname.resolved' in bus.get_states().keys()
+
+
+def test_hostname_override(monkeypatch, config):
+    config['hostname'] = 'foo'
+    monkeypatch.setattr(telegraf, 'get_remote_unit_name', lambda: None)
+    telegraf.configure_telegraf()
+    assert 'hostname = "foo"' in base_dir().join('telegraf.conf').read()
+    assert 'telegraf.hostname.resolved' in bus.get_states().keys()
 
 
 def test_inputs_config_set(monkeypatch, config):
@@ -177,6 +230,93 @@ def test_outputs_config(monkeypatch, config):
     telegraf.configure_telegraf()
 
 
+def test_get_routing(config):
+    assert telegraf.get_routing() == {}
+    config['routing'] = """
+influxdb: ["postgresql*", "mongodb*"]
+graphite:
+    namedrop: ["postgresql*", "mongodb*"]
+prometheus_client:
+    namepass: cpu
+file: {}
+"""
+    assert telegraf.get_routing() == {
+        'influxdb': {'namepass': ['postgresql*', 'mongodb*']},
+        'graphite': {'namedrop': ['postgresql*', 'mongodb*']},
+        'prometheus_client': {'namepass': ['cpu']}}
+    # extra_options take precedence
+    config['extra_options'] = """
+outputs:
+    influxdb:
+        namepass: ["cpu"]
+        precision: ms
+"""
+    outputs = telegraf.get_extra_options()['outputs']
+    assert outputs['influxdb'] == {'namepass': ['cpu'], 'precision': 'ms'}
+    assert outputs['graphite'] == {'namedrop': ['postgresql*', 'mongodb*']}
+    config['routing'] = "- influxdb"
+    assert telegraf.get_routing() == {}
+    config['routing'] = "influxdb: ["
+    assert telegraf.get_routing() == {}
+
+
+def test_outputs_config_routing(config):
+    config['outputs_config'] = """
+[[outputs.graphite]]
+  servers = ["localhost:2003"]
+  [[outputs.influxdb]] # indented
+    urls = ["http://localhost:8086"]
+"""
+    config['routing'] = """
+graphite:
+    namepass: ["cpu", "mem"]
+    namedrop: ["cpu_cores"]
+"""
+    telegraf.configure_telegraf()
+    expected = """
+[[outputs.graphite]]
+  namedrop = ["cpu_cores"]
+  namepass = ["cpu", "mem"]
+  servers = ["localhost:2003"]
+  [[outputs.influxdb]] # indented
+    urls = ["http://localhost:8086"]
+"""
+    assert expected in base_dir().join('telegraf.conf').read()
+
+
+def test_outputs_config_routing_precedence(config):
+    config['outputs_config'] = """
+[[outputs.graphite]]
+  servers = ["localhost:2003"]
+  namepass = ["mem*"]
+  [outputs.graphite.tagpass]
+    cpu = ["cpu0"]
+[[outputs.file]]
+  files = ["stdout"]
+"""
+    config['routing'] = """
+graphite:
+    namepass: ["cpu*"]
+    namedrop: ["cpu_cores"]
+file: ["disk*"]
+"""
+    telegraf.configure_telegraf()
+    expected = """
+[[outputs.graphite]]
+  namedrop = ["cpu_cores"]
+  servers = ["localhost:2003"]
+  namepass = ["mem*"]
+  [outputs.graphite.tagpass]
+    cpu = ["cpu0"]
+[[outputs.file]]
+  namepass = ["disk*"]
+  files = ["stdout"]
+"""
+    content = base_dir().join('telegraf.conf').read()
+    assert expected in content
+    assert 'cpu*' not in content
+
+
 def test_extra_plugins(config):
     config['extra_plugins'] = """[[inputs.foo]]
     some_option = "http://foo.bar.com"
@@ -187,7 +327,78 @@ def test_extra_plugins(config):
     assert configs_dir().join('extra_plugins.conf').read() == config['extra_plugins']
 
 
-def test_render_extra_options(config):
+def test_extra_plugins_structured(config):
+    config['extra_plugins'] = """
+foo:
+  plugin: inputs.foo
+  some_option: "http://foo.bar.com"
+  tagpass:
+    cpu: ["cpu0"]
+baz: |
+  [[outputs.baz]]
+    option = "enabled"
+"""
+    telegraf.configure_extra_plugins()
+    expected = """
+[[inputs.foo]]
+  some_option = "http://foo.bar.com"
+  [inputs.foo.tagpass]
+    cpu = ["cpu0"]
+"""
+    content = configs_dir().join('extra_plugins-foo.conf').read()
+    assert content.split() == expected.split()
+    expected = """[[outputs.baz]]\n  option = "enabled"\n"""
+    assert configs_dir().join('extra_plugins-baz.conf').read() == expected
+    assert not configs_dir().join('extra_plugins.conf').exists()
+    assert 'extra_plugins.configured' in bus.get_states().keys()
+
+
+def test_extra_plugins_invalid_plugin(config):
+    config['extra_plugins'] = """
+foo:
+  plugin: foo
+  option: 1
+"""
+    telegraf.configure_extra_plugins()
+    assert not configs_dir().join('extra_plugins-foo.conf').exists()
+
+
+def test_extra_plugins_incremental(mocker, config):
+    config['extra_plugins'] = yaml.dump({
+        'foo': {'plugin': 'inputs.foo', 'option': 1},
+        'bar': {'plugin': 'inputs.bar', 'option': 2}})
+    telegraf.configure_extra_plugins()
+    assert configs_dir().join('extra_plugins-foo.conf').exists()
+    assert configs_dir().join('extra_plugins-bar.conf').exists()
+    write_file = mocker.spy(telegraf.host, 'write_file')
+    config['extra_plugins'] = yaml.dump({
+        'foo': {'plugin': 'inputs.foo', 'option': 10},
+        'bar': {'plugin': 'inputs.bar', 'option': 2}})
+    telegraf.configure_extra_plugins()
+    assert write_file.call_count == 1
+    assert write_file.call_args[0][0] == \
+        configs_dir().join('extra_plugins-foo.conf').strpath
+    assert 'option = 10' in configs_dir().join('extra_plugins-foo.conf').read()
+
+
+def test_extra_plugins_cleanup(config):
+    configs_dir().join('extra_plugins.conf').write('[[inputs.old]]')
+    config['extra_plugins'] = yaml.dump({
+        'foo': {'plugin': 'inputs.foo', 'option': 1},
+        'bar': {'plugin': 'inputs.bar', 'option': 2}})
+    telegraf.configure_extra_plugins()
+    assert not configs_dir().join('extra_plugins.conf').exists()
+    config['extra_plugins'] = yaml.dump({
+        'foo': {'plugin': 'inputs.foo', 'option': 1}})
+    telegraf.configure_extra_plugins()
+    assert configs_dir().join('extra_plugins-foo.conf').exists()
+    assert not configs_dir().join('extra_plugins-bar.conf').exists()
+    config['extra_plugins'] = ""
+    telegraf.configure_extra_plugins()
+    assert not configs_dir().join('extra_plugins-foo.conf').exists()
+
+
+def test_plugin_table(config):
     extra_options = """
     inputs:
         test:
@@ -196,9 +407,15 @@ def test_render_extra_options(config):
             list: ["a", "b"]
 """
     config['extra_options'] = extra_options
-    content = telegraf.render_extra_options('inputs', 'test')
-    expected = """  boolean = true\n  list = ["a", "b"]\n  string = "10s"\n"""
-    assert sorted(content.split()) == sorted(expected.split())
+    table = telegraf.plugin_table('inputs', 'test', [('servers', ['a:1'])])
+    expected = """
+[[inputs.test]]
+  servers = ["a:1"]
+  boolean = true
+  list = ["a", "b"]
+  string = "10s"
+"""
+    assert telegraf.render_tables([table]) == expected
 
 
 def test_get_extra_options(config):
@@ -216,11 +433,11 @@ def test_get_extra_options(config):
     expected = {
         "inputs": {
             "test": {
-                "boolean": "true",
-                "string": '"somestring"',
-                "list": '["a", "b"]',
+                "boolean": True,
+                "string": "somestring",
+                "list": ["a", "b"],
                 "tagdrop": {
-                    "tag": '["foo", "bar"]'
+                    "tag": ["foo", "bar"]
                 }
             }
         },
@@ -229,7 +446,21 @@ def test_get_extra_options(config):
     assert extra_opts == expected
 
 
-def test_render_extra_options_override(config):
+def test_get_extra_options_debug_plugins(mocker, config):
+    get_installed_version = mocker.patch(
+        'reactive.telegraf.get_installed_version', return_value='1.31.3-1')
+    config['debug_plugins'] = 'inputs.exec, outputs.influxdb, exec'
+    config['extra_options'] = 'outputs:\n  influxdb:\n    log_level: info'
+    # older telegraf versions don't load configs with log_level
+    assert telegraf.get_extra_options() == {
+        'inputs': {}, 'outputs': {'influxdb': {'log_level': 'info'}}}
+    get_installed_version.return_value = '1.32.0-1'
+    assert telegraf.get_extra_options() == {
+        'inputs': {'exec': {'log_level': 'debug'}},
+        'outputs': {'influxdb': {'log_level': 'info'}}}
+
+
+def test_plugin_table_override(config):
     extra_options = """
     inputs:
         test:
@@ -239,10 +470,55 @@ def test_render_extra_options_override(config):
 """
     config['extra_options'] = extra_options
     # clone extra_options and use a modified version
-    options = {'inputs': {'test': {'string': json.dumps("20s")}}}
-    content = telegraf.render_extra_options('inputs', 'test', extra_options=options)
+    options = {'inputs': {'test': {'string': "20s"}}}
+    table = telegraf.plugin_table('inputs', 'test', [('string', '10s')],
+                                  extra_options=options)
     expected = """  string = "20s"\n"""
-    assert sorted(content.split()) == sorted(expected.split())
+    assert table.render_options() == expected
+
+
+def test_toml_value():
+    assert telegraf.toml_value(True) == 'true'
+    assert telegraf.toml_value(10) == '10'
+    assert telegraf.toml_value(99.9) == '99.9'
+    assert telegraf.toml_value('say "hi"\n') == '"say \\"hi\\"\\n"'
+    assert telegraf.toml_value(['a', 1]) == '["a", 1]'
+    assert telegraf.toml_value({'b': 'x', 'a': 1}) == '{a = 1, b = "x"}'
+
+
+def test_config_table():
+    table = telegraf.ConfigTable('inputs.foo', [
+        ('servers', ['a:1']), ('timeout', None),
+        ('tagpass', {'cpu': ['cpu0']}), ('interval', '10s')],
+        comment="Foo input", comments={'servers': "Foo servers"})
+    expected = """# Foo input
+[[inputs.foo]]
+  # Foo servers
+  servers = ["a:1"]
+  interval = "10s"
+  [inputs.foo.tagpass]
+    cpu = ["cpu0"]
+"""
+    assert table.render() == expected
+    assert telegraf.ConfigTable('agent', [('debug', True)],
+                                array=False).render() == '[agent]\n  debug = true\n'
+    # tables are compared as data, regardless of order and comments
+    other = telegraf.ConfigTable('inputs.foo').update(
+        {'tagpass': {'cpu': ['cpu0']}, 'interval': '10s', 'servers': ['a:1'],
+         'timeout': None})
+    assert table == other
+    other.options['interval'] = '20s'
+    assert table != other
+
+
+def test_plugin_data_changed(config):
+    tables = [telegraf.plugin_table('inputs', 'foo', [('servers', ['a:1'])])]
+    assert telegraf.plugin_data_changed('foo', tables)
+    configs_dir().join('foo.conf').write('')
+    assert not telegraf.plugin_data_changed('foo', tables)
+    config['extra_options'] = "inputs: {foo: {interval: 20s}}"
+    tables = [telegraf.plugin_table('inputs', 'foo', [('servers', ['a:1'])])]
+    assert telegraf.plugin_data_changed('foo', tables)
 
 
 def test_render_base_inputs(config):
@@ -269,25 +545,248 @@ inputs:
     assert content[:len(expected)] == expected
 
 
-def test_check_port(monkeypatch):
-    open_ports = set()
-    monkeypatch.setattr(telegraf.hookenv, 'open_port',
-                        lambda p: open_ports.add(p))
-    telegraf.check_port('test_check_port', 10042)
-    assert 10042 in open_ports
+def test_render_base_inputs_percpu(monkeypatch, config):
+    monkeypatch.setattr(telegraf.os, 'cpu_count', lambda: 8)
+    content = telegraf.render_base_inputs()
+    assert 'percpu = true' in content
+    assert 'cpu_cores' not in content
+    monkeypatch.setattr(telegraf.os, 'cpu_count', lambda: 128)
+    content = telegraf.render_base_inputs()
+    assert 'percpu = false' in content
+    assert 'totalcpu = true' in content
+    assert 'cpu_cores' not in content
+    config['cpu_basicstats'] = True
+    content = telegraf.render_base_inputs()
+    expected = """
+[[inputs.cpu]]
+  name_override = "cpu_cores"
+  percpu = true
+  totalcpu = false
+  drop = ["time_*"]
+  tagexclude = ["cpu"]
+
+[[aggregators.basicstats]]
+  namepass = ["cpu_cores"]
+  period = "10s"
+  drop_original = true
+"""
+    assert expected in content
+    # no threshold
+    config['percpu_max_cores'] = 0
+    content = telegraf.render_base_inputs()
+    assert 'percpu = true' in content
+    assert 'cpu_cores' not in content
+    # unknown number of cores
+    config['percpu_max_cores'] = 32
+    monkeypatch.setattr(telegraf.os, 'cpu_count', lambda: None)
+    assert 'percpu = true' in telegraf.render_base_inputs()
+    # extra_options replace the policy
+    monkeypatch.setattr(telegraf.os, 'cpu_count', lambda: 128)
+    config['extra_options'] = "inputs: {cpu: {percpu: true}}"
+    content = telegraf.render_base_inputs()
+    assert 'percpu = true' in content
+    assert 'cpu_cores' not in content
 
 
-def test_check_port_replace_old_port(monkeypatch):
-    open_ports = set()
-    monkeypatch.setattr(telegraf.hookenv, 'open_port',
-                        lambda p: open_ports.add(p))
-    monkeypatch.setattr(telegraf.hookenv, 'close_port',
-                        lambda p: open_ports.remove(p))
-    telegraf.check_port('test_check_port', 10042)
-    assert 10042 in open_ports
-    telegraf.check_port('test_check_port', 10043)
-    assert 10043 in open_ports
-    assert 10042 not in open_ports
+def test_render_base_inputs_disk_defaults(mocker, config):
+    mocker.patch('reactive.telegraf.get_installed_version',
+                 return_value='1.10.0-1')
+    content = telegraf.render_base_inputs()
+    assert 'ignore_fs = ["tmpfs", "devtmpfs", "devfs", "iso9660", "overlay", ' \
+        '"aufs", "squashfs"]' in content
+    assert 'devices = ["sd*", "vd*", "xvd*", "nvme*", "md*", "dm-*"]' in content
+    assert 'skip_serial_number = true' in content
+    assert 'mount_points =' not in content
+    # extra_options take precedence
+    config['extra_options'] = """
+inputs:
+    disk:
+        ignore_fs: ["tmpfs"]
+    diskio:
+        devices: ["sda"]
+        skip_serial_number: false
+"""
+    content = telegraf.render_base_inputs()
+    assert 'ignore_fs = ["tmpfs"]' in content
+    assert 'devices = ["sda"]' in content
+    assert 'skip_serial_number = false' in content
+    config['extra_options'] = ""
+    config['disk_ignore_fs'] = ""
+    config['diskio_devices'] = ""
+    config['diskio_skip_serial_number'] = False
+    content = telegraf.render_base_inputs()
+    assert 'ignore_fs =' not in content
+    assert 'devices =' not in content
+    assert 'skip_serial_number =' not in content
+
+
+def test_render_base_inputs_disk_autodiscover(monkeypatch, tmpdir, config):
+    mounts = tmpdir.join('mounts')
+    mounts.write("""sysfs /sys sysfs rw,nosuid,nodev,noexec,relatime 0 0
+proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0
+/dev/sda1 / ext4 rw,relatime,data=ordered 0 0
+tmpfs /run tmpfs rw,nosuid,noexec,relatime,size=1635300k,mode=755 0 0
+/dev/loop0 /snap/core/4917 squashfs ro,nodev,relatime 0 0
+/dev/sdb1 /srv/data\\040dir xfs rw,relatime 0 0
+/dev/sda1 /var/lib/docker/plugins ext4 rw,relatime,data=ordered 0 0
+overlay /var/lib/docker/overlay2/x/merged overlay rw,relatime 0 0
+""")
+    sys_block = tmpdir.mkdir('block')
+    for dev in ('loop0', 'loop1', 'ram0', 'sda', 'sdb', 'nvme0n1'):
+        sys_block.mkdir(dev)
+    monkeypatch.setattr(telegraf, 'PROC_MOUNTS', mounts.strpath)
+    monkeypatch.setattr(telegraf, 'SYS_BLOCK', sys_block.strpath)
+    config['disk_autodiscover'] = True
+    content = telegraf.render_base_inputs()
+    assert 'mount_points = ["/", "/srv/data dir", "/var/lib/docker/plugins"]' \
+        in content
+    assert 'devices = ["nvme0n1", "sda", "sdb"]' in content
+    # everything without an allowlist
+    config['diskio_devices'] = ""
+    content = telegraf.render_base_inputs()
+    assert 'devices = ["loop0", "loop1", "nvme0n1", "ram0", "sda", "sdb"]' \
+        in content
+    # discovery failed, keep the filters
+    monkeypatch.setattr(telegraf, 'get_installed_version',
+                        lambda package: '1.10.0-1')
+    monkeypatch.setattr(telegraf, 'PROC_MOUNTS', tmpdir.join('missing').strpath)
+    monkeypatch.setattr(telegraf, 'SYS_BLOCK', tmpdir.join('missing').strpath)
+    config['diskio_devices'] = "sd*"
+    content = telegraf.render_base_inputs()
+    assert 'mount_points =' not in content
+    assert 'devices = ["sd*"]' in content
+
+
+def test_render_base_inputs_diskio_no_globs(mocker, monkeypatch, tmpdir,
+                                            config):
+    mocker.patch('reactive.telegraf.get_installed_version',
+                 return_value='1.9.1-1')
+    sys_block = tmpdir.mkdir('block')
+    for dev in ('loop0', 'sda', 'sdb', 'dm-0'):
+        sys_block.mkdir(dev)
+    monkeypatch.setattr(telegraf, 'SYS_BLOCK', sys_block.strpath)
+    content = telegraf.render_base_inputs()
+    assert 'devices = ["dm-0", "sda", "sdb"]' in content
+    # device names are kept as they are
+    config['diskio_devices'] = "sda,sdc"
+    content = telegraf.render_base_inputs()
+    assert 'devices = ["sda", "sdc"]' in content
+    # nothing matching, gather all the devices rather than none
+    config['diskio_devices'] = "nvme*"
+    content = telegraf.render_base_inputs()
+    assert 'devices =' not in content
+
+
+def sockstat(tmpdir, tcp=4, tw=0, udp=0, tcp6=0):
+    """Fake /proc/net/sockstat files"""
+    tmpdir.join('sockstat').write("""sockets: used 18
+TCP: inuse {} orphan 0 tw {} alloc 4 mem 0
+UDP: inuse {} mem 0
+UDPLITE: inuse 0
+RAW: inuse 0
+FRAG: inuse 0 memory 0
+""".format(tcp, tw, udp))
+    tmpdir.join('sockstat6').write("""TCP6: inuse {}
+UDP6: inuse 0
+UDPLITE6: inuse 0
+RAW6: inuse 0
+FRAG6: inuse 0 memory 0
+""".format(tcp6))
+    return (tmpdir.join('sockstat').strpath, tmpdir.join('sockstat6').strpath)
+
+
+def test_count_sockets(monkeypatch, tmpdir):
+    monkeypatch.setattr(telegraf, 'PROC_SOCKSTAT',
+                        sockstat(tmpdir, tcp=100, tw=50, udp=3, tcp6=7))
+    assert telegraf.count_sockets() == 160
+    monkeypatch.setattr(telegraf, 'PROC_SOCKSTAT', (tmpdir.join('missing').strpath,))
+    assert telegraf.count_sockets() is None
+
+
+def test_render_base_inputs_netstat(monkeypatch, tmpdir, config):
+    monkeypatch.setattr(telegraf, 'PROC_SOCKSTAT', sockstat(tmpdir, tcp=100))
+    kv = telegraf.unitdata.kv()
+    content = telegraf.render_base_inputs()
+    assert '[[inputs.netstat]]' in content
+    assert '[[inputs.nstat]]' not in content
+    assert kv.get('netstat_mode') == 'netstat (100 sockets)'
+    assert telegraf.get_status_message() == ''
+    # a load balancer
+    monkeypatch.setattr(telegraf, 'PROC_SOCKSTAT',
+                        sockstat(tmpdir, tcp=40000, tw=100000))
+    content = telegraf.render_base_inputs()
+    assert '[[inputs.netstat]]' not in content
+    assert '[[inputs.nstat]]' in content
+    assert telegraf.get_status_message('slow inputs: cpu') == \
+        'slow inputs: cpu; netstat: nstat (140000 sockets)'
+    config['netstat_mode'] = 'slow'
+    content = telegraf.render_base_inputs()
+    assert '[[inputs.netstat]]\n  interval = "5m"\n' in content
+    assert telegraf.get_status_message() == 'netstat: slow'
+    config['netstat_mode'] = 'off'
+    content = telegraf.render_base_inputs()
+    assert 'netstat]]' not in content
+    assert 'nstat]]' not in content
+    config['netstat_mode'] = 'netstat'
+    content = telegraf.render_base_inputs()
+    assert '[[inputs.netstat]]\n\n' in content
+    assert telegraf.get_status_message() == ''
+
+
+def test_set_port(mocker):
+    kv = telegraf.unitdata.kv()
+    kv_set = mocker.spy(kv, 'set')
+    telegraf.set_port('test_set_port', 10042)
+    assert kv.get('ports') == {'test_set_port': '10042/tcp'}
+    # setting the same port again doesn't touch unitdata
+    telegraf.set_port('test_set_port', 10042)
+    assert kv_set.call_count == 1
+    telegraf.set_port('test_set_port', 10043, protocol='UDP')
+    assert kv.get('ports') == {'test_set_port': '10043/udp'}
+    telegraf.set_port('test_set_port', False)
+    assert kv.get('ports') == {}
+    telegraf.set_port('test_set_port', None)
+    assert kv_set.call_count == 3
+
+
+def test_update_ports(monkeypatch):
+    open_ports = set(['10042/tcp', '10050/tcp'])
+    calls = []
+
+    def open_port(port, protocol):
+        calls.append(('open-port', port))
+        open_ports.add('{}/{}'.format(port, protocol.lower()))
+
+    def close_port(port, protocol):
+        calls.append(('close-port', port))
+        open_ports.remove('{}/{}'.format(port, protocol.lower()))
+
+    monkeypatch.setattr(telegraf.hookenv, 'opened_ports',
+                        lambda: sorted(p.upper() for p in open_ports))
+    monkeypatch.setattr(telegraf.hookenv, 'open_port', open_port)
+    monkeypatch.setattr(telegraf.hookenv, 'close_port', close_port)
+    telegraf.set_port('test_update_ports', 10042)
+    telegraf.set_port('test_update_ports_udp', 10043, protocol='UDP')
+    telegraf.update_ports()
+    assert open_ports == set(['10042/tcp', '10043/udp'])
+    assert calls == [('close-port', '10050'), ('open-port', '10043')]
+    # replace a port
+    telegraf.set_port('test_update_ports', 10044)
+    telegraf.update_ports()
+    assert open_ports == set(['10043/udp', '10044/tcp'])
+
+
+def test_update_ports_unchanged(monkeypatch):
+    opened_ports = []
+    monkeypatch.setattr(telegraf.hookenv, 'opened_ports',
+                        lambda: opened_ports.append(1) or [])
+    monkeypatch.setattr(telegraf.hookenv, 'open_port', lambda p, proto: None)
+    telegraf.set_port('test_update_ports', 10042)
+    telegraf.update_ports()
+    assert len(opened_ports) == 1
+    telegraf.set_port('test_update_ports', 10042)
+    telegraf.update_ports()
+    assert len(opened_ports) == 1
 
 
 def test_get_prometheus_port(monkeypatch, config):
@@ -313,6 +812,45 @@ def test_prometheus_global(monkeypatch, config):
 """
     config_file = base_dir().join('telegraf.conf')
     assert expected in config_file.read()
+    assert telegraf.unitdata.kv().get('ports') == {'prometheus_output': '9103/tcp'}
+
+
+def test_prometheus_global_options(monkeypatch, config):
+    monkeypatch.setattr(telegraf.hookenv, 'open_port', lambda p: None)
+    config['prometheus_output_port'] = 'default'
+    config['prometheus_expiration_interval'] = '30s'
+    config['prometheus_collectors_exclude'] = 'gocollector,process'
+    config['prometheus_string_as_label'] = False
+    config['prometheus_path'] = '/telegraf'
+    config['extra_options'] = """
+outputs:
+  prometheus_client:
+    expiration_interval: 5m
+"""
+    telegraf.configure_telegraf()
+    expected = """
+[[outputs.prometheus_client]]
+  listen = ":9103"
+  collectors_exclude = ["gocollector", "process"]
+  expiration_interval = "5m"
+  path = "/telegraf"
+  string_as_label = false
+"""
+    config_file = base_dir().join('telegraf.conf')
+    assert expected in config_file.read()
+
+
+def test_prometheus_global_routing(monkeypatch, config):
+    monkeypatch.setattr(telegraf.hookenv, 'open_port', lambda p: None)
+    config['prometheus_output_port'] = 'default'
+    config['routing'] = "prometheus_client: ['cpu', 'mem']"
+    telegraf.configure_telegraf()
+    expected = """
+[[outputs.prometheus_client]]
+  listen = ":9103"
+  namepass = ["cpu", "mem"]
+"""
+    assert expected in base_dir().join('telegraf.conf').read()
 
 
 def test_prometheus_global_with_extra_options(monkeypatch, config):
@@ -343,6 +881,345 @@ outputs:
     assert expected in config_file.read()
 
 
+def test_validate_config(mocker, config):
+    mocker.patch('reactive.telegraf.shutil.which', return_value='/usr/bin/telegraf')
+    check_output = mocker.patch('reactive.telegraf.subprocess.check_output')
+    assert telegraf.validate_config() is None
+    check_output.assert_called_once_with(
+        ['/usr/bin/telegraf', '--config', telegraf.get_main_config_path(),
+         '--config-directory', telegraf.get_configs_dir(), '--test'],
+        stderr=telegraf.subprocess.STDOUT, timeout=30)
+    check_output.side_effect = telegraf.subprocess.CalledProcessError(
+        1, 'telegraf', output=b'Error parsing telegraf.conf')
+    assert telegraf.validate_config() == 'Error parsing telegraf.conf'
+    check_output.side_effect = telegraf.subprocess.TimeoutExpired('telegraf', 30)
+    assert telegraf.validate_config() is None
+
+
+def test_validate_config_disabled(mocker, config):
+    mocker.patch('reactive.telegraf.shutil.which', return_value='/usr/bin/telegraf')
+    check_output = mocker.patch('reactive.telegraf.subprocess.check_output')
+    config['config_check_timeout'] = 0
+    assert telegraf.validate_config() is None
+    assert not check_output.called
+
+
+def test_validate_config_not_installed(mocker, config):
+    mocker.patch('reactive.telegraf.shutil.which', return_value=None)
+    check_output = mocker.patch('reactive.telegraf.subprocess.check_output')
+    assert telegraf.validate_config() is None
+    assert not check_output.called
+
+
+def test_restore_last_good_config(config):
+    bus.set_state('plugins.exec.configured')
+    base_dir().join('telegraf.conf').write('good')
+    configs_dir().join('exec.conf').write('good exec')
+    configs_dir().join('telegraf-b-3-exec.conf').write('other exec')
+    telegraf.save_last_good_config()
+    base_dir().join('telegraf.conf').write('bad')
+    configs_dir().join('exec.conf').remove()
+    bus.set_state('plugins.apache.configured')
+    configs_dir().join('apache.conf').write('bad apache')
+    # files of other units in the machine aren't reverted
+    configs_dir().join('telegraf-b-3-exec.conf').write('new other exec')
+    configs_dir().join('telegraf-b-3-apache.conf').write('other apache')
+    assert telegraf.restore_last_good_config() == {
+        base_dir().join('telegraf.conf').strpath: 'telegraf.configured',
+        configs_dir().join('apache.conf').strpath: 'plugins.apache.configured',
+        configs_dir().join('exec.conf').strpath: 'plugins.exec.configured'}
+    assert base_dir().join('telegraf.conf').read() == 'good'
+    assert configs_dir().join('exec.conf').read() == 'good exec'
+    assert not configs_dir().join('apache.conf').exists()
+    assert configs_dir().join('telegraf-b-3-exec.conf').read() == 'new other exec'
+    assert configs_dir().join('telegraf-b-3-apache.conf').read() == 'other apache'
+
+
+def test_restore_last_good_config_not_owner(config):
+    register_unit('telegraf-b/3')
+    bus.set_state('plugins.exec.configured')
+    base_dir().join('telegraf.conf').write('good')
+    configs_dir().join('exec.conf').write('owner exec')
+    telegraf.save_last_good_config()
+    base_dir().join('telegraf.conf').write('owner changes')
+    configs_dir().join('exec.conf').remove()
+    configs_dir().join('telegraf-0-exec.conf').write('bad exec')
+    assert telegraf.restore_last_good_config() == {
+        configs_dir().join('telegraf-0-exec.conf').strpath:
+            'plugins.exec.configured'}
+    assert base_dir().join('telegraf.conf').read() == 'owner changes'
+    assert not configs_dir().join('exec.conf').exists()
+    assert not configs_dir().join('telegraf-0-exec.conf').exists()
+
+
+def test_reset_restored_config(mocker, config):
+    atexit = mocker.patch('reactive.telegraf.hookenv.atexit')
+    telegraf.helpers.data_changed('plugins.exec.data', ['exec'])
+    telegraf.helpers.data_changed('plugins.exec.relation', ['uptime'])
+    telegraf.helpers.data_changed('extra_plugins.extra_plugins-foo.conf', 'foo')
+    telegraf.helpers.data_changed('plugins.apache.data', ['apache'])
+    for state in ('telegraf.configured', 'plugins.exec.configured',
+                  'plugins.apache.configured', 'extra_plugins.configured'):
+        bus.set_state(state)
+    telegraf.reset_restored_config({
+        configs_dir().join('exec.conf').strpath: 'plugins.exec.configured',
+        configs_dir().join('extra_plugins-foo.conf').strpath:
+            'extra_plugins.configured'})
+    assert telegraf.helpers.data_changed('plugins.exec.data', ['exec'])
+    assert telegraf.helpers.data_changed('plugins.exec.relation', ['uptime'])
+    assert telegraf.helpers.data_changed(
+        'extra_plugins.extra_plugins-foo.conf', 'foo')
+    assert not telegraf.helpers.data_changed('plugins.apache.data', ['apache'])
+    # the states are removed at the end of the hook
+    assert 'plugins.exec.configured' in bus.get_states()
+    atexit.call_args[0][0]()
+    states = bus.get_states()
+    for state in ('telegraf.configured', 'plugins.exec.configured',
+                  'extra_plugins.configured'):
+        assert state not in states
+    assert 'plugins.apache.configured' in states
+
+
+def test_restore_last_good_config_missing(config):
+    base_dir().join('telegraf.conf').write('bad')
+    assert telegraf.restore_last_good_config() is None
+    assert base_dir().join('telegraf.conf').read() == 'bad'
+
+
+def test_get_metric_buffer_limit(config):
+    assert telegraf.get_metric_buffer_limit() == 10000
+    config['memory_max'] = '1G'
+    assert telegraf.get_metric_buffer_limit() == 10000
+    config['memory_max'] = '8M'
+    assert telegraf.get_metric_buffer_limit() == 4096
+    telegraf.configure_telegraf()
+    assert 'metric_buffer_limit = 4096' in base_dir().join('telegraf.conf').read()
+    config['memory_max'] = 'infinity'
+    assert telegraf.get_metric_buffer_limit() == 10000
+    # an invalid memory_max doesn't cap it, the unit is blocked instead
+    config['memory_max'] = '8 megs'
+    assert telegraf.get_metric_buffer_limit() == 10000
+    assert telegraf.get_config_error() == 'Invalid memory_max: 8 megs'
+
+
+def test_parse_size(monkeypatch, tmpdir):
+    meminfo = tmpdir.join('meminfo')
+    meminfo.write('MemTotal:        8192 kB\nMemFree:         1024 kB\n')
+    monkeypatch.setattr(telegraf, 'PROC_MEMINFO', meminfo.strpath)
+    assert telegraf.parse_size('512') == 512
+    assert telegraf.parse_size('1.5K') == 1536
+    assert telegraf.parse_size('2g') == 2 * 1024 ** 3
+    assert telegraf.parse_size('50%') == 4096 * 1024
+    assert telegraf.parse_size('infinity') is None
+    with pytest.raises(ValueError):
+        telegraf.parse_size('lots')
+
+
+def test_start_or_restart_config_error(mocker, config):
+    mocker.patch('reactive.telegraf.host.service_restart')
+    mocker.patch('reactive.telegraf.validate_config', return_value=None)
+    status_set = mocker.patch('reactive.telegraf.hookenv.status_set')
+    config['memory_max'] = 'lots'
+    bus.set_state('telegraf.installed')
+    bus.set_state('telegraf.configured')
+    telegraf.configure_systemd()
+    telegraf.start_or_restart()
+    status_set.assert_called_once_with('blocked', 'Invalid memory_max: lots')
+    assert not os.path.exists(telegraf.get_systemd_dropin_path())
+
+
+def test_configure_systemd(mocker, config):
+    check_call = mocker.patch('reactive.telegraf.subprocess.check_call')
+    dropin = py.path.local(telegraf.get_systemd_dropin_path())
+    # nothing set, no drop-in
+    telegraf.configure_systemd()
+    assert not dropin.exists()
+    assert not check_call.called
+    config['memory_max'] = '256M'
+    config['cpu_quota'] = '50%'
+    config['nice'] = 10
+    config['io_scheduling_class'] = 'idle'
+    config['gomaxprocs'] = 2
+    telegraf.configure_systemd()
+    expected = """
+# This file is managed by Juju. Do not make local changes.
+[Service]
+# MemoryLimit is the pre-231 systemd name of MemoryMax
+MemoryLimit=256M
+MemoryMax=256M
+CPUQuota=50%
+Nice=10
+IOSchedulingClass=idle
+Environment=GOMAXPROCS=2
+"""
+    assert [line for line in dropin.read().splitlines() if line] == \
+        [line for line in expected.splitlines() if line]
+    check_call.assert_called_once_with(['systemctl', 'daemon-reload'])
+    assert dropin.strpath in telegraf.list_config_files()
+    # unchanged, no daemon-reload
+    check_call.reset_mock()
+    telegraf.configure_systemd()
+    assert not check_call.called
+    # all unset, drop-in removed
+    config['memory_max'] = config['cpu_quota'] = config['io_scheduling_class'] = ''
+    config['nice'] = config['gomaxprocs'] = 0
+    telegraf.configure_systemd()
+    assert not dropin.exists()
+    check_call.assert_called_once_with(['systemctl', 'daemon-reload'])
+
+
+def test_configure_systemd_not_systemd(mocker, monkeypatch, config):
+    check_call = mocker.patch('reactive.telegraf.subprocess.check_call')
+    monkeypatch.setattr(telegraf.host, 'init_is_systemd', lambda: False)
+    config['memory_max'] = '256M'
+    telegraf.configure_systemd()
+    assert not os.path.exists(telegraf.get_systemd_dropin_path())
+    assert not check_call.called
+    assert 'telegraf.systemd.configured' in bus.get_states().keys()
+
+
+def register_unit(unit, registered=0):
+    """Register another telegraf unit in the machine"""
+    units_dir = base_dir().join(telegraf.MACHINE_UNITS_DIR)
+    units_dir.ensure(dir=True)
+    units_dir.join(unit.replace('/', '-')).write(
+        json.dumps({'unit': unit, 'registered': registered}))
+
+
+def test_machine_units(monkeypatch):
+    assert telegraf.get_config_prefix() == ''
+    assert telegraf.list_machine_units() == ['telegraf-0']
+    assert telegraf.is_machine_owner()
+    assert telegraf.get_plugin_config_path('exec') == \
+        configs_dir().join('exec.conf').strpath
+    # another unit deployed in the same machine
+    monkeypatch.setitem(os.environ, 'JUJU_UNIT_NAME', 'telegraf-b/3')
+    monkeypatch.setattr(telegraf.unitdata, '_KV', None)
+    monkeypatch.setitem(os.environ, 'UNIT_STATE_DB',
+                        base_dir().join('unit-3.db').strpath)
+    assert telegraf.get_config_prefix() == 'telegraf-b-3-'
+    assert telegraf.list_machine_units() == ['telegraf-0', 'telegraf-b/3']
+    assert not telegraf.is_machine_owner()
+    assert telegraf.get_plugin_config_path('exec') == \
+        configs_dir().join('telegraf-b-3-exec.conf').strpath
+    # the prefix doesn't change when the first unit is removed
+    base_dir().join(telegraf.MACHINE_UNITS_DIR, 'telegraf-0').remove()
+    assert telegraf.is_machine_owner()
+    assert telegraf.get_config_prefix() == 'telegraf-b-3-'
+
+
+def test_machine_slot(monkeypatch):
+    register_unit('telegraf-b/3')
+    base_dir().join(telegraf.MACHINE_UNITS_DIR, 'telegraf-c-1').write(
+        json.dumps({'unit': 'telegraf-c/1', 'registered': 1, 'slot': 1}))
+    assert telegraf.get_machine_slot() == 2
+    info = json.loads(base_dir().join(telegraf.MACHINE_UNITS_DIR,
+                                      'telegraf-0').read())
+    assert info['slot'] == 2
+    # the slot doesn't change when other units leave
+    base_dir().join(telegraf.MACHINE_UNITS_DIR, 'telegraf-c-1').remove()
+    assert telegraf.get_machine_slot() == 2
+
+
+def test_listener_input_colocated(mocker, monkeypatch, config):
+    monkeypatch.setattr(telegraf, 'LISTENER_SOCKET_DIR', '/var/lib/telegraf')
+    monkeypatch.setattr(telegraf.hookenv, 'open_port', lambda p: None)
+    mocker.patch('reactive.telegraf.host.mkdir')
+    register_unit('telegraf-b/3')
+    interface = mocker.Mock(spec=RelationBase)
+    interface.users = mocker.Mock(return_value=[])
+    interface.listeners = mocker.Mock(
+        return_value=[('unix', 'influx'), ('udp', 'json')])
+    interface.configure = mocker.Mock()
+    telegraf.listener_input(interface)
+    interface.configure.assert_called_once_with({
+        ('udp', 'json'): '127.0.0.1:{}'.format(
+            8094 + telegraf.LISTENER_PORTS_PER_UNIT),
+        ('unix', 'influx'): '/var/lib/telegraf/telegraf-0-listener-influx.sock'})
+    telegraf.prometheus_client(interface)
+    assert 'listen = ":9127"' in \
+        configs_dir().join('telegraf-0-prometheus-client.conf').read()
+
+
+def test_unregister_unit(mocker, config):
+    atexit = mocker.patch('reactive.telegraf.hookenv.atexit')
+    telegraf.get_config_prefix()
+    telegraf.unregister_unit()
+    atexit.assert_called_once_with(telegraf.remove_unit_config)
+    telegraf.remove_unit_config()
+    assert telegraf.list_machine_units() == []
+    # hooks after the stop one don't register the unit back
+    telegraf.get_plugin_config_path('exec')
+    assert telegraf.list_machine_units() == []
+
+
+def test_configure_telegraf_not_owner(mocker, config):
+    register_unit('telegraf-b/3')
+    configure_systemd = mocker.patch('reactive.telegraf.subprocess.check_call')
+    config['memory_max'] = '256M'
+    config['statsd_port'] = 'default'
+    telegraf.configure_telegraf()
+    telegraf.configure_systemd()
+    telegraf.configure_statsd()
+    assert not base_dir().join('telegraf.conf').exists()
+    assert not os.path.exists(telegraf.get_systemd_dropin_path())
+    assert not configs_dir().join('statsd.conf').exists()
+    assert not configure_systemd.called
+    assert 'telegraf.configured' in bus.get_states()
+    assert 'telegraf.systemd.configured' in bus.get_states()
+    assert 'plugins.statsd.configured' not in bus.get_states()
+
+
+def test_install_not_owner(mocker, monkeypatch, config):
+    register_unit('telegraf-b/3')
+    mocker.patch('reactive.telegraf.get_installed_version', return_value='1.4.0-1')
+    apt_install = mocker.patch('reactive.telegraf.apt_install')
+    mocker.patch('reactive.telegraf.add_source')
+    mocker.patch('reactive.telegraf.apt_update')
+    mocker.patch('reactive.telegraf.get_package_file', return_value=None)
+    telegraf.install_telegraf()
+    assert not apt_install.called
+    assert telegraf.unitdata.kv().get('install')['source'] == 'installed'
+
+
+def test_check_machine_owner(config):
+    register_unit('telegraf-b/3')
+    telegraf.check_machine_owner()
+    bus.set_state('telegraf.configured')
+    bus.set_state('telegraf.systemd.configured')
+    telegraf.check_machine_owner()
+    assert 'telegraf.configured' in bus.get_states()
+    # the owner is removed, take over
+    base_dir().join(telegraf.MACHINE_UNITS_DIR, 'telegraf-b-3').remove()
+    telegraf.check_machine_owner()
+    assert 'telegraf.configured' not in bus.get_states()
+    assert 'telegraf.systemd.configured' not in bus.get_states()
+
+
+def test_remove_unit_config(mocker, monkeypatch, config):
+    service_restart = mocker.patch('reactive.telegraf.host.service_restart')
+    register_unit('telegraf-b/3')
+    assert telegraf.get_config_prefix() == 'telegraf-0-'
+    configs_dir().join('exec.conf').write('owner')
+    configs_dir().join('telegraf-0-exec.conf').write('removed')
+    base_dir().join('telegraf.conf').write('main')
+    bus.set_state('plugins.exec.configured')
+    telegraf.remove_unit_config()
+    assert not configs_dir().join('telegraf-0-exec.conf').exists()
+    assert configs_dir().join('exec.conf').exists()
+    assert base_dir().join('telegraf.conf').exists()
+    service_restart.assert_called_once_with('telegraf')
+    assert telegraf.list_machine_units() == ['telegraf-b/3']
+    # the last unit of the machine leaves the config alone
+    base_dir().join(telegraf.MACHINE_UNITS_DIR, 'telegraf-b-3').remove()
+    telegraf.get_config_prefix()
+    configs_dir().join('telegraf-0-exec.conf').write('last')
+    telegraf.remove_unit_config()
+    assert configs_dir().join('telegraf-0-exec.conf').exists()
+    assert service_restart.call_count == 1
+    assert telegraf.list_machine_units() == []
+
+
 # Plugin tests
 
 
@@ -364,6 +1241,158 @@ def test_elasticsearch_input_no_relations(monkeypatch):
     assert not configs_dir().join('elasticsearch.conf').exists()
 
 
+def test_elasticsearch_input_unchanged(mocker, monkeypatch, config):
+    relations = [{'host': '1.2.3.4', 'port': 1234}]
+    relations_of_type = mocker.Mock(return_value=relations)
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', relations_of_type)
+    monkeypatch.setattr(telegraf.hookenv, 'hook_name',
+                        lambda: 'elasticsearch-relation-changed')
+    write_file = mocker.spy(telegraf.host, 'write_file')
+    telegraf.elasticsearch_input('test')
+    assert write_file.call_count == 1
+    # same relation data, nothing written
+    telegraf.elasticsearch_input('test')
+    assert write_file.call_count == 1
+    assert relations_of_type.call_count == 2
+    # unrelated hook, relation data isn't even read
+    monkeypatch.setattr(telegraf.hookenv, 'hook_name', lambda: 'update-status')
+    telegraf.elasticsearch_input('test')
+    assert relations_of_type.call_count == 2
+    # the relation data changed
+    monkeypatch.setattr(telegraf.hookenv, 'hook_name',
+                        lambda: 'elasticsearch-relation-changed')
+    relations.append({'host': '1.2.3.5', 'port': 1234})
+    telegraf.elasticsearch_input('test')
+    assert write_file.call_count == 2
+    assert '1.2.3.5' in configs_dir().join('elasticsearch.conf').read()
+
+
+def test_elasticsearch_input_extra_options_changed(mocker, monkeypatch, config):
+    relations = [{'host': '1.2.3.4', 'port': 1234}]
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
+    monkeypatch.setattr(telegraf.hookenv, 'hook_name', lambda: 'config-changed')
+    write_file = mocker.spy(telegraf.host, 'write_file')
+    telegraf.elasticsearch_input('test')
+    assert write_file.call_count == 1
+    # extra_options changed for another plugin, no need to write
+    bus.remove_state('plugins.elasticsearch.configured')
+    config['extra_options'] = yaml.dump({'inputs': {'haproxy': {'timeout': 10}}})
+    telegraf.elasticsearch_input('test')
+    assert write_file.call_count == 1
+    assert 'plugins.elasticsearch.configured' in bus.get_states().keys()
+    bus.remove_state('plugins.elasticsearch.configured')
+    config['extra_options'] = yaml.dump({'inputs': {'elasticsearch': {'local': False}}})
+    telegraf.elasticsearch_input('test')
+    assert write_file.call_count == 2
+    assert 'local = false' in configs_dir().join('elasticsearch.conf').read()
+
+
+def fake_peers(monkeypatch, local_unit, peers):
+    """peers maps the unit names to their data in the peer relation"""
+    settings = {}
+    monkeypatch.setattr(telegraf.hookenv, 'local_unit', lambda: local_unit)
+    monkeypatch.setattr(telegraf.hookenv, 'relation_ids', lambda n: ['peers:0'])
+    monkeypatch.setattr(telegraf.hookenv, 'related_units',
+                        lambda rid: sorted(u for u in peers if u != local_unit))
+    monkeypatch.setattr(telegraf.hookenv, 'relation_get',
+                        lambda key, unit, rid: peers[unit].get(key))
+    monkeypatch.setattr(telegraf.hookenv, 'relation_set',
+                        lambda rid, relation_settings: settings.update(relation_settings))
+    return settings
+
+
+def test_is_cluster_collector(monkeypatch):
+    peers = dict(('telegraf/{}'.format(i), {'elasticsearch-cluster': 'es'})
+                 for i in range(5))
+    peers['telegraf/5'] = {'elasticsearch-cluster': 'other-es'}
+
+    def elected():
+        units = []
+        for unit in sorted(peers):
+            fake_peers(monkeypatch, unit, peers)
+            cluster = peers[unit]['elasticsearch-cluster']
+            if telegraf.is_cluster_collector('elasticsearch', cluster):
+                units.append(unit)
+        return units
+    collectors = elected()
+    assert len(collectors) == 2
+    assert 'telegraf/5' in collectors
+    # hand-off when the elected unit departs
+    collector = collectors[0]
+    del peers[collector]
+    new_collectors = elected()
+    assert len(new_collectors) == 2
+    assert collector not in new_collectors
+    # the others don't change when an unelected unit departs
+    del peers[[u for u in peers if u not in new_collectors][0]]
+    assert elected() == new_collectors
+
+
+def test_elasticsearch_input_cluster_stats(monkeypatch, config):
+    relations = [{'host': '1.2.3.4', 'port': 1234, '__unit__': 'es/1'}]
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
+    config['elasticsearch_cluster_stats'] = True
+    config['extra_options'] = """
+inputs:
+  elasticsearch:
+    cluster_health_level: cluster
+    http_timeout: 10s
+"""
+    peers = {'telegraf/0': {'elasticsearch-cluster': 'es'},
+             'telegraf/1': {'elasticsearch-cluster': 'es'}}
+    collector = None
+    for unit in sorted(peers):
+        settings = fake_peers(monkeypatch, unit, peers)
+        bus.remove_state('plugins.elasticsearch.configured')
+        telegraf.elasticsearch_input('test')
+        assert settings == {'elasticsearch-cluster': 'es'}
+        content = configs_dir().join('elasticsearch.conf').read()
+        assert 'http_timeout = "10s"' in content
+        if 'cluster_health = true' in content:
+            assert 'cluster_stats = true' in content
+            assert 'cluster_health_level = "cluster"' in content
+            assert collector is None
+            collector = unit
+        else:
+            assert 'cluster_' not in content
+            other = unit
+    assert collector is not None
+    # the elected unit departs, the other one takes over in the peer hook
+    fake_peers(monkeypatch, other, {other: peers[other]})
+    monkeypatch.setattr(telegraf.hookenv, 'hook_name',
+                        lambda: 'peers-relation-departed')
+    telegraf.elasticsearch_input('test')
+    content = configs_dir().join('elasticsearch.conf').read()
+    assert 'cluster_health = true' in content
+
+
+def test_elasticsearch_input_departed(monkeypatch, config):
+    settings = fake_peers(monkeypatch, 'telegraf/0', {})
+    configs_dir().join('elasticsearch.conf').write('empty')
+    bus.set_state('plugins.elasticsearch.configured')
+    telegraf.elasticsearch_input_departed()
+    assert not configs_dir().join('elasticsearch.conf').exists()
+    assert 'plugins.elasticsearch.configured' not in bus.get_states()
+    assert settings == {'elasticsearch-cluster': ''}
+
+
+def test_influxdb_api_output_unchanged(mocker, monkeypatch, config):
+    relations = [{'hostname': '1.2.3.4',
+                  'port': 1234,
+                  'user': 'foo',
+                  'password': 'bar'}]
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
+    monkeypatch.setattr(telegraf.hookenv, 'hook_name',
+                        lambda: 'influxdb-api-relation-changed')
+    write_file = mocker.spy(telegraf.host, 'write_file')
+    telegraf.influxdb_api_output('test')
+    telegraf.influxdb_api_output('test')
+    assert write_file.call_count == 1
+    relations[0]['password'] = 'baz'
+    telegraf.influxdb_api_output('test')
+    assert write_file.call_count == 2
+
+
 def test_memcached_input(monkeypatch, config):
     relations = [{'host': '1.2.3.4', 'port': 1234}]
     monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
@@ -383,6 +1412,7 @@ def test_memcached_input_no_relations(monkeypatch):
 
 def test_mongodb_input(monkeypatch, config):
     relations = [{'private-address': '1.2.3.4', 'port': 1234}]
+    monkeypatch.setattr(telegraf.hookenv, 'unit_private_ip', lambda: '1.2.3.4')
     monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
     telegraf.mongodb_input('test')
     expected = """
@@ -392,6 +1422,67 @@ def test_mongodb_input(monkeypatch, config):
     assert configs_dir().join('mongodb.conf').read().strip() == expected.strip()
 
 
+def test_mongodb_input_local_member(monkeypatch, config):
+    relations = [{'private-address': '1.2.3.4', 'port': 1234},
+                 {'private-address': '1.2.3.5', 'port': 1234}]
+    monkeypatch.setattr(telegraf.hookenv, 'unit_private_ip', lambda: '1.2.3.5')
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
+    telegraf.mongodb_input('test')
+    assert 'servers = ["1.2.3.5:1234"]' in configs_dir().join('mongodb.conf').read()
+    # the local member isn't known, collect all of them
+    bus.remove_state('plugins.mongodb.configured')
+    monkeypatch.setattr(telegraf.hookenv, 'unit_private_ip', lambda: '1.2.3.6')
+    telegraf.mongodb_input('test')
+    assert 'servers = ["1.2.3.4:1234", "1.2.3.5:1234"]' in \
+        configs_dir().join('mongodb.conf').read()
+
+
+def test_mongodb_input_perdb_stats(monkeypatch, config):
+    relations = [{'private-address': '1.2.3.4', 'port': 1234, 'replset': 'rs0'}]
+    monkeypatch.setattr(telegraf.hookenv, 'unit_private_ip', lambda: '1.2.3.4')
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
+    config['mongodb_perdb_stats'] = True
+    config['extra_options'] = """
+inputs:
+  mongodb:
+    gather_col_stats: true
+    gather_cluster_status: false
+"""
+    peers = {'telegraf/0': {'mongodb-cluster': 'rs0'},
+             'telegraf/1': {'mongodb-cluster': 'rs0'},
+             'telegraf/2': {'mongodb-cluster': 'rs1'}}
+    collectors = []
+    for unit in ('telegraf/0', 'telegraf/1'):
+        settings = fake_peers(monkeypatch, unit, peers)
+        bus.remove_state('plugins.mongodb.configured')
+        telegraf.mongodb_input('test')
+        assert settings == {'mongodb-cluster': 'rs0'}
+        content = configs_dir().join('mongodb.conf').read()
+        assert 'gather_cluster_status = false' in content
+        if 'gather_perdb_stats = true' in content:
+            assert 'gather_col_stats = true' in content
+            collectors.append(unit)
+        else:
+            assert 'gather_col_stats' not in content
+    assert len(collectors) == 1
+    # the other replica set has its own collector
+    fake_peers(monkeypatch, 'telegraf/2', peers)
+    relations[0]['replset'] = 'rs1'
+    bus.remove_state('plugins.mongodb.configured')
+    telegraf.mongodb_input('test')
+    assert 'gather_perdb_stats = true' in configs_dir().join('mongodb.conf').read()
+
+
+def test_mongodb_input_departed(monkeypatch, config):
+    settings = fake_peers(monkeypatch, 'telegraf/0', {})
+    configs_dir().join('mongodb.conf').write('empty')
+    bus.set_state('plugins.mongodb.configured')
+    telegraf.mongodb_input_departed()
+    assert not configs_dir().join('mongodb.conf').exists()
+    assert 'plugins.mongodb.configured' not in bus.get_states()
+    assert settings == {'mongodb-cluster': ''}
+
+
 def test_mongodb_input_no_relations(monkeypatch):
     monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: [])
     telegraf.mongodb_input('test')
@@ -484,22 +1575,21 @@ def test_exec_input(mocker, monkeypatch):
     telegraf.exec_input(interface)
     expected = """
 [[inputs.exec]]
-  commands = ['/srv/bin/test.sh', '/bin/true']
+  commands = ["/srv/bin/test.sh", "/bin/true"]
   data_format = "json"
   timeout = "5s"
 """
     assert configs_dir().join('exec.conf').read().strip() == expected.strip()
-    # add a second relation/command set
+    # add a second relation/command set, same commands are only run once
     interface.commands.return_value = [command.copy(), command.copy()]
     telegraf.exec_input(interface)
-    expected = expected +  expected
     assert configs_dir().join('exec.conf').read().strip() == expected.strip()
 
 
 def test_exec_input_with_tags(mocker, monkeypatch):
     interface = mocker.Mock(spec=RelationBase)
     interface.commands = mocker.Mock()
-    commands = [{'commands': ['/srv/bin/test.sh', '/bin/true'],
+    commands = [{"commands": ["/srv/bin/test.sh", "/bin/true"],
                  'data_format': 'json',
                  'timeout': '5s',
                  'run_on_this_unit': True,
@@ -508,7 +1598,7 @@ def test_exec_input_with_tags(mocker, monkeypatch):
     telegraf.exec_input(interface)
     expected = """
 [[inputs.exec]]
-  commands = ['/srv/bin/test.sh', '/bin/true']
+  commands = ["/srv/bin/test.sh", "/bin/true"]
   data_format = "json"
   timeout = "5s"
   [inputs.exec.tags]
@@ -520,7 +1610,7 @@ def test_exec_input_with_tags(mocker, monkeypatch):
 def test_exec_input_no_leader(mocker, monkeypatch):
     interface = mocker.Mock(spec=RelationBase)
     interface.commands = mocker.Mock()
-    commands = [{'commands': ['/srv/bin/test.sh', '/bin/true'],
+    commands = [{"commands": ["/srv/bin/test.sh", "/bin/true"],
                  'data_format': 'json',
                  'timeout': '5s',
                  'run_on_this_unit': False}]
@@ -540,7 +1630,7 @@ def test_exec_input_all_units(mocker, monkeypatch):
     telegraf.exec_input(interface)
     expected = """
 [[inputs.exec]]
-  commands = ['/srv/bin/test.sh', '/bin/true']
+  commands = ["/srv/bin/test.sh", "/bin/true"]
   data_format = "json"
   timeout = "5s"
 """
@@ -550,14 +1640,14 @@ def test_exec_input_all_units(mocker, monkeypatch):
 def test_exec_input_no_timeout_support(mocker, monkeypatch):
     interface = mocker.Mock(spec=RelationBase)
     interface.commands = mocker.Mock()
-    commands = [{'commands': ['/srv/bin/test.sh', '/bin/true'],
+    commands = [{"commands": ["/srv/bin/test.sh", "/bin/true"],
                  'data_format': 'json',
                  'timeout': '5s',
                  'run_on_this_unit': True}]
     interface.commands.return_value = commands
     expected = """
 [[inputs.exec]]
-  commands = ['/srv/bin/test.sh', '/bin/true']
+  commands = ["/srv/bin/test.sh", "/bin/true"]
   data_format = "json"
 """
     monkeypatch.setattr(telegraf, 'exec_timeout_supported', lambda: False)
@@ -565,6 +1655,148 @@ def test_exec_input_no_timeout_support(mocker, monkeypatch):
     assert configs_dir().join('exec.conf').read().strip() == expected.strip()
 
 
+def test_exec_input_grouping(mocker, monkeypatch):
+    interface = mocker.Mock(spec=RelationBase)
+    interface.commands = mocker.Mock()
+    commands = [{"commands": ["/srv/bin/a.sh"],
+                 'data_format': 'json',
+                 'timeout': '5s',
+                 'run_on_this_unit': True},
+                {'commands': ['/srv/bin/b.sh'],
+                 'data_format': 'influx',
+                 'timeout': '5s',
+                 'run_on_this_unit': True},
+                {'commands': ['/srv/bin/c.sh'],
+                 'data_format': 'json',
+                 'timeout': '5s',
+                 'run_on_this_unit': True}]
+    interface.commands.return_value = commands
+    telegraf.exec_input(interface)
+    expected = """
+[[inputs.exec]]
+  commands = ["/srv/bin/a.sh", "/srv/bin/c.sh"]
+  data_format = "json"
+  timeout = "5s"
+
+[[inputs.exec]]
+  commands = ["/srv/bin/b.sh"]
+  data_format = "influx"
+  timeout = "5s"
+"""
+    assert configs_dir().join('exec.conf').read().strip() == expected.strip()
+
+
+def test_exec_input_interval_hints(mocker, monkeypatch, config):
+    interface = mocker.Mock(spec=RelationBase)
+    interface.commands = mocker.Mock()
+    commands = [{"commands": ["/srv/bin/a.sh"],
+                 'data_format': 'json',
+                 'timeout': '5s',
+                 'interval': '1m',
+                 'run_on_this_unit': True},
+                {'commands': ['/srv/bin/b.sh'],
+                 'data_format': 'json',
+                 'timeout': '5s',
+                 'cost': '2.5',
+                 'run_on_this_unit': True},
+                {'commands': ['/srv/bin/c.sh'],
+                 'data_format': 'json',
+                 'timeout': '5s',
+                 'cost': None,
+                 'interval': None,
+                 'run_on_this_unit': True}]
+    interface.commands.return_value = commands
+    telegraf.exec_input(interface)
+    # cost 2.5s at 10% duty cycle -> 25s, rounded up to the 10s agent interval
+    expected = """
+[[inputs.exec]]
+  commands = ["/srv/bin/a.sh"]
+  data_format = "json"
+  interval = "60s"
+  timeout = "5s"
+
+[[inputs.exec]]
+  commands = ["/srv/bin/b.sh"]
+  data_format = "json"
+  interval = "30s"
+  timeout = "5s"
+
+[[inputs.exec]]
+  commands = ["/srv/bin/c.sh"]
+  data_format = "json"
+  timeout = "5s"
+"""
+    assert configs_dir().join('exec.conf').read().strip() == expected.strip()
+
+
+def test_exec_input_invalid_hints(mocker, monkeypatch, config):
+    interface = mocker.Mock(spec=RelationBase)
+    interface.commands = mocker.Mock()
+    commands = [{"commands": ["/srv/bin/a.sh"],
+                 'data_format': 'json',
+                 'timeout': '5s',
+                 'interval': 'hourly',
+                 'cost': '2.5',
+                 'run_on_this_unit': True},
+                {'commands': ['/srv/bin/b.sh'],
+                 'data_format': 'json',
+                 'timeout': '5s',
+                 'cost': 'cheap',
+                 'run_on_this_unit': True},
+                {'commands': ['/srv/bin/c.sh'],
+                 'data_format': 'json',
+                 'timeout': '5s',
+                 'cost': 'nan',
+                 'run_on_this_unit': True}]
+    interface.commands.return_value = commands
+    telegraf.exec_input(interface)
+    # the interval falls back to the cost, and bad costs to the default
+    expected = """
+[[inputs.exec]]
+  commands = ["/srv/bin/a.sh"]
+  data_format = "json"
+  interval = "30s"
+  timeout = "5s"
+
+[[inputs.exec]]
+  commands = ["/srv/bin/b.sh", "/srv/bin/c.sh"]
+  data_format = "json"
+  timeout = "5s"
+"""
+    assert configs_dir().join('exec.conf').read().strip() == expected.strip()
+
+
+def test_exec_input_max_commands(mocker, monkeypatch, config):
+    config['exec_max_commands'] = 2
+    interface = mocker.Mock(spec=RelationBase)
+    interface.commands = mocker.Mock()
+    commands = [{"commands": ["/srv/bin/expensive.sh"],
+                 'data_format': 'json',
+                 'cost': '5',
+                 'run_on_this_unit': True},
+                {'commands': ['/srv/bin/a.sh', '/srv/bin/b.sh'],
+                 'data_format': 'json',
+                 'run_on_this_unit': True},
+                {'commands': ['/srv/bin/c.sh'],
+                 'data_format': 'json',
+                 'run_on_this_unit': True}]
+    interface.commands.return_value = commands
+    telegraf.exec_input(interface)
+    expected = """
+[[inputs.exec]]
+  commands = ["/srv/bin/a.sh", "/srv/bin/b.sh"]
+  data_format = "json"
+"""
+    assert configs_dir().join('exec.conf').read().strip() == expected.strip()
+
+
+def test_parse_duration():
+    assert telegraf.parse_duration('10s') == 10
+    assert telegraf.parse_duration('1m30s') == 90
+    assert telegraf.parse_duration('500ms') == 0.5
+    assert telegraf.parse_duration('2h') == 7200
+
+
 def test_exec_input_departed(mocker, monkeypatch):
     configs_dir().join('exec.conf').write('empty')
     relations = [1]
@@ -576,19 +1808,317 @@ def test_exec_input_departed(mocker, monkeypatch):
     assert not configs_dir().join('exec.conf').exists()
 
 
+def test_listener_input(mocker, monkeypatch, tmpdir, config):
+    socket_dir = tmpdir.join('sockets')
+    monkeypatch.setattr(telegraf, 'LISTENER_SOCKET_DIR', socket_dir.strpath)
+    mkdir = mocker.patch('reactive.telegraf.host.mkdir')
+    mocker.patch('reactive.telegraf.pwd.getpwnam')
+    mocker.patch('reactive.telegraf.grp.getgrnam').return_value.gr_mem = ['root']
+    add_user_to_group = mocker.patch('reactive.telegraf.host.add_user_to_group')
+    interface = mocker.Mock(spec=RelationBase)
+    interface.listeners = mocker.Mock()
+    interface.users = mocker.Mock(return_value=['ubuntu', 'root'])
+    interface.configure = mocker.Mock()
+    interface.listeners.return_value = [('unix', 'influx'), ('udp', 'json'),
+                                        ('http', 'influx'), ('unix', 'influx'),
+                                        ('carrier-pigeon', 'influx'),
+                                        ('unix', '../../etc/cron.d/x')]
+    telegraf.listener_input(interface)
+    mkdir.assert_called_once_with(socket_dir.strpath, owner='telegraf',
+                                  group='telegraf', perms=0o750)
+    add_user_to_group.assert_called_once_with('ubuntu', 'telegraf')
+    expected = """
+[[inputs.http_listener_v2]]
+  service_address = "127.0.0.1:8094"
+  path = "/telegraf"
+  data_format = "influx"
+
+[[inputs.socket_listener]]
+  service_address = "udp://127.0.0.1:8095"
+  data_format = "json"
+
+[[inputs.socket_listener]]
+  service_address = "unix://{}/listener-influx.sock"
+  socket_mode = "0660"
+  data_format = "influx"
+""".format(socket_dir.strpath)
+    content = configs_dir().join('listener.conf').read()
+    assert [line for line in content.splitlines() if line.strip()] == \
+        [line for line in expected.splitlines() if line.strip()]
+    interface.configure.assert_called_once_with({
+        ('http', 'influx'): 'http://127.0.0.1:8094/telegraf',
+        ('udp', 'json'): '127.0.0.1:8095',
+        ('unix', 'influx'): socket_dir.join('listener-influx.sock').strpath})
+    assert 'plugins.listener.configured' in bus.get_states().keys()
+
+
+def test_listener_input_extra_options(mocker, config):
+    config['extra_options'] = """
+inputs:
+  socket_listener:
+    read_buffer_size: 65535
+"""
+    interface = mocker.Mock(spec=RelationBase)
+    interface.users = mocker.Mock(return_value=[])
+    interface.listeners = mocker.Mock(return_value=[('udp', 'influx')])
+    interface.configure = mocker.Mock()
+    telegraf.listener_input(interface)
+    assert 'read_buffer_size = 65535' in configs_dir().join('listener.conf').read()
+
+
+def test_listener_input_departed(mocker, monkeypatch):
+    configs_dir().join('listener.conf').write('empty')
+    relations = [1]
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
+    telegraf.listener_input_departed()
+    assert configs_dir().join('listener.conf').exists()
+    relations.pop()
+    telegraf.listener_input_departed()
+    assert not configs_dir().join('listener.conf').exists()
+
+
+def test_get_statsd_port(config):
+    config['statsd_port'] = ''
+    assert telegraf.get_statsd_port() is False
+    config['statsd_port'] = 'default'
+    assert telegraf.get_statsd_port() == 8125
+    config['statsd_port'] = '9125'
+    assert telegraf.get_statsd_port() == 9125
+
+
+def test_configure_statsd(config):
+    config['statsd_port'] = 'default'
+    config['statsd_percentiles'] = '50, 90,99.9'
+    config['statsd_delete_gauges'] = False
+    config['statsd_metric_separator'] = '.'
+    telegraf.configure_statsd()
+    content = configs_dir().join('statsd.conf').read()
+    for line in ['service_address = ":8125"',
+                 'percentiles = [50, 90, 99.9]',
+                 'delete_gauges = false',
+                 'delete_counters = true',
+                 'allowed_pending_messages = 10000',
+                 'percentile_limit = 1000',
+                 'metric_separator = "."']:
+        assert line in content
+    assert telegraf.unitdata.kv().get('ports') == {'statsd': '8125/udp'}
+    assert configs_dir().join('statsd.conf').strpath in telegraf.list_config_files()
+    # disable it
+    bus.remove_state('plugins.statsd.configured')
+    config['statsd_port'] = ''
+    telegraf.configure_statsd()
+    assert not configs_dir().join('statsd.conf').exists()
+    assert telegraf.unitdata.kv().get('ports') == {}
+
+
+def test_configure_statsd_invalid_percentiles(config):
+    config['statsd_percentiles'] = '50, p99,90, 101'
+    assert telegraf.get_config_error() is None
+    config['statsd_port'] = 'default'
+    telegraf.configure_statsd()
+    assert 'percentiles = [50, 90]' in configs_dir().join('statsd.conf').read()
+    assert telegraf.get_config_error() == \
+        'Invalid statsd_percentiles: 50, p99,90, 101'
+
+
+def test_statsd_listener_udp(mocker, config):
+    mocker.patch('reactive.telegraf.get_installed_version',
+                 return_value='1.12.0-1')
+    config['statsd_port'] = '8200'
+    config['statsd_percentiles'] = '50,99.9'
+    config['statsd_allowed_pending_messages'] = 500
+    config['statsd_percentile_limit'] = 200
+    telegraf.configure_statsd()
+    content = configs_dir().join('statsd.conf').read()
+    options = [line.strip() for line in content.split('[[inputs.statsd]]\n')[1]
+               .splitlines() if line.strip() and not line.lstrip().startswith('#')]
+    assert options[:2] == ['protocol = "udp"', 'service_address = ":8200"']
+    for line in ['percentiles = [50, 99.9]',
+                 'allowed_pending_messages = 500',
+                 'percentile_limit = 200']:
+        assert line in options
+    assert telegraf.unitdata.kv().get('ports') == {'statsd': '8200/udp'}
+    # the principal gets the same UDP address via the listener relation
+    interface = mocker.Mock(spec=RelationBase)
+    interface.users = mocker.Mock(return_value=[])
+    interface.listeners = mocker.Mock(return_value=[('statsd', 'statsd')])
+    interface.configure = mocker.Mock()
+    telegraf.listener_input(interface)
+    address = interface.configure.call_args[0][0][('statsd', 'statsd')]
+    assert address.endswith(':8200')
+    assert not configs_dir().join('listener.conf').exists()
+
+
+def test_statsd_protocol_unsupported(mocker, config):
+    mocker.patch('reactive.telegraf.get_installed_version',
+                 return_value='1.4.0-1')
+    config['statsd_port'] = 'default'
+    telegraf.configure_statsd()
+    content = configs_dir().join('statsd.conf').read()
+    assert 'protocol' not in content
+    assert 'service_address = ":8125"' in content
+
+
+def test_statsd_listener_not_configured(mocker, config):
+    interface = mocker.Mock(spec=RelationBase)
+    interface.users = mocker.Mock(return_value=[])
+    interface.listeners = mocker.Mock(return_value=[('statsd', 'statsd')])
+    interface.configure = mocker.Mock()
+    telegraf.listener_input(interface)
+    interface.configure.assert_called_once_with({})
+
+
+def test_config_changed_statsd(mocker, config):
+    service_restart = mocker.patch('reactive.telegraf.host.service_restart')
+    bus.set_state('telegraf.installed')
+    bus.dispatch()
+    service_restart.reset_mock()
+    config.save()
+    config.load_previous()
+    config['statsd_port'] = 'default'
+    bus.set_state('config.changed')
+    bus.dispatch()
+    assert configs_dir().join('statsd.conf').exists()
+    service_restart.assert_called_once_with('telegraf')
+
+
+def test_configure_procstat(monkeypatch, tmpdir, config):
+    units_dir = tmpdir.mkdir('units')
+    units_dir.join('remote-unit.service').write('')
+    monkeypatch.setattr(telegraf, 'SYSTEMD_UNIT_DIRS', (units_dir.strpath,))
+    monkeypatch.setattr(telegraf, 'get_remote_unit_name', lambda: 'remote-unit/0')
+    config['procstat_targets'] = ('principal, cgroup:system.slice/a.service, '
+                                  'pid_file:/run/b.pid, pattern:c, pid_file:')
+    config['extra_options'] = 'inputs:\n  procstat:\n    pid_tag: true'
+    telegraf.configure_procstat()
+    expected = """
+[[inputs.procstat]]
+  systemd_unit = "remote-unit.service"
+  pid_tag = true
+
+[[inputs.procstat]]
+  cgroup = "system.slice/a.service"
+  pid_tag = true
+
+[[inputs.procstat]]
+  pid_file = "/run/b.pid"
+  pid_tag = true
+"""
+    assert configs_dir().join('procstat.conf').read() == expected
+    assert 'plugins.procstat.configured' in bus.get_states().keys()
+    assert telegraf.get_plugin_config_path('procstat') in \
+        telegraf.list_config_files()
+
+
+def test_configure_procstat_no_principal_unit(monkeypatch, tmpdir, config):
+    monkeypatch.setattr(telegraf, 'SYSTEMD_UNIT_DIRS',
+                        (tmpdir.mkdir('units').strpath,))
+    configs_dir().join('procstat.conf').write('empty')
+    config['procstat_targets'] = 'principal'
+    telegraf.configure_procstat()
+    assert not configs_dir().join('procstat.conf').exists()
+    assert 'plugins.procstat.configured' not in bus.get_states().keys()
+    # the principal isn't known yet, keep the config until it is
+    configs_dir().join('procstat.conf').write('empty')
+    monkeypatch.setattr(telegraf, 'get_remote_unit_name', lambda: None)
+    telegraf.configure_procstat()
+    assert configs_dir().join('procstat.conf').exists()
+
+
 def test_influxdb_api_output(monkeypatch, config):
     relations = [{'hostname': '1.2.3.4',
                   'port': 1234,
                   'user': 'foo',
                   'password': 'bar'}]
     monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
+    # content_encoding is only supported since telegraf 1.8
+    monkeypatch.setattr(telegraf, 'get_installed_version', lambda p: '1.4.0-1')
+    telegraf.influxdb_api_output('test')
+    expected = """
+[[outputs.influxdb]]
+  urls = ["http://1.2.3.4:1234"]
+  database = "telegraf"
+  precision = "s"
+  timeout = "5s"
+  username = "foo"
+  password = "bar"
+  user_agent = "telegraf"
+"""
+    content = configs_dir().join('influxdb-api.conf').read()
+    assert [line for line in content.splitlines()
+            if not line.lstrip().startswith('#')] == expected.splitlines()
+    assert 'content_encoding' not in content
+
+
+def test_influxdb_api_output_transport(monkeypatch, config):
+    # stand-in for the related InfluxDB, advertising its version and UDP port
+    influxdb = {'hostname': '1.2.3.4',
+                'port': 8086,
+                'user': 'foo',
+                'password': 'bar',
+                'version': '1.7.3'}
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: [influxdb])
+    monkeypatch.setattr(telegraf, 'get_installed_version', lambda p: '1.9.0-1')
+    monkeypatch.setitem(os.environ, 'JUJU_HOOK_NAME', 'influxdb-api-relation-changed')
+    telegraf.influxdb_api_output('test')
+    content = configs_dir().join('influxdb-api.conf').read()
+    assert 'content_encoding = "gzip"' in content
+    assert 'timeout = "5s"' in content
+    assert 'precision = "s"' in content
+    # an old InfluxDB doesn't get gzipped writes
+    influxdb['version'] = '0.13.0'
+    telegraf.influxdb_api_output('test')
+    assert 'content_encoding' not in configs_dir().join('influxdb-api.conf').read()
+    # unless asked for
+    config['influxdb_content_encoding'] = 'gzip'
+    config['influxdb_precision'] = 'ms'
+    config['influxdb_timeout'] = ''
+    telegraf.influxdb_api_output('test')
+    content = configs_dir().join('influxdb-api.conf').read()
+    assert 'content_encoding = "gzip"' in content
+    assert 'precision = "ms"' in content
+    assert 'timeout =' not in content
+    # old telegraf versions don't support it
+    monkeypatch.setattr(telegraf, 'get_installed_version', lambda p: '1.4.0-1')
+    telegraf.influxdb_api_output('test')
+    assert 'content_encoding' not in configs_dir().join('influxdb-api.conf').read()
+    # UDP, only if the InfluxDB unit has an UDP listener
+    config['influxdb_udp'] = True
+    telegraf.influxdb_api_output('test')
+    content = configs_dir().join('influxdb-api.conf').read()
+    assert 'urls = ["http://1.2.3.4:8086"]' in content
+    influxdb['udp-port'] = 8089
+    telegraf.influxdb_api_output('test')
+    content = configs_dir().join('influxdb-api.conf').read()
+    assert 'urls = ["udp://1.2.3.4:8089"]' in content
+
+
+def test_influxdb_api_output_config_changed(config):
+    bus.set_state('plugins.influxdb-api.configured')
+    config.save()
+    config.load_previous()
+    config['influxdb_udp'] = True
+    telegraf.handle_config_changes()
+    assert 'plugins.influxdb-api.configured' not in bus.get_states()
+
+
+def test_influxdb_api_output_routing(monkeypatch, config):
+    relations = [{'hostname': '1.2.3.4',
+                  'port': 1234,
+                  'user': 'foo',
+                  'password': 'bar'}]
+    monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: relations)
+    config['routing'] = "influxdb: ['postgresql*']"
+    telegraf.influxdb_api_output('test')
+    content = configs_dir().join('influxdb-api.conf').read()
+    assert 'namepass = ["postgresql*"]' in content
+    # re-rendered when the routing changes
+    config['routing'] = "influxdb: {namedrop: ['cpu']}"
+    monkeypatch.setitem(os.environ, 'JUJU_HOOK_NAME', 'influxdb-api-relation-changed')
     telegraf.influxdb_api_output('test')
-    expected = render(source='influxdb-api.conf.tmpl', target=None,
-                      templates_dir=telegraf.get_templates_dir(),
-                      context={'username': 'foo',
-                               'password': 'bar',
-                               'urls': '["http://1.2.3.4:1234"]'})
-    assert configs_dir().join('influxdb-api.conf').read().strip() == expected.strip()
+    content = configs_dir().join('influxdb-api.conf').read()
+    assert 'namepass' not in content
+    assert 'namedrop = ["cpu"]' in content
 
 
 def test_prometheus_client_output(mocker, monkeypatch, config):
@@ -602,6 +2132,39 @@ def test_prometheus_client_output(mocker, monkeypatch, config):
   listen = ":9126"
 """
     assert configs_dir().join('prometheus-client.conf').read().strip() == expected.strip()
+    assert telegraf.unitdata.kv().get('ports') == {'prometheus-client': '9126/tcp'}
+
+
+def test_prometheus_client_output_global(mocker, monkeypatch, config):
+    config['prometheus_output_port'] = 'default'
+    interface = mocker.Mock(spec=RelationBase)
+    interface.configure = mocker.Mock()
+    telegraf.prometheus_client(interface)
+    interface.configure.assert_called_once_with(9103)
+    assert not configs_dir().join('prometheus-client.conf').exists()
+    assert telegraf.unitdata.kv().get('ports', {}) == {}
+
+
+def test_prometheus_client_output_options(mocker, monkeypatch, config):
+    monkeypatch.setattr(telegraf.hookenv, 'open_port',
+                        lambda p: None)
+    config['prometheus_expiration_interval'] = '30s'
+    config['prometheus_collectors_exclude'] = 'gocollector, process'
+    config['prometheus_string_as_label'] = False
+    config['prometheus_path'] = '/telegraf'
+    interface = mocker.Mock(spec=RelationBase)
+    interface.configure = mocker.Mock()
+    telegraf.prometheus_client(interface)
+    expected = """
+[[outputs.prometheus_client]]
+  listen = ":9126"
+  collectors_exclude = ["gocollector", "process"]
+  expiration_interval = "30s"
+  path = "/telegraf"
+  string_as_label = false
+"""
+    content = configs_dir().join('prometheus-client.conf').read()
+    assert sorted(content.split()) == sorted(expected.split())
 
 
 def test_prometheus_client_output_departed(mocker, monkeypatch, config):
@@ -631,6 +2194,8 @@ def test_config_changed_apt(mocker, config):
     apt_install = mocker.patch('reactive.telegraf.apt_install')
     apt_update = mocker.patch('reactive.telegraf.apt_update')
     add_source = mocker.patch('reactive.telegraf.add_source')
+    mocker.patch('reactive.telegraf.get_installed_version', return_value='1.0.0')
+    mocker.patch('reactive.telegraf.get_package_file', return_value=None)
     bus.set_state('telegraf.installed')
     config.save()
     config['apt_repository'] = "ppa:test-repo"
@@ -643,6 +2208,77 @@ def test_config_changed_apt(mocker, config):
     service_restart.assert_called_once_with('telegraf')
 
 
+def test_install_already_installed(mocker, config):
+    apt_install = mocker.patch('reactive.telegraf.apt_install')
+    apt_update = mocker.patch('reactive.telegraf.apt_update')
+    mocker.patch('reactive.telegraf.add_source')
+    mocker.patch('reactive.telegraf.get_installed_version', return_value='1.4.0-1')
+    mocker.patch('reactive.telegraf.get_package_file', return_value=None)
+    config.save()
+    config.load_previous()
+    telegraf.install_telegraf()
+    assert not apt_update.called
+    assert not apt_install.called
+    assert 'telegraf.installed' in bus.get_states().keys()
+    assert telegraf.unitdata.kv().get('install')['source'] == 'installed'
+    # pinned to a different version
+    config['package_name'] = 'telegraf=1.5.0-1'
+    telegraf.install_telegraf()
+    assert apt_update.called
+    apt_install.assert_called_once_with('telegraf=1.5.0-1', fatal=True)
+    assert telegraf.unitdata.kv().get('install')['source'] == 'apt'
+
+
+def test_install_from_file(mocker, config):
+    apt_install = mocker.patch('reactive.telegraf.apt_install')
+    check_call = mocker.patch('reactive.telegraf.subprocess.check_call')
+    mocker.patch('reactive.telegraf.hookenv.resource_get', return_value=False)
+    get_installed_version = mocker.patch('reactive.telegraf.get_installed_version',
+                                         return_value=None)
+    mocker.patch('reactive.telegraf.get_deb_version', return_value='1.4.0-1')
+    files_dir = py.path.local(telegraf.hookenv.charm_dir()).mkdir('files')
+    files_dir.join('telegraf_1.4.0-1_amd64.deb').write('deb')
+    config['package_name'] = 'telegraf_1.4.0-1_amd64.deb'
+    assert telegraf.get_package_file() == files_dir.join(config['package_name']).strpath
+    telegraf.install_telegraf()
+    check_call.assert_called_once_with(
+        ['dpkg', '-i', files_dir.join(config['package_name']).strpath])
+    assert not apt_install.called
+    assert telegraf.unitdata.kv().get('install')['source'] == 'file'
+    # same version already installed
+    check_call.reset_mock()
+    get_installed_version.return_value = '1.4.0-1'
+    telegraf.install_telegraf()
+    assert not check_call.called
+
+
+def test_get_package_file_resource(mocker, config, tmpdir):
+    resource = tmpdir.join('telegraf.deb')
+    resource.write('')
+    mocker.patch('reactive.telegraf.hookenv.resource_get',
+                 return_value=resource.strpath + '\n')
+    # empty resources are ignored
+    assert telegraf.get_package_file() is None
+    resource.write('deb')
+    assert telegraf.get_package_file() == resource.strpath
+
+
+def test_config_changed_systemd(mocker, config):
+    service_restart = mocker.patch('reactive.telegraf.host.service_restart')
+    check_call = mocker.patch('reactive.telegraf.subprocess.check_call')
+    bus.set_state('telegraf.installed')
+    bus.dispatch()
+    service_restart.assert_called_once_with('telegraf')
+    service_restart.reset_mock()
+    config.save()
+    config.load_previous()
+    config['cpu_quota'] = '50%'
+    bus.set_state('config.changed')
+    bus.dispatch()
+    check_call.assert_called_once_with(['systemctl', 'daemon-reload'])
+    service_restart.assert_called_once_with('telegraf')
+
+
 def test_config_changed_extra_options(mocker, config):
     service_restart = mocker.patch('reactive.telegraf.host.service_restart')
     bus.set_state('telegraf.installed')
@@ -676,6 +2312,313 @@ def test_config_changed_extra_plugins(mocker, config):
     service_restart.assert_called_once_with('telegraf')
 
 
+def test_config_changed_extra_plugins_removed(mocker, config):
+    service_restart = mocker.patch('reactive.telegraf.host.service_restart')
+    config['extra_plugins'] = yaml.dump({
+        'foo': {'plugin': 'inputs.foo', 'option': 1}})
+    bus.set_state('telegraf.installed')
+    telegraf.configure_telegraf()
+    telegraf.configure_extra_plugins()
+    persist_state()
+    config.save()
+    config.load_previous()
+    config['extra_plugins'] = ""
+    bus.set_state('config.changed')
+    bus.dispatch()
+    assert not configs_dir().join('extra_plugins-foo.conf').exists()
+    service_restart.assert_called_once_with('telegraf')
+
+
+def test_invalid_config_not_restarted(mocker, config):
+    service_restart = mocker.patch('reactive.telegraf.host.service_restart')
+    status_set = mocker.patch('reactive.telegraf.hookenv.status_set')
+    validate_config = mocker.patch('reactive.telegraf.validate_config',
+                                   return_value=None)
+    callbacks = []
+    mocker.patch('reactive.telegraf.hookenv.atexit', callbacks.append)
+
+    def end_hook():
+        bus.remove_state('config.changed')
+        while callbacks:
+            callbacks.pop(0)()
+    bus.set_state('telegraf.installed')
+    bus.dispatch()
+    service_restart.assert_called_once_with('telegraf')
+    status_set.assert_called_once_with('active', '')
+    good_config = base_dir().join('telegraf.conf').read()
+    assert base_dir().join(telegraf.LAST_GOOD_DIR, 'telegraf.conf').read() == good_config
+    # now break the config
+    service_restart.reset_mock()
+    validate_config.return_value = 'Error parsing telegraf.conf'
+    config.save()
+    config.load_previous()
+    config['interval'] = '10 seconds'
+    bus.set_state('config.changed')
+    bus.dispatch()
+    assert not service_restart.called
+    status_set.assert_called_with('blocked',
+                                  'Invalid telegraf config, see juju debug-log')
+    assert 'telegraf.config.invalid' in bus.get_states()
+    assert base_dir().join('telegraf.conf').read() == good_config
+    end_hook()
+    # rendered again on the next hook, and rejected again
+    validate_config.reset_mock()
+    bus.dispatch()
+    assert validate_config.called
+    assert not service_restart.called
+    assert base_dir().join('telegraf.conf').read() == good_config
+    end_hook()
+    # applied once it's accepted
+    validate_config.return_value = None
+    bus.dispatch()
+    service_restart.assert_called_once_with('telegraf')
+    assert 'interval = "10 seconds"' in base_dir().join('telegraf.conf').read()
+    assert 'telegraf.config.invalid' not in bus.get_states()
+
+
+INTERNAL_METRICS = """# HELP internal_gather_gather_time_ns Telegraf collected metric
+# TYPE internal_gather_gather_time_ns untyped
+internal_gather_gather_time_ns{host="foo",input="cpu"} 1.2e+06
+internal_gather_gather_time_ns{host="foo",input="mongodb"} 9.5e+09
+internal_write_buffer_limit{host="foo",output="influxdb"} 10000
+internal_write_buffer_size{host="foo",output="influxdb"} 9000
+internal_write_buffer_limit{host="foo",output="file"} 10000
+internal_write_buffer_size{host="foo",output="file"} 10
+internal_write_errors{host="foo",output="influxdb"} 3
+internal_write_metrics_dropped{host="foo",output="influxdb"} 0
+internal_agent_gather_errors{host="foo"} 0
+"""
+
+
+def test_health_config(mocker, config):
+    get_installed_version = mocker.patch(
+        'reactive.telegraf.get_installed_version', return_value='1.4.0-1')
+    telegraf.configure_telegraf()
+    assert 'internal' not in base_dir().join('telegraf.conf').read()
+    config['health_port'] = 9274
+    telegraf.configure_telegraf()
+    content = base_dir().join('telegraf.conf').read()
+    expected = """
+[[outputs.prometheus_client]]
+  listen = "127.0.0.1:9274"
+  namepass = ["internal_*"]
+"""
+    assert expected in content
+    assert '[[inputs.internal]]' in content
+    assert telegraf.unitdata.kv().get('health.port') == 9274
+    # no internal input in telegraf 0.12
+    get_installed_version.return_value = '0.12.1-1'
+    telegraf.configure_telegraf()
+    assert 'internal' not in base_dir().join('telegraf.conf').read()
+    assert not telegraf.unitdata.kv().get('health.port')
+
+
+def test_get_internal_metrics(mocker, config):
+    urlopen = mocker.patch('reactive.telegraf.urllib.request.urlopen')
+    urlopen.return_value.__enter__.return_value.read.return_value = \
+        INTERNAL_METRICS.encode('utf-8')
+    telegraf.unitdata.kv().set('health.port', 9274)
+    metrics = telegraf.get_internal_metrics()
+    urlopen.assert_called_once_with('http://127.0.0.1:9274/metrics',
+                                    timeout=telegraf.HEALTH_TIMEOUT)
+    assert len(metrics) == 9
+    assert metrics[1] == ('internal_gather_gather_time_ns',
+                          {'host': 'foo', 'input': 'mongodb'}, 9.5e9)
+    assert metrics[-1] == ('internal_agent_gather_errors', {'host': 'foo'}, 0)
+
+
+def test_check_health(mocker, config):
+    metrics = [('internal_gather_gather_time_ns', {'input': 'cpu'}, 1e6),
+               ('internal_write_buffer_limit', {'output': 'influxdb'}, 10000),
+               ('internal_write_buffer_size', {'output': 'influxdb'}, 10),
+               ('internal_write_errors', {'output': 'influxdb'}, 3),
+               ('internal_write_metrics_dropped', {'output': 'influxdb'}, 0)]
+    assert telegraf.check_health(metrics) == ('active', '')
+    # counters only count when they go up
+    metrics[-2] = ('internal_write_errors', {'output': 'influxdb'}, 5)
+    metrics.append(('internal_gather_gather_time_ns', {'input': 'mongodb'}, 9.5e9))
+    metrics.append(('internal_write_buffer_size', {'output': 'file'}, 9000))
+    assert telegraf.check_health(metrics) == (
+        'blocked', 'write errors: influxdb; buffer full: file; '
+        'slow inputs: mongodb')
+    # no buffer_limit in older telegraf versions
+    config['health_gather_threshold'] = 1
+    metrics[-1] = ('internal_write_buffer_size', {'output': 'file'}, 2000)
+    config['metric_buffer_limit'] = 2000
+    assert telegraf.check_health(metrics) == ('active', 'buffer full: file')
+
+
+def test_update_health(mocker, monkeypatch, config):
+    status_set = mocker.patch('reactive.telegraf.hookenv.status_set')
+    get_internal_metrics = mocker.patch(
+        'reactive.telegraf.get_internal_metrics',
+        return_value=[('internal_write_metrics_dropped', {'output': 'file'}, 1)])
+    bus.set_state('telegraf.configured')
+    # no health endpoint in the config
+    telegraf.update_health()
+    assert not get_internal_metrics.called
+    telegraf.unitdata.kv().set('health.port', 9274)
+    bus.remove_state('telegraf.configured')
+    telegraf.update_health()
+    assert not get_internal_metrics.called
+    bus.set_state('telegraf.configured')
+    telegraf.update_health()
+    status_set.assert_called_once_with('active', '')
+    get_internal_metrics.return_value = [
+        ('internal_write_metrics_dropped', {'output': 'file'}, 20)]
+    telegraf.update_health()
+    status_set.assert_called_with('blocked', 'dropping metrics: file')
+    get_internal_metrics.side_effect = IOError('Connection refused')
+    telegraf.update_health()
+    status_set.assert_called_with('blocked',
+                                  'Telegraf internal metrics not available')
+    # the invalid config status is kept
+    status_set.reset_mock()
+    bus.set_state('telegraf.config.invalid')
+    telegraf.update_health()
+    assert not status_set.called
+
+
+def test_debug_duration(monkeypatch, config):
+    now = [1000]
+    monkeypatch.setattr(telegraf.time, 'time', lambda: now[0])
+    config['debug'] = True
+    config['debug_duration'] = '1h'
+    telegraf.start_debug_window()
+    assert telegraf.is_debug_active()
+    assert telegraf.get_status_message() == 'debug: on'
+    now[0] += 3601
+    assert not telegraf.is_debug_active()
+    assert telegraf.get_status_message() == 'debug: expired'
+    config['debug'] = False
+    telegraf.start_debug_window()
+    assert telegraf.get_status_message() == ''
+
+
+def test_debug_upgrade(monkeypatch, config):
+    now = [1000]
+    monkeypatch.setattr(telegraf.time, 'time', lambda: now[0])
+    # debug was on before the charm tracked the window
+    config['debug'] = True
+    config['debug_duration'] = '1h'
+    assert telegraf.is_debug_active()
+    assert telegraf.unitdata.kv().get('debug.since') == 1000
+    now[0] += 3601
+    assert not telegraf.is_debug_active()
+
+
+def test_debug_duration_invalid(config):
+    config['debug'] = True
+    config['debug_duration'] = 'a while'
+    telegraf.start_debug_window()
+    assert telegraf.is_debug_active()
+    telegraf.expire_debug()
+    assert telegraf.get_config_error() == 'Invalid debug_duration: a while'
+
+
+def test_expire_debug(monkeypatch, config):
+    now = [1000]
+    monkeypatch.setattr(telegraf.time, 'time', lambda: now[0])
+    config['debug'] = True
+    config['debug_duration'] = '10m'
+    telegraf.start_debug_window()
+    bus.set_state('telegraf.configured')
+    bus.set_state('plugins.exec.configured')
+    telegraf.expire_debug()
+    assert 'telegraf.configured' in bus.get_states().keys()
+    now[0] += 601
+    telegraf.expire_debug()
+    assert 'telegraf.configured' not in bus.get_states().keys()
+    assert 'plugins.exec.configured' not in bus.get_states().keys()
+    telegraf.configure_telegraf()
+    assert 'debug = false' in base_dir().join('telegraf.conf').read()
+
+
+def test_agent_table(config):
+    config['hostname'] = 'myhost'
+    telegraf.configure_telegraf()
+    content = base_dir().join('telegraf.conf').read()
+    options = [line.strip() for line in content.split('[agent]\n')[1]
+               .split('\n\n')[0].splitlines()
+               if not line.lstrip().startswith('#')]
+    assert options == [
+        'interval = "{}"'.format(config['interval']),
+        'round_interval = true',
+        'metric_buffer_limit = 10000',
+        'collection_jitter = "{}"'.format(config['collection_jitter']),
+        'flush_interval = "{}"'.format(config['flush_interval']),
+        'flush_jitter = "{}"'.format(config['flush_jitter']),
+        'debug = false',
+        'quiet = false',
+        'hostname = "myhost"']
+
+
+def test_logfile(config):
+    telegraf.configure_telegraf()
+    assert 'logfile' not in base_dir().join('telegraf.conf').read()
+    bus.remove_state('telegraf.configured')
+    config['logfile'] = base_dir().join('telegraf.log').strpath
+    telegraf.configure_telegraf()
+    expected = """
+  logfile = "{}"
+  logfile_rotation_max_size = "10MB"
+  logfile_rotation_max_archives = 5
+""".format(config['logfile'])
+    assert expected in base_dir().join('telegraf.conf').read()
+
+
+def test_update_nrpe_config(mocker, config):
+    nrpe = mocker.patch('reactive.telegraf.nrpe')
+    nrpe.get_nagios_unit_name.return_value = 'telegraf/0'
+    nrpe_setup = nrpe.NRPE.return_value
+    mocker.patch('reactive.telegraf.get_installed_version',
+                 return_value='1.4.0-1')
+    config['health_port'] = 9274
+    telegraf.update_nrpe_config('nrpe-external-master')
+    nrpe.copy_nrpe_checks.assert_called_once_with(nrpe_files_dir=os.path.join(
+        telegraf.hookenv.charm_dir(), 'files', 'nrpe'))
+    checks = dict((kw['shortname'], kw['check_cmd'])
+                  for _, kw in nrpe_setup.add_check.call_args_list)
+    assert checks == {
+        'telegraf_proc': 'check_procs -c 1: -C telegraf',
+        'telegraf_write_errors': 'check_telegraf.py errors --port 9274',
+        'telegraf_buffer': 'check_telegraf.py buffer --port 9274 -w 80 -c 95 '
+                           '--limit 10000',
+        'telegraf_gather_time': 'check_telegraf.py gather --port 9274 -w 8 -c 10'}
+    nrpe_setup.write.assert_called_once_with()
+    assert 'telegraf.nrpe.configured' in bus.get_states()
+    # without the health endpoint only the process is checked
+    nrpe_setup.reset_mock()
+    config['health_port'] = 0
+    telegraf.update_nrpe_config('nrpe-external-master')
+    assert [kw['shortname'] for _, kw in nrpe_setup.add_check.call_args_list] == \
+        ['telegraf_proc']
+    assert [kw['shortname'] for _, kw in nrpe_setup.remove_check.call_args_list] == \
+        list(telegraf.NRPE_CHECKS[1:])
+
+
+def test_remove_nrpe_config(mocker, config):
+    nrpe = mocker.patch('reactive.telegraf.nrpe')
+    bus.set_state('telegraf.nrpe.configured')
+    telegraf.remove_nrpe_config()
+    assert [kw['shortname'] for _, kw in
+            nrpe.NRPE.return_value.remove_check.call_args_list] == \
+        list(telegraf.NRPE_CHECKS)
+    assert 'telegraf.nrpe.configured' not in bus.get_states()
+
+
+def test_nrpe_config_changed(config):
+    bus.set_state('telegraf.nrpe.configured')
+    config.save()
+    config.load_previous()
+    config['tags'] = 'dc=us-east-1'
+    telegraf.handle_config_changes()
+    assert 'telegraf.nrpe.configured' in bus.get_states()
+    config['nrpe_buffer_warning'] = 50
+    telegraf.handle_config_changes()
+    assert 'telegraf.nrpe.configured' not in bus.get_states()
+
+
 def test_restart_on_output_plugin_relation_departed(mocker, monkeypatch, config):
     service_restart = mocker.patch('reactive.telegraf.host.service_restart')
     monkeypatch.setattr(telegraf.hookenv, 'relations_of_type', lambda n: [])